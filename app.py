@@ -1,25 +1,217 @@
-import os, sqlite3, mimetypes, platform, shutil
+import os, re, sqlite3, mimetypes, platform, shutil
 from math import ceil
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    send_from_directory, abort, jsonify, send_file, flash
+    send_from_directory, send_file, abort, jsonify, flash, Response, g
 )
+from flask import Request
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from werkzeug.wsgi import ClosingIterator
+from markupsafe import Markup, escape
+import click
 import zipfile
-import io
 import threading
 import time
+import json
+import base64
+import zlib
+import gzip
+import hashlib
+import tempfile
+import subprocess
+import sys
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import deque, OrderedDict
+from array import array
+from bisect import bisect_left
+from urllib.parse import quote
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Optional: without Pillow image cards fall back to the original file
+    Image = None
+try:
+    import brotli
+except ImportError:  # Optional: without it responses are gzip-compressed only
+    brotli = None
+try:
+    import fcntl
+except ImportError:  # Windows: no host-wide locks, every process runs the services
+    fcntl = None
 import logging
 
+IMPORT_STARTED = time.perf_counter()
+
 APP_ROOT      = os.path.dirname(os.path.abspath(__file__))
-UPLOAD_FOLDER = "/export/nas/paste_bin_files/"
-DB_PATH       = os.path.join(APP_ROOT, "pastes.db")
+UPLOAD_FOLDER = os.environ.get("PASTEBIN_UPLOAD_FOLDER", "/export/nas/paste_bin_files/")  # initial default only
+DB_PATH       = os.environ.get("PASTEBIN_DB", os.path.join(APP_ROOT, "pastes.db"))
 PAGE_SIZE     = 15
+SCHEMA_VERSION = 5     # bump whenever init_db() changes; stored in PRAGMA user_version
+PREVIEW_CHARS = 200    # characters of a paste body shipped with the listing
+
+# Text pastes above this many bytes keep only their head inline (for the
+# listing) and the full body zlib-compressed in paste_bodies
+INLINE_TEXT_LIMIT   = 64 * 1024
+TEXT_COMPRESS_LEVEL = 6
+TEXT_STREAM_CHUNK   = 256 * 1024
+COUNT_CAP     = 10000  # filtered listings count at most this many rows
+
+# SQLite connection tuning
+DB_BUSY_TIMEOUT    = 30                 # seconds a writer waits for the lock
+DB_MMAP_SIZE       = 256 * 1024 * 1024  # bytes of the database file to memory-map
+DB_CACHE_KIB       = 16 * 1024          # page cache per connection
+DB_STATEMENT_CACHE = 256                # prepared statements kept per connection
+SETTINGS_CACHE_TTL = 5                  # seconds; bounds staleness across worker processes
+
+# Uploads are written straight into the upload folder under a temp name
+UPLOAD_TEMP_PREFIX   = ".upload-"
+UPLOAD_CHUNK_SIZE    = 1024 * 1024   # bytes read from the request per write
+UPLOAD_SESSION_TTL   = 24 * 3600     # seconds an unfinished resumable upload is kept
+
+# Stored files live in hash-prefix subdirectories (e.g. 3/f/<name>) so no directory
+# grows past a few thousand entries; 16 x 16 leaves keep the recursive watcher
+# at 273 inotify watches. Changing these needs `flask --app app shard-upload-folder`.
+SHARD_LEVELS = 2
+SHARD_CHARS  = 1
+
+# Content-addressed storage: identical uploads share one blob named by its SHA-256
+CAS_PREFIX      = "cas_"
+DEDUPE_DEFAULT  = "true" if os.environ.get("PASTEBIN_DEDUPE") == "1" else "false"
+
+# Card thumbnails; generated in a small worker pool and cached on local disk
+THUMB_FOLDER          = os.environ.get("PASTEBIN_THUMB_DIR", os.path.join(APP_ROOT, "thumbnails"))
+THUMB_SIZE            = (480, 256)           # bounding box; cards are 128px high, this covers 2x screens
+THUMB_QUALITY         = 80
+THUMB_WORKERS         = 2
+THUMB_WAIT            = 15                   # seconds a request waits for a thumbnail being generated
+THUMB_CACHE_MAX_BYTES = 512 * 1024 * 1024    # the oldest thumbnails are evicted past this
+THUMB_MAX_AGE         = 365 * 24 * 3600      # pastes never change, so thumbnails are immutable
+FFMPEG                = shutil.which("ffmpeg")
+VIDEO_EXTENSIONS      = (".mp4", ".webm", ".mov", ".avi", ".mkv", ".flv", ".wmv")
+
+# Text file previews: a bounded head and tail, or a window of lines found through a sparse index
+PREVIEW_HEAD_BYTES   = 64 * 1024     # shown from the start of a text file
+PREVIEW_TAIL_BYTES   = 16 * 1024     # and from its end, where logs keep the news
+PREVIEW_MAX_LINES    = 1000          # lines per requested window
+PREVIEW_WINDOW_BYTES = 256 * 1024    # bytes per requested window; very long lines are cut
+LINE_INDEX_STRIDE    = 64 * 1024     # bytes between index checkpoints, i.e. the most scanned per seek
+LINE_INDEX_MIN       = 1024 * 1024   # smaller files are counted on the fly instead of indexed
+LINE_INDEX_WORKERS   = 1
+LINE_INDEX_WAIT      = 10            # seconds a line request waits for an index being built
+LINE_INDEX_CACHE     = 32            # indexes kept in memory per process
+TEXT_PREVIEW_EXTENSIONS = (
+    ".txt", ".md", ".log", ".conf", ".ini", ".cfg", ".json", ".xml", ".yaml", ".yml", ".csv",
+    ".js", ".py", ".html", ".css", ".java", ".cpp", ".c", ".php", ".rb", ".go", ".rs", ".swift",
+)
+
+# Deletes: rows go in one short transaction, files are unlinked afterwards by a pool
+DELETE_CHUNK   = 500  # ids per IN (...) statement
+UNLINK_WORKERS = 8
+
+# Retention: per-paste TTLs, a global maximum age and a storage quota, enforced by a sweeper
+RETENTION_INTERVAL    = 60     # seconds between sweeper passes
+RETENTION_BATCH       = 200    # pastes deleted per transaction
+MAX_AGE_DEFAULT       = os.environ.get("PASTEBIN_MAX_AGE", "0")     # seconds; 0 keeps pastes forever
+QUOTA_DEFAULT         = os.environ.get("PASTEBIN_QUOTA", "0")       # bytes of stored files; 0 is unlimited
+EVICTION_DEFAULT      = os.environ.get("PASTEBIN_EVICTION", "oldest")  # "oldest" or "lru"
+EVICTION_POLICIES     = ("oldest", "lru")
+ACCESS_TOUCH_INTERVAL = 3600   # seconds; a paste's accessed_at is written at most this often
+ACCESS_FLUSH_INTERVAL = 60     # seconds between batched accessed_at writes per process
+TTL_UNITS             = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+# Upload-folder migrations run in the background from a journal in the database
+MIGRATION_WORKERS = 4                 # parallel copies when moving across filesystems
+MIGRATION_BATCH   = 200               # journal rows claimed per round
+MIGRATION_CHUNK   = 4 * 1024 * 1024   # copy buffer
+
+# Directory browser for the settings dialog
+BROWSE_PAGE_SIZE     = 200    # directories returned per request
+BROWSE_CACHE_TTL     = 30     # seconds listings and per-directory details are reused
+BROWSE_CACHE_ENTRIES = 2048
+BROWSE_WORKERS       = 16     # concurrent permission / subdirectory probes
+BROWSE_DETAIL_BUDGET = 0.15   # seconds a listing waits for probes before answering
+BROWSE_PROBE_LIMIT   = 1000   # entries looked at before assuming a directory has subdirs
+
+# /file and /download: row + stat cache, and optional hand-off of the bytes to the proxy
+FILE_META_CACHE_SIZE = 4096
+FILE_MAX_AGE         = 3600
+SENDFILE_MODE        = os.environ.get("PASTEBIN_SENDFILE", "")  # "", "x-sendfile" or "x-accel-redirect"
+ACCEL_REDIRECT_PREFIX = os.environ.get("PASTEBIN_ACCEL_PREFIX", "/_protected_files/")
+
+# Optional read-through cache of served files on local disk, e.g. an SSD in front of the NAS
+CACHE_DIR            = os.environ.get("PASTEBIN_CACHE_DIR", "")   # empty leaves the tier off
+CACHE_MAX_BYTES      = int(os.environ.get("PASTEBIN_CACHE_SIZE", 10 * 1024 ** 3))
+CACHE_POLICY         = os.environ.get("PASTEBIN_CACHE_POLICY", "lru")  # "lru" or "lfu"
+CACHE_MAX_FILE_SHARE = 8      # files over 1/8 of the cache are served from the NAS, so one can't flush it
+CACHE_FILL_WORKERS   = 2
+CACHE_FILL_QUEUE     = 64     # fills waiting per process; further misses just read the NAS
+CACHE_FLUSH_INTERVAL = 10     # seconds between batched writes of hits to the cache index
+
+# Bulk downloads are streamed; these formats are already compressed and are stored as-is
+ZIP_STREAM_CHUNK  = 1024 * 1024
+ZIP_STORED_EXTENSIONS = {
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".avif", ".heic",
+    ".mp4", ".mkv", ".mov", ".webm", ".avi", ".mp3", ".m4a", ".ogg", ".flac", ".opus",
+    ".pdf", ".docx", ".xlsx", ".pptx", ".jar", ".apk", ".whl",
+}
 
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Background sweep for file pastes whose file vanished without a watcher event
+RECONCILE_INTERVAL = 30   # seconds between sweep batches
+RECONCILE_BATCH    = 200  # file rows stat'ed per batch
+
+# Watcher deletions are queued and written in batches
+WATCHER_FLUSH_INTERVAL = 0.2      # seconds a deletion waits for others to share its transaction
+WATCHER_BATCH          = 500      # deleted files per transaction; a full batch is written at once
+WATCHER_QUEUE_MAX      = 100000   # pending files; past this events are dropped and left to the reconciler
+
+# Files copied straight into the upload folder are registered as pastes (opt-in)
+INGEST_DEFAULT       = "true" if os.environ.get("PASTEBIN_INGEST") == "1" else "false"
+INGEST_POLL          = 2      # seconds between size checks of files being written
+INGEST_SETTLE        = 10     # seconds a file's size and mtime must hold still before it is registered
+INGEST_SCAN_INTERVAL = 60     # seconds between scans of the folder for files the watcher didn't report
+INGEST_BATCH         = 200    # files registered per transaction
+
+# Change feed pushed to open tabs over SSE / long-poll
+CHANGE_FEED_POLL      = 0.5    # seconds between tails of paste_changes per process
+CHANGE_FEED_BUFFER    = 1000   # recent changes kept in memory for catching up
+CHANGE_FEED_RETENTION = 10000  # rows kept in paste_changes
+CHANGE_STREAM_MAX_AGE = 300    # seconds before an SSE stream closes and the browser reconnects
+
+# Response compression and HTTP caching
+COMPRESS_MIN_SIZE  = 1024             # bytes; smaller bodies aren't worth the CPU
+COMPRESS_LEVEL     = 6                # gzip level for dynamic responses; static assets get 9, once
+BROTLI_QUALITY     = 5                # likewise; static assets get 11
+COMPRESS_MIMETYPES = {
+    "text/html", "text/plain", "text/css", "text/javascript", "application/javascript",
+    "application/json", "image/svg+xml",
+}
+STATIC_MAX_AGE     = 365 * 24 * 3600  # static URLs carry a content hash, so they never change
+
+# Startup: schema setup and the background services (watcher, sweeps) run once
+# per host. Workers elect a leader with a lock file; PASTEBIN_SERVICES=off leaves
+# them to a separate `flask --app app run-services` process.
+SERVICES_MODE      = os.environ.get("PASTEBIN_SERVICES", "auto")
+INIT_LOCK_PATH     = DB_PATH + ".init.lock"
+SERVICES_LOCK_PATH = DB_PATH + ".services.lock"
+LEADER_RETRY       = 10    # seconds between attempts to take over the services
+STARTUP_BUDGET     = 1.0   # seconds from import to first request served; slower is logged
+
+# Metrics served at /metrics in the Prometheus text format, per worker process
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# With PASTEBIN_PROFILE=1 a request carrying ?_profile=1 is sampled and its
+# folded stacks written to PROFILE_DIR (flamegraph.pl / speedscope input)
+PROFILE_ENABLED  = os.environ.get("PASTEBIN_PROFILE") == "1"
+PROFILE_DIR      = os.environ.get("PASTEBIN_PROFILE_DIR", tempfile.gettempdir())
+PROFILE_INTERVAL = 0.005  # seconds between stack samples
+
+# Markers FTS5 wraps around matched terms in snippets; swapped for <mark> after escaping
+SNIPPET_OPEN  = "\x02"
+SNIPPET_CLOSE = "\x03"
 
 app = Flask(__name__)
 app.config.update(
@@ -32,49 +224,547 @@ app.config.update(
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Global file system watcher
+# ---------- Metrics ----------
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+class Counter:
+    """Monotonic counter, optionally split by labels"""
+    
+    kind = "counter"
+    
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+            
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}_total{_format_labels(self.labels, key)} {value}"
+
+class Histogram:
+    """Cumulative-bucket histogram of durations (or any value), optionally split by labels"""
+    
+    kind = "histogram"
+    
+    def __init__(self, name, help, labels=(), buckets=METRICS_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [per-bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+        
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            state[index] += 1
+            state[-1] += value
+            
+    def time(self, **labels):
+        return _Timer(self, labels)
+        
+    def samples(self):
+        with self._lock:
+            values = [(key, list(state)) for key, state in self._values.items()]
+        for key, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), state):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(self.labels, key, [('le', bound)])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, key)} {state[-1]}"
+            yield f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}"
+
+class _Timer:
+    """Context manager that observes the elapsed time of its block"""
+    
+    __slots__ = ("histogram", "labels", "started")
+    
+    def __init__(self, histogram, labels):
+        self.histogram, self.labels = histogram, labels
+        
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+        
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+class Gauge:
+    """Value read from a callback at scrape time"""
+    
+    kind = "gauge"
+    
+    def __init__(self, name, help, read):
+        self.name, self.help, self.read = name, help, read
+        
+    def samples(self):
+        try:
+            yield f"{self.name} {self.read()}"
+        except Exception as e:
+            logger.warning(f"Metric {self.name} unavailable: {e}")
+
+class MetricsRegistry:
+    """Holds the metrics of this process and renders them for /metrics"""
+    
+    def __init__(self):
+        self._metrics = []
+        
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+        
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+REQUEST_SECONDS = metrics.register(Histogram(
+    "pastebin_request_duration_seconds", "Time until the response is returned, by endpoint", ("endpoint", "method")
+))
+REQUESTS = metrics.register(Counter(
+    "pastebin_requests", "Requests by endpoint and status", ("endpoint", "method", "status")
+))
+DB_QUERY_SECONDS = metrics.register(Histogram(
+    "pastebin_db_query_duration_seconds", "SQLite statement time to first row, by calling function", ("site",)
+))
+STORAGE_SECONDS = metrics.register(Histogram(
+    "pastebin_storage_op_duration_seconds", "Upload-folder I/O: save, rename, stat, unlink and send", ("op",)
+))
+STORAGE_BYTES = metrics.register(Counter(
+    "pastebin_storage_bytes", "Bytes written to (save) and sent from (bulk_download) the upload folder", ("op",)
+))
+WATCHER_EVENTS = metrics.register(Counter(
+    "pastebin_watcher_events", "File system events seen by the watcher; \"dropped\" when its queue was full", ("event",)
+))
+WATCHER_QUEUE_DEPTH = metrics.register(Gauge(
+    "pastebin_watcher_queue_depth", "Deleted files waiting to be written",
+    lambda: len(file_watcher.queue) if file_watcher else 0
+))
+WATCHER_LAG_SECONDS = metrics.register(Histogram(
+    "pastebin_watcher_lag_seconds", "From the directory change to the database being updated"
+))
+RECONCILE_SECONDS = metrics.register(Histogram(
+    "pastebin_reconcile_batch_duration_seconds", "Missing-file sweep batch duration"
+))
+RECONCILE_REMOVED = metrics.register(Counter(
+    "pastebin_reconcile_removed", "Pastes dropped by the missing-file sweep"
+))
+BULK_DOWNLOAD_SECONDS = metrics.register(Histogram(
+    "pastebin_bulk_download_duration_seconds", "Time to stream a bulk-download archive"
+))
+FILE_CACHE_REQUESTS = metrics.register(Counter(
+    "pastebin_file_cache_requests", "Local file cache lookups: hit, miss or bypass (too big)", ("result",)
+))
+FILE_CACHE_EVICTIONS = metrics.register(Counter(
+    "pastebin_file_cache_evictions", "Files evicted from the local file cache"
+))
+
+def timed_storage(op):
+    """Time a block of upload-folder I/O, e.g. `with timed_storage("stat"):`"""
+    return STORAGE_SECONDS.time(op=op)
+
+def query_site(code):
+    """Name to file a query under; co_qualname (Class.method) is Python 3.11+"""
+    return getattr(code, "co_qualname", code.co_name)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection that times every statement under the name of the function issuing it.
+
+    Only execute() is timed, i.e. up to the first row; for the listing and
+    count queries that is where SQLite does the work.
+    """
+    
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, site=query_site(sys._getframe(1).f_code))
+            
+    def executemany(self, sql, parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, site=query_site(sys._getframe(1).f_code))
+
+class StackSampler:
+    """Samples one thread's stack every PROFILE_INTERVAL and counts folded stacks.
+
+    A sampling profiler has a fixed, small cost per sample no matter how many
+    calls the request makes, unlike cProfile.
+    """
+    
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        
+    def start(self):
+        self._thread.start()
+        return self
+        
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+        return self.stacks
+        
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                folded = ";".join(reversed(stack))
+                self.stacks[folded] = self.stacks.get(folded, 0) + 1
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    if PROFILE_ENABLED and request.args.get("_profile") == "1":
+        g.stack_sampler = StackSampler(threading.get_ident()).start()
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or "unmatched"
+    REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, endpoint=endpoint, method=request.method)
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    sampler = g.pop("stack_sampler", None)
+    if sampler:
+        stacks = sampler.stop()
+        path = os.path.join(PROFILE_DIR, f"pastebin-{endpoint}-{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}.folded")
+        with open(path, "w") as out:
+            out.writelines(f"{stack} {count}\n" for stack, count in stacks.items())
+        response.headers["X-Profile-File"] = path
+        logger.info(f"Profiled {request.path}: {sum(stacks.values())} samples in {path}")
+    return response
+
+# ---------- HTTP Caching & Compression ----------
+def compress(data, encoding, static=False):
+    """`data` encoded as "br" or "gzip"; static assets get the slow, maximum setting"""
+    if encoding == "br":
+        return brotli.compress(data, quality=11 if static else BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=9 if static else COMPRESS_LEVEL, mtime=0)
+
+def accepted_encoding():
+    """Best encoding the client accepts, or None"""
+    return request.accept_encodings.best_match(["br", "gzip"] if brotli else ["gzip"])
+
+@app.after_request
+def compress_response(response):
+    """gzip/brotli buffered text responses; streams and file downloads are left alone"""
+    if (
+        response.mimetype not in COMPRESS_MIMETYPES
+        or response.direct_passthrough
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+        or (response.content_length or 0) < COMPRESS_MIN_SIZE
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = accepted_encoding()
+    if response.status_code != 200 or encoding is None:
+        return response
+    response.set_data(compress(response.get_data(), encoding))
+    response.headers["Content-Encoding"] = encoding
+    # The bytes differ from the identity encoding, so a strong validator can't be shared
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+class StaticAssets:
+    """Content hashes for static URLs, and each asset compressed once per process.
+
+    url_for("static", ...) gets a `v=<hash>` argument; a request carrying the
+    current hash is cached by browsers for good, so a refresh costs nothing and
+    a deploy changes the URL.
+    """
+    
+    def __init__(self, folder):
+        self.folder = folder
+        self._versions = {}    # filename -> (mtime_ns, size, hash)
+        self._compressed = {}  # (filename, encoding) -> (mtime_ns, bytes)
+        self._lock = threading.Lock()
+        
+    def version(self, filename):
+        """Short content hash of a static file, or None if it doesn't exist"""
+        path = safe_join(self.folder, filename)
+        if path is None or not os.path.isfile(path):
+            return None
+        st = os.stat(path)
+        cached = self._versions.get(filename)
+        if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return cached[2]
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:12]
+        with self._lock:
+            self._versions[filename] = (st.st_mtime_ns, st.st_size, digest)
+        return digest
+    
+    def compressed(self, filename, encoding):
+        """The file's bytes in `encoding`, compressed on first use; call version() first"""
+        path = safe_join(self.folder, filename)
+        mtime_ns = os.stat(path).st_mtime_ns
+        cached = self._compressed.get((filename, encoding))
+        if cached and cached[0] == mtime_ns:
+            return cached[1]
+        with open(path, "rb") as f:
+            data = compress(f.read(), encoding, static=True)
+        with self._lock:
+            self._compressed[(filename, encoding)] = (mtime_ns, data)
+        return data
+
+static_assets = StaticAssets(app.static_folder)
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+    if endpoint == "static" and "v" not in values:
+        values["v"] = static_assets.version(values.get("filename", ""))
+
+def serve_static(filename):
+    """Static files: immutable under their current hash, precompressed when the client accepts it"""
+    version = static_assets.version(filename)
+    if version is None or os.path.basename(filename).startswith("."):
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    encoding = accepted_encoding() if mimetype in COMPRESS_MIMETYPES else None
+    if encoding:
+        response = Response(static_assets.compressed(filename, encoding), mimetype=mimetype)
+        response.headers["Content-Encoding"] = encoding
+        response.set_etag(f"{version}-{encoding}")
+    else:
+        response = send_from_directory(app.static_folder, filename, etag=False, conditional=False)
+        response.set_etag(version)
+    if mimetype in COMPRESS_MIMETYPES:
+        response.vary.add("Accept-Encoding")
+    if request.args.get("v") == version:
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        # An old or missing hash, e.g. a page rendered before a deploy: revalidate
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+app.view_functions["static"] = serve_static
+
+_render_version = None
+
+def render_version():
+    """Hash of the code and templates, so a deploy invalidates cached pages"""
+    global _render_version
+    if _render_version is None:
+        digest = hashlib.sha256()
+        template_folder = os.path.join(app.root_path, app.template_folder)
+        for path in [os.path.abspath(__file__)] + sorted(
+            os.path.join(template_folder, name) for name in os.listdir(template_folder)
+        ):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        _render_version = digest.hexdigest()[:12]
+    return _render_version
+
+def listing_validators(db):
+    """(ETag, Last-Modified) of the listing: every insert and delete adds a paste_changes row"""
+    row = db.execute("SELECT id, created_at FROM paste_changes ORDER BY id DESC LIMIT 1").fetchone()
+    cursor, changed_at = (row["id"], row["created_at"]) if row else (0, None)
+    etag = f"list-{cursor}-{render_version()}-{int(fts_enabled)}"
+    last_modified = datetime.strptime(changed_at, "%Y-%m-%d %H:%M:%S") if changed_at else None
+    return cursor, etag, last_modified
+
+# Global file system watcher, missing-file reconciler and ingester
 file_watcher = None
+reconciler = None
+ingester = None
+retention_sweeper = None
 
 # ---------- FILE SYSTEM MONITORING ----------
 class PasteFileHandler(FileSystemEventHandler):
     """Handle file system events for paste files"""
     
-    def __init__(self):
+    def __init__(self, queue):
         super().__init__()
-        self.db_path = DB_PATH
+        self.queue = queue
         
     def on_deleted(self, event):
-        """Handle file deletion events"""
+        """Queue the deleted file; its rows are dropped with the next batch"""
         if event.is_directory:
             return
             
         deleted_file = os.path.basename(event.src_path)
-        logger.info(f"File deleted from storage: {deleted_file}")
+        if deleted_file.startswith(UPLOAD_TEMP_PREFIX):
+            return  # In-progress upload moved into place or discarded
+        WATCHER_EVENTS.inc(event="deleted")
+        logger.debug(f"File deleted from storage: {deleted_file}")
+        self.queue.put(deleted_file, os.path.dirname(event.src_path))
         
-        # Remove corresponding database entry
-        self._cleanup_database_entry(deleted_file)
+    def on_created(self, event):
+        """Hand files copied into the folder to the ingester"""
+        if not event.is_directory and ingester:
+            ingester.note(event.src_path)
+            
+    def on_modified(self, event):
+        if not event.is_directory and ingester:
+            ingester.note(event.src_path)
+            
+    def on_moved(self, event):
+        """A rename into the folder, e.g. by rsync or a copy tool finishing its temp file"""
+        if not event.is_directory and ingester:
+            ingester.note(event.dest_path)
+
+class DeletionQueue:
+    """Coalesces watcher deletions and drops their rows in batched transactions.
+
+    An `rm` of thousands of files would otherwise be one write transaction per
+    file, each contending with uploads for the lock. Names are de-duplicated
+    while they wait; a batch is written once WATCHER_BATCH names are pending or
+    the oldest has waited WATCHER_FLUSH_INTERVAL. Past WATCHER_QUEUE_MAX pending
+    names further events are dropped and the missing-file reconciler is asked
+    for a full pass instead, so a storm costs accuracy for a while, not memory.
+    """
     
-    def _cleanup_database_entry(self, filename):
-        """Remove database entry for deleted file"""
-        try:
-            with sqlite3.connect(self.db_path) as db:
-                # Find and delete the paste entry
-                cursor = db.execute(
-                    "SELECT id, original_filename FROM pastes WHERE stored_filename = ? AND is_file = 1",
-                    (filename,)
-                )
-                row = cursor.fetchone()
+    def __init__(self, interval=WATCHER_FLUSH_INTERVAL, batch_size=WATCHER_BATCH, max_pending=WATCHER_QUEUE_MAX):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._pending = OrderedDict()  # stored name -> directory it was deleted from
+        self._oldest = 0.0
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+        
+    def __len__(self):
+        return len(self._pending)
+        
+    def put(self, stored_filename, directory):
+        """Queue a deleted file; never blocks the observer thread"""
+        with self._cond:
+            if stored_filename in self._pending:
+                return
+            if len(self._pending) >= self.max_pending:
+                WATCHER_EVENTS.inc(event="dropped")
+                if reconciler:
+                    reconciler.expedite()
+                return
+            if not self._pending:
+                self._oldest = time.monotonic()
+            self._pending[stored_filename] = directory
+            if len(self._pending) >= self.batch_size or len(self._pending) == 1:
+                self._cond.notify()
+        
+    def start(self):
+        """Start the flush thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="watcher-flush", daemon=True)
+        self._thread.start()
+        
+    def stop(self):
+        """Write what is pending and stop the flush thread"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout=10)
+        self._thread = None
+        
+    def _next_batch(self):
+        """Wait for a full batch or the flush interval; None once stopped and drained"""
+        with self._cond:
+            while not self._pending and not self._stopping:
+                self._cond.wait()
+            while len(self._pending) < self.batch_size and not self._stopping:
+                remaining = self._oldest + self.interval - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if not self._pending:
+                return None
+            batch = [self._pending.popitem(last=False) for _ in range(min(self.batch_size, len(self._pending)))]
+            self._oldest = time.monotonic()
+            return batch
+        
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self.flush(batch)
+            except Exception as e:
+                logger.error(f"Error applying {len(batch)} watcher deletions: {e}")
                 
-                if row:
-                    paste_id, original_filename = row
-                    db.execute("DELETE FROM pastes WHERE id = ?", (paste_id,))
-                    db.commit()
-                    logger.info(f"Deleted database entry for paste {paste_id} (file: {original_filename})")
-                else:
-                    logger.warning(f"No database entry found for deleted file: {filename}")
-                    
-        except Exception as e:
-            logger.error(f"Error cleaning up database entry for {filename}: {e}")
+    def flush(self, batch):
+        """Drop the rows of a batch of (stored name, directory) in one write transaction"""
+        names = [name for name, _ in batch]
+        placeholders = ",".join("?" * len(names))
+        with get_db() as db:
+            rows = db.execute(
+                "SELECT id, stored_filename, original_filename FROM pastes"
+                f" WHERE stored_filename IN ({placeholders}) AND is_file = 1",
+                names
+            ).fetchall()
+            # A file moved into a shard the watcher wasn't watching yet looks deleted;
+            # stat outside the write lock so the NAS never holds it up
+            present = {name for name in {row["stored_filename"] for row in rows} if stored_file_exists(db, name)}
+            rows = [row for row in rows if row["stored_filename"] not in present]
+            if rows:
+                # Under the write lock an upload can't be re-creating these blobs; only
+                # deduplicated names are ever stored again, so only those are rechecked
+                acquire_write_lock(db)
+                restored = {
+                    name for name in {row["stored_filename"] for row in rows}
+                    if name.startswith(CAS_PREFIX) and stored_file_exists(db, name)
+                }
+                rows = [row for row in rows if row["stored_filename"] not in restored]
+            ids = [row["id"] for row in rows]
+            if ids:
+                db.execute(f"DELETE FROM pastes WHERE id IN ({','.join('?' * len(ids))})", ids)
+                bump_deletion_generation(db, len(ids))
+                db.commit()
+                file_meta_cache.invalidate(ids)
+                file_cache.discard({row["stored_filename"] for row in rows})
+                change_feed.notify()
+                for row in rows:
+                    logger.debug(f"Deleted database entry for paste {row['id']} (file: {row['original_filename']})")
+        
+        unknown = len(set(names) - {row["stored_filename"] for row in rows})
+        logger.info(
+            f"Watcher removed {len(ids)} pastes for {len(names)} deleted files"
+            + (f"; {unknown} had no entry or still exist" if unknown else "")
+        )
+        # The deletions bumped their directories' mtimes; good enough to see a backlog
+        now = time.time()
+        for directory in {directory for _, directory in batch}:
+            try:
+                WATCHER_LAG_SECONDS.observe(max(0.0, now - os.stat(directory).st_mtime))
+            except OSError:
+                pass
 
 class FileSystemWatcher:
     """Manages file system monitoring"""
@@ -82,7 +772,8 @@ class FileSystemWatcher:
     def __init__(self, watch_path):
         self.watch_path = watch_path
         self.observer = None
-        self.event_handler = PasteFileHandler()
+        self.queue = DeletionQueue()
+        self.event_handler = PasteFileHandler(self.queue)
         self._running = False
         
     def start(self):
@@ -94,8 +785,10 @@ class FileSystemWatcher:
             # Ensure watch path exists
             os.makedirs(self.watch_path, exist_ok=True)
             
+            self.queue.start()
             self.observer = Observer()
-            self.observer.schedule(self.event_handler, self.watch_path, recursive=False)
+            # Files live in shard subdirectories
+            self.observer.schedule(self.event_handler, self.watch_path, recursive=True)
             self.observer.start()
             self._running = True
             logger.info(f"File system watcher started for: {self.watch_path}")
@@ -111,6 +804,7 @@ class FileSystemWatcher:
         try:
             self.observer.stop()
             self.observer.join(timeout=5)
+            self.queue.stop()
             self._running = False
             logger.info("File system watcher stopped")
             
@@ -132,7 +826,6 @@ def init_file_watcher():
 
 def cleanup_orphaned_entries():
     """Clean up database entries for files that no longer exist"""
-    current_path = get_current_upload_folder()
     cleanup_count = 0
     
     try:
@@ -142,18 +835,24 @@ def cleanup_orphaned_entries():
                 "SELECT id, stored_filename, original_filename FROM pastes WHERE is_file = 1"
             ).fetchall()
             
+            # Deduplicated pastes share a blob; stat each one once
+            exists = {}
             for entry in file_entries:
                 paste_id, stored_filename, original_filename = entry
-                file_path = os.path.join(current_path, stored_filename)
+                if stored_filename not in exists:
+                    exists[stored_filename] = stored_file_exists(db, stored_filename)
                 
-                if not os.path.exists(file_path):
+                if not exists[stored_filename]:
                     # File doesn't exist, remove database entry
                     db.execute("DELETE FROM pastes WHERE id = ?", (paste_id,))
                     cleanup_count += 1
                     logger.info(f"Cleaned up orphaned entry: {paste_id} ({original_filename})")
             
             if cleanup_count > 0:
+                bump_deletion_generation(db, cleanup_count)
                 db.commit()
+                file_meta_cache.clear()
+                file_cache.discard(name for name, present in exists.items() if not present)
                 logger.info(f"Cleaned up {cleanup_count} orphaned database entries")
                 
     except Exception as e:
@@ -161,14 +860,480 @@ def cleanup_orphaned_entries():
         
     return cleanup_count
 
+class MissingFileReconciler:
+    """Slow background sweep that checks file pastes in small batches.
+
+    The watcher is the main source of truth for deletions; the sweep only
+    catches what it missed (files removed while the app was down, dropped
+    events on network mounts). Each batch stats at most RECONCILE_BATCH files.
+    """
+    
+    def __init__(self, interval=RECONCILE_INTERVAL, batch_size=RECONCILE_BATCH):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._last_id = 0
+        self._stop_event = threading.Event()
+        self._hurry = threading.Event()
+        # Guards _hurry transitions and the flags below, which the observer sets through expedite()
+        self._hurry_lock = threading.Lock()
+        self._restart = False
+        self._another_pass = False
+        self._wakeup = threading.Event()
+        self._thread = None
+        
+    def expedite(self):
+        """Run full passes back to back until one starts after the last call, e.g. after the watcher dropped events"""
+        with self._hurry_lock:
+            if self._hurry.is_set():
+                self._another_pass = True
+                return
+            self._restart = True
+            self._another_pass = False
+            self._hurry.set()
+        logger.warning("Watcher events were dropped; checking every file paste now")
+        self._wakeup.set()
+        
+    def start(self):
+        """Start the background sweep thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="missing-file-reconciler", daemon=True)
+        self._thread.start()
+        logger.info(f"Missing-file reconciler started (batch {self.batch_size} every {self.interval}s)")
+        
+    def stop(self):
+        """Stop the background sweep thread"""
+        if not self._thread:
+            return
+        self._stop_event.set()
+        self._wakeup.set()
+        self._thread.join(timeout=5)
+        self._thread = None
+        
+    def _run(self):
+        while True:
+            if not self._hurry.is_set():
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
+            if self._stop_event.is_set():
+                return
+            try:
+                drain_pending_unlinks(self.batch_size)
+                self.sweep_batch()
+            except Exception as e:
+                logger.error(f"Error during missing-file sweep: {e}")
+                
+    def sweep_batch(self):
+        """Check the next batch of file pastes; returns the number removed"""
+        with RECONCILE_SECONDS.time():
+            removed = self._sweep_batch()
+        RECONCILE_REMOVED.inc(removed)
+        return removed
+        
+    def _sweep_batch(self):
+        with get_db() as db:
+            rows = db.execute(
+                "SELECT id, stored_filename, original_filename FROM pastes"
+                " WHERE is_file = 1 AND id > ? ORDER BY id LIMIT ?",
+                (self._last_id, self.batch_size)
+            ).fetchall()
+        
+        with self._hurry_lock:
+            if self._restart:
+                # expedite() came in during this batch: the next pass starts from the top
+                self._restart = False
+                self._last_id = 0
+            else:
+                # Wrap around once the end of the table is reached
+                self._last_id = rows[-1]["id"] if len(rows) == self.batch_size else 0
+                if not self._last_id:
+                    if self._another_pass:
+                        self._another_pass = False
+                    else:
+                        self._hurry.clear()
+        
+        # Stat outside of any transaction so the NAS never holds the write lock
+        exists = {
+            name: os.path.exists(resolve_stored_path(name))
+            for name in {row["stored_filename"] for row in rows}
+        }
+        missing = [row for row in rows if not exists[row["stored_filename"]]]
+        if not missing:
+            return 0
+        
+        with get_db() as db:
+            # A deduplicated blob may have been stored again meanwhile; recheck the few missing
+            acquire_write_lock(db)
+            missing = [row for row in missing if not stored_file_exists(db, row["stored_filename"])]
+            removed = db.executemany(
+                "DELETE FROM pastes WHERE id = ?", [(row["id"],) for row in missing]
+            ).rowcount
+            bump_deletion_generation(db, removed)
+        file_meta_cache.invalidate(row["id"] for row in missing)
+        file_cache.discard({row["stored_filename"] for row in missing})
+        change_feed.notify()
+        
+        for row in missing:
+            logger.info(f"Reconciled missing file: {row['id']} ({row['original_filename']})")
+        return removed
+
+def init_reconciler():
+    """Initialize the background missing-file sweep"""
+    global reconciler
+    reconciler = MissingFileReconciler()
+    reconciler.start()
+
+class UploadFolderIngester:
+    """Registers files copied straight into the upload folder as pastes.
+
+    Build systems can write large artifacts onto the share at full NAS speed
+    instead of uploading them through a worker. Only files at the top of the
+    folder are considered, never the shard directories the app manages, and
+    hidden files are skipped so in-flight temp files are left alone. The
+    watcher reports new files; a scan on start and every INGEST_SCAN_INTERVAL
+    catches the rest (network mounts often report nothing). A file is
+    registered once its size and mtime have held still for INGEST_SETTLE
+    seconds: it is moved into its shard under a new stored name and inserted
+    in batches of INGEST_BATCH.
+    """
+    
+    def __init__(self, poll=INGEST_POLL, settle=INGEST_SETTLE, scan_interval=INGEST_SCAN_INTERVAL):
+        self.poll = poll
+        self.settle = settle
+        self.scan_interval = scan_interval
+        self._candidates = {}  # name -> (size, mtime_ns, monotonic time that signature was first seen)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        
+    def start(self):
+        """Start the background ingest thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="upload-folder-ingester", daemon=True)
+        self._thread.start()
+        
+    def stop(self):
+        """Stop the background ingest thread"""
+        if not self._thread:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout=5)
+        self._thread = None
+        
+    def note(self, path):
+        """Start (or restart) the settle timer of a file the watcher saw change"""
+        name = os.path.basename(path)
+        if name.startswith(".") or not is_ingest_enabled():
+            return
+        if os.path.normpath(os.path.dirname(path)) != os.path.normpath(get_current_upload_folder()):
+            return  # Inside a shard: the app's own files
+        with self._lock:
+            self._candidates[name] = (None, None, time.monotonic())
+            
+    def _run(self):
+        next_scan = 0
+        while True:
+            try:
+                if is_ingest_enabled():
+                    if time.monotonic() >= next_scan:
+                        self.scan()
+                        next_scan = time.monotonic() + self.scan_interval
+                    self.register_settled()
+            except Exception as e:
+                logger.error(f"Error ingesting files from the upload folder: {e}")
+            if self._stop_event.wait(self.poll):
+                return
+                
+    def scan(self):
+        """Queue every untracked file at the top of the folder; one scandir and indexed lookups"""
+        folder = get_current_upload_folder()
+        try:
+            with os.scandir(folder) as entries:
+                names = [
+                    entry.name for entry in entries
+                    if not entry.name.startswith(".") and entry.is_file(follow_symlinks=False)
+                ]
+        except FileNotFoundError:
+            return 0
+        with get_db() as db:
+            untracked = untracked_names(db, names)
+        now = time.monotonic()
+        with self._lock:
+            added = [name for name in untracked if name not in self._candidates]
+            for name in added:
+                self._candidates[name] = (None, None, now)
+        if added:
+            logger.info(f"Found {len(added)} untracked files in {folder}")
+        return len(added)
+        
+    def register_settled(self):
+        """Register the files that stopped changing; returns the new paste ids"""
+        folder = get_current_upload_folder()
+        now = time.monotonic()
+        settled = []
+        with self._lock:
+            candidates = list(self._candidates.items())
+        for name, (size, mtime_ns, since) in candidates:
+            try:
+                st = os.stat(os.path.join(folder, name))
+            except OSError:
+                with self._lock:
+                    self._candidates.pop(name, None)
+                continue
+            if (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+                with self._lock:
+                    self._candidates[name] = (st.st_size, st.st_mtime_ns, now)
+            elif now - since >= self.settle:
+                settled.append((name, st.st_size))
+        
+        paste_ids = []
+        for start in range(0, len(settled), INGEST_BATCH):
+            paste_ids.extend(self._register(folder, settled[start:start + INGEST_BATCH]))
+        return paste_ids
+        
+    def _register(self, folder, batch):
+        new_files = []
+        with get_db() as db:
+            untracked = set(untracked_names(db, [name for name, _ in batch]))
+            # Rename on the NAS first so other writers only wait for the inserts;
+            # nothing else moves untracked top-level files, so no lock is needed
+            for name, size in batch:
+                if name not in untracked:
+                    continue
+                original = secure_filename(name) or "file"
+                try:
+                    stored = store_upload(db, os.path.join(folder, name), original)
+                except OSError as e:
+                    logger.error(f"Could not ingest {name}: {e}")
+                    continue
+                new_files.append({
+                    "stored_filename": stored, "original_filename": original,
+                    "content_hash": None, "size": size,
+                })
+        if new_files:
+            with get_db() as db:
+                for row in new_files:
+                    row["id"] = insert_file_paste(
+                        db, None, row["stored_filename"], row["original_filename"], row.pop("size"), None
+                    )
+        with self._lock:
+            for name, _ in batch:
+                self._candidates.pop(name, None)
+        if new_files:
+            change_feed.notify()
+            for row in new_files:
+                thumbnails.schedule(row)
+                line_indexes.schedule(row)
+            logger.info(f"Ingested {len(new_files)} files from {folder}")
+        return [row["id"] for row in new_files]
+
+def untracked_names(db, names):
+    """The names that are neither a stored file nor queued for unlinking"""
+    names = list(names)
+    tracked = set()
+    for start in range(0, len(names), DELETE_CHUNK):
+        chunk = names[start:start + DELETE_CHUNK]
+        placeholders = ",".join("?" * len(chunk))
+        tracked.update(row[0] for row in db.execute(
+            f"SELECT stored_filename FROM pastes WHERE stored_filename IN ({placeholders})"
+            f" UNION SELECT stored_filename FROM pending_unlinks WHERE stored_filename IN ({placeholders})",
+            chunk + chunk
+        ))
+    return [name for name in names if name not in tracked]
+
+def init_ingester():
+    """Initialize the upload-folder ingester; idle while ingest is turned off"""
+    global ingester
+    ingester = UploadFolderIngester()
+    ingester.start()
+
+def bump_deletion_generation(db, count=1):
+    """Advance the deletion generation by the number of rows reconciled away"""
+    if count > 0:
+        db.execute(
+            "UPDATE counters SET value = value + ? WHERE name = 'deletion_generation'", (count,)
+        )
+
+def acquire_write_lock(db):
+    """Take SQLite's write lock now instead of at the transaction's first write.
+
+    Used where a filesystem check has to be atomic with the rows that depend on
+    it: reusing a deduplicated blob versus unlinking its last reference.
+    """
+    if not db.in_transaction:
+        db.execute("BEGIN IMMEDIATE")
+
+def get_deletion_generation():
+    """Current deletion generation; a single primary-key lookup"""
+    with get_db() as db:
+        row = db.execute("SELECT value FROM counters WHERE name = 'deletion_generation'").fetchone()
+        return row["value"] if row else 0
+
+# ---------- CHANGE FEED ----------
+class ChangeFeed:
+    """Fans rows of the paste_changes table out to connected clients.
+
+    Triggers on the pastes table record every insert and delete, whatever code
+    path caused it. One poller thread per process tails that table, so the cost
+    does not grow with the number of open tabs; local writers call notify() to
+    wake it immediately instead of waiting for the next poll.
+    """
+    
+    def __init__(self, poll_interval=CHANGE_FEED_POLL, buffer_size=CHANGE_FEED_BUFFER):
+        self.poll_interval = poll_interval
+        self._recent = deque(maxlen=buffer_size)
+        self._cursor = 0
+        self._cond = threading.Condition()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._listeners = []
+        
+    def subscribe(self, callback):
+        """Call `callback(changes)` with every batch of (id, paste_id, op) this process sees"""
+        self._listeners.append(callback)
+        self.ensure_started()
+        
+    def ensure_started(self):
+        """Start the poller on first use"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._cursor = get_change_cursor()
+            self._thread = threading.Thread(target=self._run, name="change-feed", daemon=True)
+            self._thread.start()
+            
+    @property
+    def cursor(self):
+        """Id of the newest change this process has seen"""
+        return self._cursor
+        
+    def notify(self):
+        """Wake the poller after a local write"""
+        self._wakeup.set()
+        
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                self._poll()
+            except Exception as e:
+                logger.error(f"Error polling change feed: {e}")
+                
+    def _poll(self):
+        with get_db() as db:
+            rows = db.execute(
+                "SELECT id, paste_id, op FROM paste_changes WHERE id > ? ORDER BY id LIMIT ?",
+                (self._cursor, self._recent.maxlen)
+            ).fetchall()
+        if not rows:
+            return
+        changes = [(row["id"], row["paste_id"], row["op"]) for row in rows]
+        with self._cond:
+            self._recent.extend(changes)
+            self._cursor = rows[-1]["id"]
+            self._cond.notify_all()
+        for callback in self._listeners:
+            callback(changes)
+            
+    def changes_since(self, since, timeout):
+        """Wait up to `timeout` seconds for changes after cursor `since`.
+
+        Returns (changes, cursor, reset). `reset` is True when the client is too
+        far behind to be caught up incrementally and should reload its list.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._cursor > since, timeout)
+            cursor = self._cursor
+            if since >= cursor:
+                return [], cursor, False
+            if not self._recent or self._recent[0][0] > since + 1:
+                return [], cursor, True
+            changes = [
+                {"id": change_id, "paste_id": paste_id, "op": op}
+                for change_id, paste_id, op in self._recent if change_id > since
+            ]
+            return changes, cursor, False
+
+change_feed = ChangeFeed()
+
+def get_change_cursor():
+    """Id of the newest recorded paste change"""
+    with get_db() as db:
+        return db.execute("SELECT COALESCE(MAX(id), 0) FROM paste_changes").fetchone()[0]
+
 # ---------- DB ----------
+_db_local = threading.local()
+
+class PooledConnection(InstrumentedConnection):
+    """Per-thread connection whose `with` blocks nest.
+
+    get_db() hands every caller on a thread the same connection, so a helper
+    opening its own `with get_db()` inside a caller's transaction must not
+    commit it (and drop a BEGIN IMMEDIATE taken by acquire_write_lock). Only
+    the outermost block commits or rolls back; an inner block that raises is
+    undone back to a savepoint so a caller catching the error keeps its own
+    work intact.
+    """
+    
+    def __enter__(self):
+        depth = self.__dict__.get("_depth", 0)
+        self._depth = depth + 1
+        savepoint = None
+        if depth and self.in_transaction:
+            savepoint = f"nested_{depth}"
+            self.execute(f"SAVEPOINT {savepoint}")
+        self.__dict__.setdefault("_savepoints", []).append(savepoint)
+        return self
+        
+    def __exit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        savepoint = self._savepoints.pop()
+        if self._depth == 0:
+            return super().__exit__(exc_type, exc, tb)
+        if savepoint is not None:
+            if exc_type is not None:
+                self.execute(f"ROLLBACK TO {savepoint}")
+            self.execute(f"RELEASE {savepoint}")
+        elif exc_type is not None and self.in_transaction:
+            # The transaction began inside this block, so it holds nothing of the caller's
+            self.rollback()
+        return False
+
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    """Return this thread's pooled connection, opening it on first use.
+
+    The connection lives as long as the thread (and is reopened after a fork),
+    so `with get_db() as db:` keeps its commit/rollback semantics without
+    paying for a new connect and PRAGMA setup on every call. Nested blocks
+    share the outermost one's transaction (see PooledConnection).
+    """
+    conn = getattr(_db_local, "conn", None)
+    if conn is None or _db_local.pid != os.getpid():
+        conn = sqlite3.connect(
+            DB_PATH, timeout=DB_BUSY_TIMEOUT, cached_statements=DB_STATEMENT_CACHE,
+            factory=PooledConnection,
+        )
+        conn.row_factory = sqlite3.Row
+        # Search reads the full text of compressed pastes through this
+        conn.create_function("inflate_text", 1, inflate_text, deterministic=True)
+        # journal_mode=WAL is persistent and set once in init_db()
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KIB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        _db_local.conn = conn
+        _db_local.pid = os.getpid()
     return conn
 
 def init_db():
     with get_db() as db:
+        # WAL lets readers proceed while an upload holds the write lock
+        db.execute("PRAGMA journal_mode=WAL")
         db.execute(
             """
             CREATE TABLE IF NOT EXISTS pastes (
@@ -191,119 +1356,2122 @@ def init_db():
             );
             """
         )
+        # Monotonic counters clients can poll cheaply
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            );
+            """
+        )
+        db.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('deletion_generation', 0)")
+        # Change log behind the change feed, written by triggers so every
+        # insert/delete path (routes, watcher, reconciler) is covered
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS paste_changes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                paste_id INTEGER NOT NULL,
+                op TEXT NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+        db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS pastes_change_insert AFTER INSERT ON pastes BEGIN
+                INSERT INTO paste_changes (paste_id, op) VALUES (new.id, 'insert');
+            END;
+            """
+        )
+        db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS pastes_change_delete AFTER DELETE ON pastes BEGIN
+                INSERT INTO paste_changes (paste_id, op) VALUES (old.id, 'delete');
+            END;
+            """
+        )
+        # Listing order index and a maintained row count, so neither deep pages
+        # nor the unfiltered total need a table scan
+        db.execute("CREATE INDEX IF NOT EXISTS idx_pastes_created_at ON pastes (created_at, id)")
+        if not db.execute("SELECT 1 FROM counters WHERE name = 'paste_count'").fetchone():
+            db.execute("INSERT INTO counters (name, value) SELECT 'paste_count', COUNT(*) FROM pastes")
+        db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS pastes_count_insert AFTER INSERT ON pastes BEGIN
+                UPDATE counters SET value = value + 1 WHERE name = 'paste_count';
+            END;
+            """
+        )
+        db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS pastes_count_delete AFTER DELETE ON pastes BEGIN
+                UPDATE counters SET value = value - 1 WHERE name = 'paste_count';
+            END;
+            """
+        )
+        db.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS paste_changes_prune AFTER INSERT ON paste_changes
+            WHEN new.id % 1000 = 0 BEGIN
+                DELETE FROM paste_changes WHERE id <= new.id - {CHANGE_FEED_RETENTION};
+            END;
+            """
+        )
         # Add file_size column if it doesn't exist (for existing databases)
         try:
             db.execute("ALTER TABLE pastes ADD COLUMN file_size INTEGER DEFAULT 0")
         except sqlite3.OperationalError:
             pass  # Column already exists
-        
-        # Initialize upload folder setting if it doesn't exist
-        current_path = db.execute("SELECT value FROM settings WHERE key=?", ("upload_folder",)).fetchone()
-        if not current_path:
-            db.execute("INSERT INTO settings (key, value) VALUES (?, ?)", ("upload_folder", UPLOAD_FOLDER))
-            db.commit()
-init_db()
-
-def format_file_size(size_bytes):
-    """Convert bytes to human readable format"""
-    if size_bytes == 0:
-        return "0 B"
-    size_names = ["B", "KB", "MB", "GB", "TB"]
-    i = 0
-    while size_bytes >= 1024 and i < len(size_names) - 1:
-        size_bytes /= 1024.0
-        i += 1
-    return f"{size_bytes:.1f} {size_names[i]}"
-
-# ---------- Filters ----------
-@app.template_filter("snippet")
-def snippet_filter(value, length: int = 20):
-    value = (value or "").replace("\n", " ")
-    return (value[:length] + "...") if len(value) > length else value
-
-@app.template_filter("is_image")
-def is_image_filter(filename):
-    mtype, _ = mimetypes.guess_type(filename or "")
-    return bool(mtype and mtype.startswith("image/"))
+        # SHA-256 of stored files, computed while the upload streams in
+        try:
+            db.execute("ALTER TABLE pastes ADD COLUMN content_hash TEXT")
+        except sqlite3.OperationalError:
+            pass  # Column already exists
+        # Reference counts of (deduplicated) blobs and lookups by content hash
+        db.execute("CREATE INDEX IF NOT EXISTS idx_pastes_stored_filename ON pastes (stored_filename)")
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_pastes_content_hash ON pastes (content_hash)"
+            " WHERE content_hash IS NOT NULL"
+        )
+        # Files stored before the sharded layout sit directly in the upload folder
+        # until `shard-upload-folder` moves them; fresh installs never look there
+        db.execute(
+            "INSERT OR IGNORE INTO settings (key, value) SELECT 'flat_layout',"
+            " CASE WHEN EXISTS (SELECT 1 FROM pastes WHERE is_file = 1) THEN 'true' ELSE 'false' END"
+        )
+        # Retention: optional per-paste expiry, and last download time for LRU eviction
+        for column in ("expires_at DATETIME", "accessed_at DATETIME"):
+            try:
+                db.execute(f"ALTER TABLE pastes ADD COLUMN {column}")
+            except sqlite3.OperationalError:
+                pass  # Column already exists
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_pastes_expires_at ON pastes (expires_at)"
+            " WHERE expires_at IS NOT NULL"
+        )
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_pastes_lru ON pastes (COALESCE(accessed_at, created_at), id)"
+            " WHERE is_file = 1"
+        )
+        # Bytes of stored files, counting a deduplicated blob once; kept by
+        # triggers so the quota check never sums file_size over the table
+        if not db.execute("SELECT 1 FROM counters WHERE name = 'storage_used'").fetchone():
+            db.execute(
+                "INSERT INTO counters (name, value) SELECT 'storage_used', COALESCE(SUM(size), 0) FROM"
+                " (SELECT MAX(COALESCE(file_size, 0)) AS size FROM pastes WHERE is_file = 1 GROUP BY stored_filename)"
+            )
+        db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS pastes_storage_insert AFTER INSERT ON pastes
+            WHEN new.is_file = 1 AND NOT EXISTS (
+                SELECT 1 FROM pastes WHERE stored_filename = new.stored_filename AND id != new.id
+            ) BEGIN
+                UPDATE counters SET value = value + COALESCE(new.file_size, 0) WHERE name = 'storage_used';
+            END;
+            """
+        )
+        db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS pastes_storage_delete AFTER DELETE ON pastes
+            WHEN old.is_file = 1 AND NOT EXISTS (
+                SELECT 1 FROM pastes WHERE stored_filename = old.stored_filename
+            ) BEGIN
+                UPDATE counters SET value = value - COALESCE(old.file_size, 0) WHERE name = 'storage_used';
+            END;
+            """
+        )
+        # Compressed bodies of large text pastes, kept out of the pastes rows
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS paste_bodies (
+                paste_id INTEGER PRIMARY KEY,
+                codec TEXT NOT NULL,
+                body BLOB NOT NULL
+            );
+            """
+        )
+        db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS pastes_body_delete AFTER DELETE ON pastes BEGIN
+                DELETE FROM paste_bodies WHERE paste_id = old.id;
+            END;
+            """
+        )
+        # Sparse newline index of large text files, for /preview line windows
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS line_indexes (
+                paste_id INTEGER PRIMARY KEY,
+                stride INTEGER NOT NULL,
+                line_count INTEGER NOT NULL,
+                checkpoints BLOB NOT NULL
+            );
+            """
+        )
+        db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS pastes_line_index_delete AFTER DELETE ON pastes
+            WHEN old.is_file = 1 BEGIN
+                DELETE FROM line_indexes WHERE paste_id = old.id;
+            END;
+            """
+        )
+        # Upload-folder migrations and their per-file journal, so an interrupted
+        # migration resumes where it stopped
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS migrations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                source TEXT NOT NULL,
+                dest TEXT NOT NULL,
+                verify INTEGER DEFAULT 0,
+                status TEXT NOT NULL DEFAULT 'scanning',
+                message TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                finished_at DATETIME
+            );
+            """
+        )
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS migration_files (
+                migration_id INTEGER NOT NULL,
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                error TEXT,
+                PRIMARY KEY (migration_id, filename)
+            );
+            """
+        )
+        # Files whose last paste is gone but which may still be on disk; cleared
+        # once unlinked, so a crash in between never leaks or dangles anything
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pending_unlinks (
+                stored_filename TEXT PRIMARY KEY,
+                queued_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+        # Unfinished resumable uploads; the offset is the size of the .part file
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS uploads (
+                token TEXT PRIMARY KEY,
+                original_filename TEXT NOT NULL,
+                content TEXT,
+                upload_length INTEGER NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+        try:
+            db.execute("ALTER TABLE uploads ADD COLUMN ttl INTEGER")
+        except sqlite3.OperationalError:
+            pass  # Column already exists
+        # Time of the last PATCH; uploads expire on inactivity, not age
+        try:
+            db.execute("ALTER TABLE uploads ADD COLUMN updated_at DATETIME")
+        except sqlite3.OperationalError:
+            pass  # Column already exists
+        
+        # Initialize upload folder setting if it doesn't exist
+        current_path = db.execute("SELECT value FROM settings WHERE key=?", ("upload_folder",)).fetchone()
+        if not current_path:
+            db.execute("INSERT INTO settings (key, value) VALUES (?, ?)", ("upload_folder", UPLOAD_FOLDER))
+            db.commit()
+    
+    init_search_index()
+
+# Set by init_search_index(); search falls back to LIKE without FTS5
+fts_enabled = False
+
+def full_text_sql(paste_id, content):
+    """SQL for the whole text of a paste: its compressed body if it has one, else `content`"""
+    return f"COALESCE((SELECT inflate_text(body) FROM paste_bodies WHERE paste_id = {paste_id}), {content})"
+
+def init_search_index():
+    """Create the FTS5 index over pastes and backfill it on first creation.
+
+    The index is an external-content table, so it stores only the inverted
+    index; triggers keep it in step with every insert and delete, including
+    watcher-driven and bulk deletions. Its content is the paste_search view,
+    which has the whole text of large pastes rather than their inline head.
+    """
+    global fts_enabled
+    with get_db() as db:
+        db.execute(
+            f"""
+            CREATE VIEW IF NOT EXISTS paste_search AS
+            SELECT id, {full_text_sql("pastes.id", "pastes.content")} AS content, original_filename
+            FROM pastes;
+            """
+        )
+        existing = db.execute(
+            "SELECT sql FROM sqlite_master WHERE type='table' AND name='pastes_fts'"
+        ).fetchone()
+        if existing and "paste_search" not in existing["sql"]:
+            # Built from pastes.content, which only has the head of large pastes
+            for trigger in ("pastes_fts_insert", "pastes_fts_delete", "pastes_fts_update"):
+                db.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            db.execute("DROP TABLE pastes_fts")
+            existing = None
+        try:
+            db.execute(
+                """
+                CREATE VIRTUAL TABLE IF NOT EXISTS pastes_fts USING fts5(
+                    content, original_filename,
+                    content='paste_search', content_rowid='id',
+                    tokenize='unicode61', prefix='2 3'
+                );
+                """
+            )
+        except sqlite3.OperationalError as e:
+            logger.warning(f"FTS5 unavailable, search falls back to LIKE scans: {e}")
+            fts_enabled = False
+            return
+        
+        # A 'delete' has to repeat exactly what was indexed, so every trigger
+        # derives the text the way paste_search does
+        db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS pastes_fts_insert AFTER INSERT ON pastes BEGIN
+                INSERT INTO pastes_fts (rowid, content, original_filename)
+                VALUES (new.id, new.content, new.original_filename);
+            END;
+            """
+        )
+        # BEFORE, so the body is still there; pastes_body_delete removes it afterwards
+        db.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS pastes_fts_delete BEFORE DELETE ON pastes BEGIN
+                INSERT INTO pastes_fts (pastes_fts, rowid, content, original_filename)
+                VALUES ('delete', old.id, {full_text_sql("old.id", "old.content")}, old.original_filename);
+            END;
+            """
+        )
+        db.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS pastes_fts_update AFTER UPDATE OF content, original_filename ON pastes BEGIN
+                INSERT INTO pastes_fts (pastes_fts, rowid, content, original_filename)
+                VALUES ('delete', old.id, {full_text_sql("old.id", "old.content")}, old.original_filename);
+                INSERT INTO pastes_fts (rowid, content, original_filename)
+                VALUES (new.id, {full_text_sql("new.id", "new.content")}, new.original_filename);
+            END;
+            """
+        )
+        # Storing a body swaps the indexed head (or previous body) for the whole text
+        db.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS paste_bodies_fts_unindex BEFORE INSERT ON paste_bodies BEGIN
+                INSERT INTO pastes_fts (pastes_fts, rowid, content, original_filename)
+                SELECT 'delete', id, {full_text_sql("pastes.id", "pastes.content")}, original_filename
+                FROM pastes WHERE id = new.paste_id;
+            END;
+            """
+        )
+        db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS paste_bodies_fts_index AFTER INSERT ON paste_bodies BEGIN
+                INSERT INTO pastes_fts (rowid, content, original_filename)
+                SELECT id, inflate_text(new.body), original_filename
+                FROM pastes WHERE id = new.paste_id;
+            END;
+            """
+        )
+        if not existing:
+            rebuild_search_index(db)
+    fts_enabled = True
+
+def rebuild_search_index(db):
+    """One-shot backfill of the FTS index from the pastes table"""
+    started = time.monotonic()
+    db.execute("INSERT INTO pastes_fts (pastes_fts) VALUES ('rebuild')")
+    db.commit()
+    logger.info(f"Built search index in {time.monotonic() - started:.1f}s")
+
+def build_fts_query(q):
+    """Turn free text into an FTS5 query where every term must match as a prefix.
+
+    Terms are quoted, so FTS5 operators typed into the search box are treated as
+    plain words. Returns "" when nothing searchable is left.
+    """
+    terms = re.findall(r"\w+", q)
+    return " ".join(f'"{term}"*' for term in terms)
+
+@app.cli.command("rebuild-search-index")
+def rebuild_search_index_command():
+    """Rebuild the full-text search index from the pastes table."""
+    ensure_schema()
+    with get_db() as db:
+        rebuild_search_index(db)
+
+def format_file_size(size_bytes):
+    """Convert bytes to human readable format"""
+    if size_bytes == 0:
+        return "0 B"
+    size_names = ["B", "KB", "MB", "GB", "TB"]
+    i = 0
+    while size_bytes >= 1024 and i < len(size_names) - 1:
+        size_bytes /= 1024.0
+        i += 1
+    return f"{size_bytes:.1f} {size_names[i]}"
+
+def parse_date_arg(value):
+    """Parse a YYYY-MM-DD query argument; None when missing or malformed"""
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+def encode_page_cursor(row):
+    """Opaque keyset cursor for a listing row, built from its (created_at, id)"""
+    raw = f"{row['created_at']}|{row['id']}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_page_cursor(token):
+    """Inverse of encode_page_cursor(); None when missing or malformed"""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        created_at, paste_id = raw.rsplit("|", 1)
+        return created_at, int(paste_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+# Listing rows carry a bounded preview instead of the body; /raw/<id> serves the rest
+LISTING_COLUMNS = (
+    "pastes.id, pastes.stored_filename, pastes.original_filename, pastes.is_file,"
+    " pastes.file_size, pastes.created_at,"
+    f" substr(pastes.content, 1, {PREVIEW_CHARS + 1}) AS preview"
+)
+
+def count_pastes(db, source, where, params):
+    """Total for a listing as (count, is_estimate).
+
+    Unfiltered listings read the trigger-maintained counter; filtered ones stop
+    counting after COUNT_CAP matches instead of scanning everything.
+    """
+    if not where:
+        row = db.execute("SELECT value FROM counters WHERE name = 'paste_count'").fetchone()
+        return (row["value"] if row else 0), False
+    total = db.execute(
+        f"SELECT COUNT(*) FROM (SELECT 1 FROM {source} {where} LIMIT ?)", params + [COUNT_CAP + 1]
+    ).fetchone()[0]
+    return min(total, COUNT_CAP), total > COUNT_CAP
+
+# ---------- Text Storage ----------
+def inflate_text(body):
+    """SQL function inflate_text(): the text of a compressed paste body"""
+    return zlib.decompress(body).decode("utf-8") if body is not None else None
+
+def inline_head(text):
+    """The part of a large paste kept in pastes.content, cut on a character boundary"""
+    return text.encode("utf-8")[:INLINE_TEXT_LIMIT].decode("utf-8", "ignore")
+
+def insert_text_paste(db, text, ttl=None):
+    """Insert a text paste, moving a large body out of row; returns the new id"""
+    size = len(text.encode("utf-8"))
+    large = size > INLINE_TEXT_LIMIT
+    paste_id = db.execute(
+        "INSERT INTO pastes (content, is_file, file_size, expires_at) VALUES (?,0,?,datetime('now', ?))",
+        (inline_head(text) if large else text, size, ttl_modifier(ttl)),
+    ).lastrowid
+    if large:
+        store_text_body(db, paste_id, text)
+    return paste_id
+
+def store_text_body(db, paste_id, text):
+    db.execute(
+        "INSERT OR REPLACE INTO paste_bodies (paste_id, codec, body) VALUES (?, 'zlib', ?)",
+        (paste_id, zlib.compress(text.encode("utf-8"), TEXT_COMPRESS_LEVEL)),
+    )
+
+def paste_text_chunks(db, paste_id, content):
+    """Yield the full UTF-8 body of a paste, decompressing it piece by piece if stored out of row.
+
+    The compressed blob is read incrementally where sqlite3 has blobopen()
+    (Python 3.11+), and no piece yielded is larger than TEXT_STREAM_CHUNK.
+    """
+    row = db.execute("SELECT codec FROM paste_bodies WHERE paste_id = ?", (paste_id,)).fetchone()
+    if row is None:
+        yield (content or "").encode("utf-8")
+        return
+    if row["codec"] != "zlib":
+        raise ValueError(f"Unknown text codec {row['codec']!r} for paste {paste_id}")
+    if hasattr(db, "blobopen"):
+        with db.blobopen("paste_bodies", "body", paste_id, readonly=True) as blob:
+            yield from inflate_chunks(iter(lambda: blob.read(TEXT_STREAM_CHUNK), b""))
+        return
+    body = db.execute("SELECT body FROM paste_bodies WHERE paste_id = ?", (paste_id,)).fetchone()["body"]
+    yield from inflate_chunks(body[start:start + TEXT_STREAM_CHUNK] for start in range(0, len(body), TEXT_STREAM_CHUNK))
+
+def inflate_chunks(pieces):
+    """Decompress zlib data arriving in `pieces`, TEXT_STREAM_CHUNK bytes of output at a time.
+
+    Text compresses well, so without max_length one compressed piece could
+    expand to many megabytes.
+    """
+    decompressor = zlib.decompressobj()
+    for piece in pieces:
+        while piece:
+            data = decompressor.decompress(piece, TEXT_STREAM_CHUNK)
+            piece = decompressor.unconsumed_tail
+            if data:
+                yield data
+    # Output zlib still holds back once all the input is in
+    while not decompressor.eof:
+        data = decompressor.decompress(b"", TEXT_STREAM_CHUNK)
+        if not data:
+            break
+        yield data
+
+def database_size():
+    """Bytes used by the database file, and bytes of it that are free pages"""
+    with get_db() as db:
+        page_size = db.execute("PRAGMA page_size").fetchone()[0]
+        pages = db.execute("PRAGMA page_count").fetchone()[0]
+        free = db.execute("PRAGMA freelist_count").fetchone()[0]
+    return pages * page_size, free * page_size
+
+def time_listing_queries():
+    """Milliseconds for the queries the index page runs, for before/after reports"""
+    timings = {}
+    queries = {
+        "first_page": (f"SELECT {LISTING_COLUMNS} FROM pastes ORDER BY created_at DESC, id DESC LIMIT ?", [PAGE_SIZE]),
+        "like_scan": ("SELECT COUNT(*) FROM pastes WHERE content LIKE ?", ["%needle-that-is-not-there%"]),
+        "full_scan": ("SELECT SUM(length(content)) FROM pastes", []),
+    }
+    with get_db() as db:
+        for name, (sql, params) in queries.items():
+            started = time.perf_counter()
+            db.execute(sql, params).fetchall()
+            timings[name] = round((time.perf_counter() - started) * 1000, 1)
+    return timings
+
+@app.cli.command("compress-text-pastes")
+@click.option("--batch", default=200, help="Pastes converted per transaction.")
+@click.option("--vacuum", is_flag=True, help="VACUUM afterwards to return the freed pages to the filesystem.")
+def compress_text_pastes_command(batch, vacuum):
+    """Move text pastes above INLINE_TEXT_LIMIT into compressed out-of-row storage."""
+    ensure_schema()
+    size_before, _ = database_size()
+    timings_before = time_listing_queries()
+    converted = saved = 0
+    last_id = 0
+    while True:
+        with get_db() as db:
+            rows = db.execute(
+                "SELECT id, content FROM pastes"
+                " WHERE is_file = 0 AND id > ? AND length(CAST(content AS BLOB)) > ?"
+                " AND id NOT IN (SELECT paste_id FROM paste_bodies)"
+                " ORDER BY id LIMIT ?",
+                (last_id, INLINE_TEXT_LIMIT, batch)
+            ).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                store_text_body(db, row["id"], row["content"])
+                db.execute("UPDATE pastes SET content = ? WHERE id = ?", (inline_head(row["content"]), row["id"]))
+            saved += sum(len(row["content"].encode("utf-8")) for row in rows)
+            converted += len(rows)
+            last_id = rows[-1]["id"]
+        click.echo(f"  {converted} pastes converted")
+    
+    if vacuum:
+        with get_db() as db:
+            if fts_enabled:
+                # Merge away the index entries of the text that was moved
+                db.execute("INSERT INTO pastes_fts (pastes_fts) VALUES ('optimize')")
+                db.commit()
+            db.execute("VACUUM")
+    size_after, free_after = database_size()
+    timings_after = time_listing_queries()
+    click.echo(f"Moved {converted} pastes ({format_file_size(saved)} of text) out of row")
+    report = f"Database: {format_file_size(size_before)} -> {format_file_size(size_after)}"
+    if free_after and not vacuum:
+        report += f" ({format_file_size(free_after)} in free pages; --vacuum releases them)"
+    click.echo(report)
+    for name in timings_before:
+        click.echo(f"{name:>10}: {timings_before[name]:8.1f} ms -> {timings_after[name]:8.1f} ms")
+
+# ---------- Filters ----------
+@app.template_filter("snippet")
+def snippet_filter(value, length: int = 20):
+    value = (value or "").replace("\n", " ")
+    return (value[:length] + "...") if len(value) > length else value
+
+@app.template_filter("highlight")
+def highlight_filter(value):
+    """Escape an FTS snippet and turn its match markers into <mark> tags"""
+    escaped = str(escape(value or ""))
+    if escaped.count(SNIPPET_OPEN) > escaped.count(SNIPPET_CLOSE):
+        escaped += SNIPPET_CLOSE  # Cut short inside a match
+    return Markup(
+        escaped.replace(SNIPPET_OPEN, '<mark class="bg-yellow-500/40 text-gray-100 rounded">')
+               .replace(SNIPPET_CLOSE, "</mark>")
+    )
+
+@app.template_filter("is_image")
+def is_image_filter(filename):
+    mtype, _ = mimetypes.guess_type(filename or "")
+    return bool(mtype and mtype.startswith("image/"))
 
 @app.template_filter("format_size")
 def format_size_filter(size_bytes):
     return format_file_size(size_bytes or 0)
 
 # ---------- Settings Management ----------
+_settings_cache = {}
+_settings_lock = threading.Lock()
+
+def get_setting(key, default=None):
+    """Read a setting through a small in-process cache.
+
+    Entries are dropped by set_setting() and expire after SETTINGS_CACHE_TTL,
+    so other worker processes pick up changes within a few seconds.
+    """
+    now = time.monotonic()
+    with _settings_lock:
+        cached = _settings_cache.get(key)
+        if cached and cached[1] > now:
+            return cached[0]
+    
+    with get_db() as db:
+        row = db.execute("SELECT value FROM settings WHERE key=?", (key,)).fetchone()
+    value = row["value"] if row else default
+    
+    with _settings_lock:
+        _settings_cache[key] = (value, now + SETTINGS_CACHE_TTL)
+    return value
+
+def set_setting(key, value):
+    """Persist a setting and invalidate its cached value"""
+    with get_db() as db:
+        db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+    with _settings_lock:
+        _settings_cache.pop(key, None)
+
 def get_current_upload_folder():
     """Get the current upload folder from database"""
-    with get_db() as db:
-        row = db.execute("SELECT value FROM settings WHERE key=?", ("upload_folder",)).fetchone()
-        return row["value"] if row else UPLOAD_FOLDER
+    return get_setting("upload_folder", UPLOAD_FOLDER)
 
 def update_upload_folder(new_path):
     """Update the upload folder setting in database"""
     global file_watcher
-    with get_db() as db:
-        db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", ("upload_folder", new_path))
-        db.commit()
+    set_setting("upload_folder", new_path)
+    file_meta_cache.clear()  # Cached paths point into the old folder
     
     # Restart file watcher with new path
     if file_watcher:
         file_watcher.restart(new_path)
 
+def is_dedupe_enabled():
+    """Whether new uploads go to content-addressed, deduplicated storage"""
+    return get_setting("dedupe_uploads", DEDUPE_DEFAULT) == "true"
+
+def is_ingest_enabled():
+    """Whether files copied straight into the upload folder become pastes"""
+    return get_setting("ingest_files", INGEST_DEFAULT) == "true"
+
+def get_max_age():
+    """Global maximum paste age in seconds; 0 when pastes are kept forever"""
+    return int(get_setting("max_age", MAX_AGE_DEFAULT) or 0)
+
+def get_storage_quota():
+    """Upper bound on bytes of stored files; 0 when unlimited"""
+    return int(get_setting("storage_quota", QUOTA_DEFAULT) or 0)
+
+def get_eviction_policy():
+    """Which file pastes go first when over quota: 'oldest' or 'lru'"""
+    policy = get_setting("eviction_policy", EVICTION_DEFAULT)
+    return policy if policy in EVICTION_POLICIES else "oldest"
+
 def is_first_time_setup():
     """Check if this is the first time the app is being accessed"""
-    with get_db() as db:
-        row = db.execute("SELECT value FROM settings WHERE key=?", ("setup_complete",)).fetchone()
-        return row is None
+    return get_setting("setup_complete") is None
 
 def complete_setup():
     """Mark setup as complete"""
-    with get_db() as db:
-        db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", ("setup_complete", "true"))
-        db.commit()
+    set_setting("setup_complete", "true")
+
+def stored_file_folders():
+    """Folders a stored file can be in: the upload folder, plus the old one while a migration runs"""
+    folders = [get_current_upload_folder()]
+    source = get_setting("migration_source")
+    if source and source != folders[0]:
+        folders.append(source)
+    return folders
+
+def shard_path(folder, stored_filename):
+    """Where a stored file lives in `folder`: SHARD_LEVELS directories from its name's CRC32"""
+    digest = f"{zlib.crc32(stored_filename.encode()):08x}"
+    shards = [digest[i * SHARD_CHARS:(i + 1) * SHARD_CHARS] for i in range(SHARD_LEVELS)]
+    return os.path.join(folder, *shards, stored_filename)
+
+def has_flat_files():
+    """Whether files may still sit directly in the upload folder (pre-sharding layout)"""
+    return get_setting("flat_layout", "true") == "true"
+
+def stored_path_candidates(folder, stored_filename):
+    paths = [shard_path(folder, stored_filename)]
+    if has_flat_files():
+        paths.append(os.path.join(folder, stored_filename))
+    return paths
+
+def resolve_stored_path(stored_filename):
+    """Path of a stored file; the one place that maps stored filenames to disk.
+
+    Normally its shard in the upload folder, without touching the disk. Only
+    while flat files remain or a migration runs are the other places checked.
+    """
+    candidates = [
+        path for folder in stored_file_folders() for path in stored_path_candidates(folder, stored_filename)
+    ]
+    if len(candidates) > 1:
+        for path in candidates:
+            if os.path.exists(path):
+                return path
+    return candidates[0]
+
+def iter_stored_files(folder, depth=0):
+    """DirEntry of every stored file in `folder`, flat or in shard directories"""
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.startswith(UPLOAD_TEMP_PREFIX):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if depth < SHARD_LEVELS and len(entry.name) == SHARD_CHARS:
+                    yield from iter_stored_files(entry.path, depth + 1)
+            elif entry.is_file() and depth in (0, SHARD_LEVELS):
+                yield entry
+
+def stored_file_exists(db, stored_filename):
+    """Whether a stored file still exists somewhere; the check before dropping its rows.
+
+    Besides resolve_stored_path() this asks the database for running
+    migrations, because this process's settings cache may not have seen a
+    migration that another worker just started.
+    """
+    if os.path.exists(resolve_stored_path(stored_filename)):
+        return True
+    return any(
+        os.path.exists(shard_path(row["dest"], stored_filename))
+        for row in db.execute("SELECT dest FROM migrations WHERE status IN ('scanning', 'copying')")
+    )
+
+# ---------- Folder Migration ----------
+class FolderMigration:
+    """Moves the files of a previous upload folder into the new one in the background.
 
-def migrate_files(old_path, new_path):
-    """Migrate files from old path to new path"""
-    if not os.path.exists(old_path):
-        return {"success": True, "message": "No files to migrate (old path doesn't exist)"}
+    The file list is journaled in migration_files first; each file is marked
+    done or failed as it is handled, so a restart picks up the pending rows
+    only. Files are renamed when both folders share a filesystem and copied by
+    a small thread pool (optionally checksum-verified) when they don't. While
+    it runs, reads fall back to the old folder through resolve_stored_path().
+    """
     
-    if not os.path.exists(new_path):
+    def __init__(self, migration_id):
+        self.migration_id = migration_id
+        self._thread = None
+        
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"folder-migration-{self.migration_id}", daemon=True)
+        self._thread.start()
+        
+    def _load(self):
+        with get_db() as db:
+            return db.execute("SELECT * FROM migrations WHERE id = ?", (self.migration_id,)).fetchone()
+        
+    def _set_status(self, status, message=None):
+        with get_db() as db:
+            db.execute(
+                "UPDATE migrations SET status = ?, message = ?,"
+                " finished_at = CASE WHEN ? IN ('done', 'failed') THEN CURRENT_TIMESTAMP END"
+                " WHERE id = ?",
+                (status, message, status, self.migration_id)
+            )
+    
+    def _run(self):
+        job = self._load()
+        self.source, self.dest, self.verify = job["source"], job["dest"], bool(job["verify"])
         try:
-            os.makedirs(new_path, exist_ok=True)
+            if job["status"] == "scanning":
+                self._scan()
+            self._transfer()
+            self._finish()
         except Exception as e:
-            return {"success": False, "message": f"Failed to create new directory: {str(e)}"}
+            logger.error(f"Migration {self.migration_id} stopped: {e}")
+            self._set_status("failed", str(e))
+    
+    def _scan(self):
+        """Journal every file of the old folder (idempotent, so safe to redo after a crash)"""
+        batch = []
+        for entry in iter_stored_files(self.source):
+            batch.append((self.migration_id, entry.name, entry.stat().st_size))
+            if len(batch) >= 1000:
+                self._journal(batch)
+        self._journal(batch)
+        self._set_status("copying")
     
+    def _journal(self, batch):
+        with get_db() as db:
+            db.executemany(
+                "INSERT OR IGNORE INTO migration_files (migration_id, filename, size) VALUES (?, ?, ?)", batch
+            )
+        batch.clear()
+    
+    def _transfer(self):
+        same_filesystem = os.stat(self.source).st_dev == os.stat(self.dest).st_dev
+        logger.info(
+            f"Migration {self.migration_id}: {self.source} -> {self.dest}"
+            f" ({'rename' if same_filesystem else f'copy with {MIGRATION_WORKERS} workers'})"
+        )
+        with ThreadPoolExecutor(max_workers=1 if same_filesystem else MIGRATION_WORKERS,
+                                thread_name_prefix="migration") as pool:
+            while True:
+                with get_db() as db:
+                    rows = db.execute(
+                        "SELECT filename, size FROM migration_files"
+                        " WHERE migration_id = ? AND state = 'pending' LIMIT ?",
+                        (self.migration_id, MIGRATION_BATCH)
+                    ).fetchall()
+                if not rows:
+                    return
+                results = pool.map(lambda row: self._move(row["filename"], row["size"], same_filesystem), rows)
+                with get_db() as db:
+                    db.executemany(
+                        "UPDATE migration_files SET state = ?, error = ? WHERE migration_id = ? AND filename = ?",
+                        [(state, error, self.migration_id, row["filename"]) for row, (state, error) in zip(rows, results)]
+                    )
+    
+    def _move(self, filename, size, same_filesystem):
+        """Move one file into its shard in the new folder; returns the journal (state, error) for it"""
+        src = shard_path(self.source, filename)
+        if not os.path.exists(src):
+            src = os.path.join(self.source, filename)
+        dst = shard_path(self.dest, filename)
+        try:
+            if not os.path.exists(src):
+                return "done", None  # Deleted meanwhile, or moved before an interruption
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if os.path.exists(dst):
+                # A deduplicated blob, or a copy finished just before an interruption
+                if not self._same_content(src, dst):
+                    return "failed", "a different file with this name exists in the new folder"
+                os.remove(src)
+                return "done", None
+            if same_filesystem:
+                os.rename(src, dst)
+            else:
+                self._copy(src, dst)
+                os.remove(src)
+            return "done", None
+        except OSError as e:
+            logger.error(f"Migration {self.migration_id}: failed to move {filename}: {e}")
+            return "failed", str(e)
+    
+    def _copy(self, src, dst):
+        """Copy into a temp name in the destination and rename it into place when complete"""
+        fd, temp_path = tempfile.mkstemp(prefix=UPLOAD_TEMP_PREFIX, dir=self.dest)
+        try:
+            digest = hashlib.sha256()
+            with open(src, "rb") as fsrc, os.fdopen(fd, "wb") as fdst:
+                for chunk in iter(lambda: fsrc.read(MIGRATION_CHUNK), b""):
+                    if self.verify:
+                        digest.update(chunk)
+                    fdst.write(chunk)
+                fdst.flush()
+                os.fsync(fdst.fileno())
+            shutil.copystat(src, temp_path)
+            if self.verify and file_sha256(temp_path) != digest.hexdigest():
+                raise OSError(f"checksum mismatch after copying {os.path.basename(src)}")
+            os.replace(temp_path, dst)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    
+    def _same_content(self, a, b):
+        if os.path.getsize(a) != os.path.getsize(b):
+            return False
+        if self.verify or not os.path.basename(a).startswith(CAS_PREFIX):
+            return file_sha256(a) == file_sha256(b)
+        return True  # cas_ names are the hash of the content
+    
+    def _finish(self):
+        progress = migration_progress(self.migration_id)
+        if progress["failed"]:
+            # Keep reading from the old folder so the files left there stay reachable
+            self._set_status("failed", f"{progress['failed']} files could not be moved")
+            logger.warning(f"Migration {self.migration_id} finished with {progress['failed']} failures")
+            return
+        self._set_status("done", f"Moved {progress['done']} files")
+        set_setting("migration_source", "")
+        file_meta_cache.clear()
+        logger.info(f"Migration {self.migration_id} finished: {progress['done']} files")
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(MIGRATION_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def active_migration():
+    """The migration that is still scanning or copying, if any"""
+    with get_db() as db:
+        return db.execute(
+            "SELECT * FROM migrations WHERE status IN ('scanning', 'copying') ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+
+def migration_progress(migration_id):
+    with get_db() as db:
+        rows = db.execute(
+            "SELECT state, COUNT(*) AS files, COALESCE(SUM(size), 0) AS bytes"
+            " FROM migration_files WHERE migration_id = ? GROUP BY state",
+            (migration_id,)
+        ).fetchall()
+    by_state = {row["state"]: row for row in rows}
+    progress = {state: by_state[state]["files"] if state in by_state else 0 for state in ("pending", "done", "failed")}
+    progress["total"] = sum(progress.values())
+    progress["bytes_total"] = sum(row["bytes"] for row in rows)
+    progress["bytes_done"] = by_state["done"]["bytes"] if "done" in by_state else 0
+    return progress
+
+def unfinished_migration_source():
+    """Folder a failed migration left files in, while reads still fall back to it"""
+    return get_setting("migration_source") or None
+
+def start_migration(old_path, new_path, verify=False):
+    """Journal a migration and start moving files; reads use both folders until it is done"""
     if not os.access(new_path, os.W_OK):
-        return {"success": False, "message": "New path is not writable"}
+        raise ValueError("New path is not writable")
+    if unfinished_migration_source():
+        # Only one fallback folder is kept; replacing it would orphan the files still there
+        raise ValueError("Files of the last migration have not all been moved")
+    with get_db() as db:
+        migration_id = db.execute(
+            "INSERT INTO migrations (source, dest, verify) VALUES (?, ?, ?)",
+            (old_path, new_path, 1 if verify else 0)
+        ).lastrowid
+    set_setting("migration_source", old_path)
+    # Switch before the first file moves, so nothing is ever looked for only in the old folder
+    update_upload_folder(new_path)
+    FolderMigration(migration_id).start()
+    return migration_id
+
+def resume_migration():
+    """Restart a migration that was interrupted (e.g. by a restart of the app)"""
+    job = active_migration()
+    if job:
+        logger.info(f"Resuming migration {job['id']} from {job['source']}")
+        FolderMigration(job["id"]).start()
+
+def relayout_upload_folder(folder, batch=1000, pause=0.0):
+    """Move the flat files of `folder` into their shards; returns (moved, left behind).
+
+    Safe while the app runs: readers look in the shard first and then the flat
+    path, and a rename inside the watched tree is a move event, not a deletion.
+    Only stored files move; anything else was dropped there for the ingester,
+    which looks at the top level only.
+    """
+    moved = skipped = 0
+    with os.scandir(folder) as entries:
+        names = [e.name for e in entries if e.is_file() and not e.name.startswith(UPLOAD_TEMP_PREFIX)]
+    with get_db() as db:
+        untracked = set(untracked_names(db, names))
+    names = [name for name in names if name not in untracked]
+    for i, name in enumerate(names, 1):
+        src, dst = os.path.join(folder, name), shard_path(folder, name)
+        try:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if os.path.exists(dst):
+                skipped += 1
+                logger.warning(f"Not re-laying out {name}: {dst} already exists")
+                continue
+            os.rename(src, dst)
+            moved += 1
+        except FileNotFoundError:
+            pass  # Deleted meanwhile
+        except OSError as e:
+            skipped += 1
+            logger.error(f"Failed to move {name} into its shard: {e}")
+        if i % batch == 0:
+            logger.info(f"Re-layout: {i}/{len(names)} files")
+            time.sleep(pause)
+    return moved, skipped
+
+@app.cli.command("shard-upload-folder")
+@click.option("--batch", default=1000, help="Files moved between progress reports and pauses.")
+@click.option("--pause", default=0.0, help="Seconds to sleep after each batch, to spare the NAS.")
+def shard_upload_folder_command(batch, pause):
+    """Move files stored flat in the upload folder into hash-prefix subdirectories."""
+    ensure_schema()
+    if active_migration():
+        raise click.ClickException("A folder migration is running; try again when it has finished.")
+    folder = get_current_upload_folder()
+    moved, skipped = relayout_upload_folder(folder, batch, pause)
+    if not skipped:
+        # Nothing flat is left, so lookups stop checking for it
+        set_setting("flat_layout", "false")
+    click.echo(f"Moved {moved} files into shards under {folder}; {skipped} left in place")
+
+# ---------- Upload Storage ----------
+class UploadSpool:
+    """File object an uploaded form part is streamed into.
+
+    It lives in the upload folder under a temp name, so the finished upload is
+    renamed into place instead of being copied again from /tmp, and its size
+    and SHA-256 are known without re-reading the file.
+    """
     
-    moved_count = 0
-    error_count = 0
-    errors = []
+    def __init__(self, folder):
+        fd, self.path = tempfile.mkstemp(prefix=UPLOAD_TEMP_PREFIX, dir=folder)
+        self._file = os.fdopen(fd, "w+b")
+        self.hash = hashlib.sha256()
+        self.size = 0
+        
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        STORAGE_BYTES.inc(len(data), op="save")
+        with timed_storage("save"):
+            return self._file.write(data)
+    
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+class PasteRequest(Request):
+    """Request that spools multipart file parts directly into the upload folder"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        folder = get_current_upload_folder()
+        os.makedirs(folder, exist_ok=True)
+        spool = UploadSpool(folder)
+        g.setdefault("upload_spools", []).append(spool)
+        return spool
+
+app.request_class = PasteRequest
+
+@app.teardown_request
+def discard_upload_spools(exc):
+    """Remove spooled parts that were never moved into place (errors, aborted uploads)"""
+    for spool in g.pop("upload_spools", []):
+        spool.close()
+        try:
+            os.remove(spool.path)
+        except FileNotFoundError:
+            pass
+
+def store_upload(db, temp_path, original, content_hash=None):
+    """Move a completely written upload into place; returns its stored filename.
+
+    With deduplication on, bytes already stored are reused and the temp file is
+    dropped. Call it in the transaction that inserts the paste row: the write
+    lock taken here keeps a concurrent delete from unlinking the reused blob.
+    """
+    folder = get_current_upload_folder()
+    ts = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    stored = f"{ts}_{original}"
+    if content_hash and is_dedupe_enabled():
+        acquire_write_lock(db)
+        row = db.execute(
+            "SELECT stored_filename FROM pastes WHERE content_hash = ? AND is_file = 1 LIMIT 1",
+            (content_hash,)
+        ).fetchone()
+        if row and os.path.exists(resolve_stored_path(row["stored_filename"])):
+            os.remove(temp_path)
+            return row["stored_filename"]
+        # A blob queued for unlinking must not be handed the new bytes
+        if not db.execute(
+            "SELECT 1 FROM pending_unlinks WHERE stored_filename = ?", (f"{CAS_PREFIX}{content_hash}",)
+        ).fetchone():
+            stored = f"{CAS_PREFIX}{content_hash}"
+    dest = shard_path(folder, stored)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    with timed_storage("rename"):
+        shutil.move(temp_path, dest)
+    return stored
+
+def delete_pastes(paste_ids):
+    """Delete pastes and then the files no remaining paste references.
+
+    Phase one is a single short write transaction: the rows go with set-based
+    statements and every file left without a reference is recorded in
+    pending_unlinks. Phase two unlinks those files in a worker pool with no
+    lock held, clearing each tombstone once its file is gone. Whatever a crash
+    interrupts, drain_pending_unlinks() finishes later.
+
+    Returns ({deleted id: stored filename or None}, set of files that could not be removed).
+    """
+    paste_ids = list(dict.fromkeys(paste_ids))
+    deleted = {}
+    with get_db() as db:
+        acquire_write_lock(db)
+        for start in range(0, len(paste_ids), DELETE_CHUNK):
+            chunk = paste_ids[start:start + DELETE_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            rows = db.execute(
+                f"SELECT id, stored_filename, is_file FROM pastes WHERE id IN ({placeholders})", chunk
+            ).fetchall()
+            db.execute(f"DELETE FROM pastes WHERE id IN ({placeholders})", chunk)
+            deleted.update((row["id"], row["stored_filename"] if row["is_file"] else None) for row in rows)
+        
+        # Deduplicated files go only once their last paste is gone
+        orphaned = [
+            stored for stored in set(filter(None, deleted.values()))
+            if not db.execute("SELECT 1 FROM pastes WHERE stored_filename = ? LIMIT 1", (stored,)).fetchone()
+        ]
+        db.executemany(
+            "INSERT OR IGNORE INTO pending_unlinks (stored_filename) VALUES (?)", [(stored,) for stored in orphaned]
+        )
     
+    file_meta_cache.invalidate(deleted)
+    if deleted:
+        change_feed.notify()
+    return deleted, unlink_stored_files(orphaned)
+
+_unlink_pool = None
+_unlink_pool_lock = threading.Lock()
+
+def unlink_stored_files(stored_filenames):
+    """Remove files queued in pending_unlinks from every folder they may be in.
+
+    Returns the names that could not be removed; they stay queued.
+    """
+    global _unlink_pool
+    if not stored_filenames:
+        return set()
+    with _unlink_pool_lock:
+        if _unlink_pool is None:
+            _unlink_pool = ThreadPoolExecutor(max_workers=UNLINK_WORKERS, thread_name_prefix="unlink")
+    file_cache.discard(stored_filenames)
+    folders = stored_file_folders()
+    
+    def unlink(stored):
+        for path in (p for folder in folders for p in stored_path_candidates(folder, stored)):
+            try:
+                with timed_storage("unlink"):
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Error deleting file {stored}: {e}")
+                return False
+        return True
+    
+    results = list(_unlink_pool.map(unlink, stored_filenames))
+    done = [(stored,) for stored, ok in zip(stored_filenames, results) if ok]
+    with get_db() as db:
+        db.executemany("DELETE FROM pending_unlinks WHERE stored_filename = ?", done)
+    return {stored for stored, ok in zip(stored_filenames, results) if not ok}
+
+def drain_pending_unlinks(limit=RECONCILE_BATCH):
+    """Retry unlinks left over from a crash or an earlier error; returns how many were cleared"""
+    with get_db() as db:
+        queued = [row["stored_filename"] for row in db.execute(
+            "SELECT stored_filename FROM pending_unlinks ORDER BY queued_at LIMIT ?", (limit,)
+        )]
+    failed = unlink_stored_files(queued)
+    return len(queued) - len(failed)
+
+def insert_file_paste(db, text, stored, original, file_size, content_hash, ttl=None):
+    """Record a stored file as a paste; returns the new paste id"""
+    return db.execute(
+        "INSERT INTO pastes (content, stored_filename, original_filename, is_file, file_size, content_hash, expires_at)"
+        " VALUES (?,?,?,1,?,?,datetime('now', ?))",
+        (text if text else None, stored, original, file_size, content_hash, ttl_modifier(ttl)),
+    ).lastrowid
+
+def upload_part_path(token):
+    """Where the bytes of a resumable upload accumulate"""
+    return os.path.join(get_current_upload_folder(), f"{UPLOAD_TEMP_PREFIX}{token}.part")
+
+def parse_upload_metadata(header):
+    """Decode a tus-style Upload-Metadata header: 'key base64value,key base64value'"""
+    metadata = {}
+    for pair in filter(None, (item.strip() for item in (header or "").split(","))):
+        key, _, value = pair.partition(" ")
+        try:
+            metadata[key] = base64.b64decode(value).decode("utf-8") if value else ""
+        except (ValueError, UnicodeDecodeError):
+            abort(400)
+    return metadata
+
+# Running SHA-256 per resumable upload: token -> (offset, hash). Rebuilt from the
+# .part file when a different process or a restart picks the upload back up.
+_upload_hashes = {}
+# Without fcntl uploads are only locked within a process: token -> Lock
+_upload_locks = {}
+_upload_locks_guard = threading.Lock()
+
+@contextlib.contextmanager
+def locked_upload_part(token, blocking=True):
+    """Open a resumable upload's .part file for appending, holding a lock on it.
+
+    The lock is an flock on the file itself, so requests for one upload are
+    serialized across every worker on the host. Yields None if the upload is
+    gone (or finished or cancelled while we waited); raises BlockingIOError
+    when not blocking and someone else holds it.
+    """
+    part_path = upload_part_path(token)
     try:
-        for filename in os.listdir(old_path):
-            old_file = os.path.join(old_path, filename)
-            new_file = os.path.join(new_path, filename)
-            
-            if os.path.isfile(old_file):
+        part = open(part_path, "r+b")  # unlike "ab", never recreates a finished upload
+    except FileNotFoundError:
+        yield None
+        return
+    with part:
+        lock = None
+        if fcntl:
+            fcntl.flock(part, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            with _upload_locks_guard:
+                lock = _upload_locks.setdefault(token, threading.Lock())
+            if not lock.acquire(blocking):
+                raise BlockingIOError(f"Upload {token} is busy")
+        try:
+            try:
+                current = os.stat(part_path)
+            except FileNotFoundError:
+                current = None
+            if current is None or not os.path.samestat(current, os.fstat(part.fileno())):
+                yield None
+            else:
+                part.seek(0, os.SEEK_END)
+                yield part
+        finally:
+            if lock:
+                lock.release()
+
+def forget_upload(token):
+    """Drop this process's in-memory state for an upload that is finished or gone"""
+    _upload_hashes.pop(token, None)
+    with _upload_locks_guard:
+        _upload_locks.pop(token, None)
+
+def discard_upload(token, stale_after=None):
+    """Delete a resumable upload's row and .part file.
+
+    With `stale_after` (seconds) only an upload idle that long is deleted, and
+    one a request is writing to is skipped (BlockingIOError) instead of waited for.
+    Returns whether the upload was deleted.
+    """
+    with locked_upload_part(token, blocking=stale_after is None) as part:
+        with get_db() as db:
+            if stale_after is None:
+                deleted = db.execute("DELETE FROM uploads WHERE token = ?", (token,)).rowcount
+            else:
+                deleted = db.execute(
+                    "DELETE FROM uploads WHERE token = ?"
+                    " AND COALESCE(updated_at, created_at) < datetime('now', ?)",
+                    (token, f"-{stale_after} seconds")
+                ).rowcount
+        if part is not None and (deleted or stale_after is None):
+            os.remove(upload_part_path(token))
+    forget_upload(token)
+    return bool(deleted)
+
+def _upload_hash(token, part_path, offset):
+    state = _upload_hashes.get(token)
+    if state and state[0] == offset:
+        return state[1]
+    digest = hashlib.sha256()
+    with open(part_path, "rb") as part:
+        for chunk in iter(lambda: part.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest
+
+def expire_stale_uploads():
+    """Drop resumable uploads that have had no PATCH within UPLOAD_SESSION_TTL"""
+    with get_db() as db:
+        stale = db.execute(
+            "SELECT token FROM uploads WHERE COALESCE(updated_at, created_at) < datetime('now', ?)",
+            (f"-{UPLOAD_SESSION_TTL} seconds",)
+        ).fetchall()
+    for row in stale:
+        try:
+            discard_upload(row["token"], stale_after=UPLOAD_SESSION_TTL)
+        except BlockingIOError:
+            pass  # A PATCH is writing to it right now
+    # Uploads another worker finished or cancelled
+    with get_db() as db:
+        live = {row["token"] for row in db.execute("SELECT token FROM uploads")}
+    for token in list(_upload_hashes):
+        if token not in live:
+            forget_upload(token)
+
+def finish_resumable_upload(session, part_path, digest, size):
+    """Move a completed resumable upload into place and record the paste"""
+    with get_db() as db:
+        stored = store_upload(db, part_path, session["original_filename"], digest.hexdigest())
+        paste_id = insert_file_paste(
+            db, session["content"], stored, session["original_filename"], size, digest.hexdigest(),
+            session["ttl"],
+        )
+        db.execute("DELETE FROM uploads WHERE token = ?", (session["token"],))
+    forget_upload(session["token"])
+    change_feed.notify()
+    row = {
+        "id": paste_id, "stored_filename": stored,
+        "original_filename": session["original_filename"], "content_hash": digest.hexdigest(),
+    }
+    thumbnails.schedule(row)
+    line_indexes.schedule(row)
+    return paste_id
+
+# ---------- Retention ----------
+def parse_ttl(value):
+    """Seconds from a TTL like '3600', '30m', '12h' or '7d'; None for no expiry.
+
+    Raises ValueError for anything else.
+    """
+    value = (value or "").strip().lower()
+    if not value or value == "0":
+        return None
+    unit = TTL_UNITS.get(value[-1])
+    seconds = int(value[:-1]) * unit if unit else int(value)
+    if seconds <= 0:
+        raise ValueError(f"Invalid TTL: {value}")
+    return seconds
+
+def ttl_modifier(ttl):
+    """SQLite datetime() modifier for a TTL; datetime('now', NULL) is NULL, i.e. never"""
+    return f"+{ttl} seconds" if ttl else None
+
+def storage_used():
+    """Bytes of stored files, from the trigger-maintained counter"""
+    with get_db() as db:
+        row = db.execute("SELECT value FROM counters WHERE name = 'storage_used'").fetchone()
+        return row["value"] if row else 0
+
+class AccessTracker:
+    """Remembers which file pastes were downloaded, for LRU eviction.
+
+    Downloads only touch memory; every worker writes accessed_at in one batch
+    at most once per ACCESS_FLUSH_INTERVAL, and a paste is written at most
+    once per ACCESS_TOUCH_INTERVAL.
+    """
+    
+    def __init__(self, interval=ACCESS_TOUCH_INTERVAL):
+        self.interval = interval
+        self._pending = set()
+        self._written = {}  # paste id -> monotonic time of the last write
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        
+    def touch(self, paste_id):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._written.get(paste_id, -self.interval) >= self.interval:
+                self._pending.add(paste_id)
+            due = self._pending and now - self._last_flush >= ACCESS_FLUSH_INTERVAL
+        if due:
+            self.flush()
+                
+    def flush(self):
+        """Write pending accesses; returns how many pastes were updated"""
+        now = time.monotonic()
+        with self._lock:
+            pending, self._pending = self._pending, set()
+            self._last_flush = now
+            for paste_id in pending:
+                self._written[paste_id] = now
+            # Forget entries old enough to be written again anyway
+            if len(self._written) > FILE_META_CACHE_SIZE:
+                self._written = {k: t for k, t in self._written.items() if now - t < self.interval}
+        if pending:
+            with get_db() as db:
+                db.executemany(
+                    "UPDATE pastes SET accessed_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    [(paste_id,) for paste_id in pending]
+                )
+        return len(pending)
+
+access_tracker = AccessTracker()
+
+class RetentionSweeper:
+    """Background thread that expires pastes and keeps stored files under quota.
+
+    Every pass deletes, in batches of RETENTION_BATCH through delete_pastes(),
+    pastes past their own TTL, pastes older than the global maximum age, and
+    then the oldest or least recently downloaded file pastes while storage
+    used exceeds the quota. Candidates come off indexes, and each batch is its
+    own short transaction.
+    """
+    
+    def __init__(self, interval=RETENTION_INTERVAL, batch_size=RETENTION_BATCH):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stop_event = threading.Event()
+        self._thread = None
+        
+    def start(self):
+        """Start the background sweeper thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="retention-sweeper", daemon=True)
+        self._thread.start()
+        logger.info(f"Retention sweeper started (batch {self.batch_size} every {self.interval}s)")
+        
+    def stop(self):
+        """Stop the background sweeper thread"""
+        if not self._thread:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout=5)
+        self._thread = None
+        
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Error during retention sweep: {e}")
+                
+    def sweep(self):
+        """One full pass; returns the number of pastes removed for each reason"""
+        access_tracker.flush()
+        removed = {
+            "expired": self._delete_matching(
+                "SELECT id FROM pastes WHERE expires_at <= CURRENT_TIMESTAMP ORDER BY expires_at LIMIT ?", ()
+            ),
+            "max_age": 0,
+            "quota": self._enforce_quota(),
+        }
+        max_age = get_max_age()
+        if max_age > 0:
+            removed["max_age"] = self._delete_matching(
+                "SELECT id FROM pastes WHERE created_at < datetime('now', ?) ORDER BY created_at, id LIMIT ?",
+                (f"-{max_age} seconds",)
+            )
+            removed["quota"] += self._enforce_quota()
+        if any(removed.values()):
+            logger.info(f"Retention sweep removed {removed}")
+        return removed
+        
+    def _delete_matching(self, query, params):
+        """Delete pastes returned by `query` a batch at a time until none are left"""
+        total = 0
+        while not self._stop_event.is_set():
+            with get_db() as db:
+                ids = [row["id"] for row in db.execute(query, params + (self.batch_size,))]
+            if not ids:
+                break
+            deleted, _ = delete_pastes(ids)
+            total += len(deleted)
+            if len(ids) < self.batch_size:
+                break
+        return total
+        
+    def _enforce_quota(self):
+        """Evict file pastes by the configured policy until storage used fits the quota"""
+        quota = get_storage_quota()
+        if quota <= 0:
+            return 0
+        order = "COALESCE(accessed_at, created_at), id" if get_eviction_policy() == "lru" else "created_at, id"
+        total = 0
+        while not self._stop_event.is_set():
+            excess = storage_used() - quota
+            if excess <= 0:
+                break
+            with get_db() as db:
+                rows = db.execute(
+                    f"SELECT id, file_size FROM pastes WHERE is_file = 1 ORDER BY {order} LIMIT ?",
+                    (self.batch_size,)
+                ).fetchall()
+            if not rows:
+                break
+            # Take only as many as should cover the excess
+            ids, freed = [], 0
+            for row in rows:
+                ids.append(row["id"])
+                freed += row["file_size"] or 0
+                if freed >= excess:
+                    break
+            deleted, _ = delete_pastes(ids)
+            if not deleted:
+                break
+            total += len(deleted)
+        return total
+
+def init_retention_sweeper():
+    """Initialize the background retention sweeper"""
+    global retention_sweeper
+    retention_sweeper = RetentionSweeper()
+    retention_sweeper.start()
+
+# ---------- Thumbnails ----------
+class ThumbnailCache:
+    """Generates card thumbnails off the request thread and keeps them on disk.
+
+    Images are scaled with Pillow, videos get a poster frame from ffmpeg; both
+    are optional and a missing tool just means no thumbnail. Files are keyed by
+    content hash when known (deduplicated uploads share one) and otherwise by
+    paste id. Past THUMB_CACHE_MAX_BYTES the least recently written are evicted.
+    """
+    
+    def __init__(self, folder=THUMB_FOLDER, workers=THUMB_WORKERS, max_bytes=THUMB_CACHE_MAX_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._workers = workers
+        self._pool = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._size = None  # bytes on disk, counted on first write
+        
+    @staticmethod
+    def kind(filename):
+        """'image', 'video' or None for files that get no thumbnail"""
+        name = (filename or "").lower()
+        if name.endswith(VIDEO_EXTENSIONS):
+            return "video" if FFMPEG else None
+        if Image is not None and is_image_filter(name) and not name.endswith(".svg"):
+            return "image"
+        return None
+    
+    def name_for(self, row):
+        """Cache filename of a paste's thumbnail, or None if it can't have one"""
+        kind = self.kind(row["original_filename"])
+        if kind is None:
+            return None
+        key = row["content_hash"] or f"paste{row['id']}"
+        return f"{key}.webp" if kind == "image" else f"{key}.jpg"
+    
+    def lookup(self, row):
+        """Name of the cached thumbnail if it already exists"""
+        name = self.name_for(row)
+        if name and os.path.exists(os.path.join(self.folder, name)):
+            return name
+        return None
+    
+    def schedule(self, row):
+        """Start generating a thumbnail in the background; returns a Future or None"""
+        name = self.name_for(row)
+        if name is None:
+            return None
+        with self._lock:
+            future = self._pending.get(name)
+            if future is None:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="thumbnail")
+                source = resolve_stored_path(row["stored_filename"])
+                future = self._pool.submit(self._generate, source, name, self.kind(row["original_filename"]))
+                future.add_done_callback(lambda _, name=name: self._forget(name))
+                self._pending[name] = future
+        return future
+    
+    def _forget(self, name):
+        with self._lock:
+            self._pending.pop(name, None)
+    
+    def _generate(self, source, name, kind):
+        target = os.path.join(self.folder, name)
+        if os.path.exists(target):
+            return name
+        os.makedirs(self.folder, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix=".thumb-", suffix=os.path.splitext(name)[1], dir=self.folder)
+        os.close(fd)
+        try:
+            if kind == "image":
+                self._render_image(source, temp_path)
+            else:
+                self._render_video(source, temp_path)
+            os.replace(temp_path, target)
+        except Exception as e:
+            logger.warning(f"Could not generate thumbnail for {os.path.basename(source)}: {e}")
+            return None
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self._account(os.path.getsize(target))
+        return name
+    
+    @staticmethod
+    def _render_image(source, target):
+        with Image.open(source) as img:
+            # JPEG can decode at a reduced scale, which is most of the saving
+            img.draft("RGB", (THUMB_SIZE[0] * 2, THUMB_SIZE[1] * 2))
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail(THUMB_SIZE)
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "transparency" in img.info or img.mode in ("LA", "PA") else "RGB")
+            img.save(target, "WEBP", quality=THUMB_QUALITY, method=4)
+    
+    @staticmethod
+    def _render_video(source, target):
+        width, height = THUMB_SIZE
+        subprocess.run(
+            [FFMPEG, "-nostdin", "-loglevel", "error", "-y", "-ss", "1", "-i", source,
+             "-frames:v", "1", "-vf", f"scale={width}:{height}:force_original_aspect_ratio=decrease",
+             "-q:v", "5", target],
+            check=True, timeout=60,
+        )
+        if not os.path.getsize(target):
+            raise ValueError("no frame decoded")  # Shorter than one second, most likely
+    
+    def _files(self):
+        """(mtime, size, path) of every thumbnail, skipping ones removed mid-scan.
+
+        Other workers evict from the same folder, and writes land by rename.
+        """
+        files = []
+        for entry in os.scandir(self.folder):
+            try:
+                if entry.is_file() and not entry.name.startswith("."):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+            except OSError:
+                continue
+        return files
+    
+    def _account(self, added):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._files())
+            else:
+                self._size += added
+            over = self._size > self.max_bytes
+        if over:
+            self.evict()
+    
+    def evict(self):
+        """Drop the oldest thumbnails until the cache is at 90% of its budget"""
+        entries = sorted(self._files())
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                size -= entry_size
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._size = size
+
+thumbnails = ThumbnailCache()
+
+# ---------- Text Previews ----------
+def build_line_index(path, stride=LINE_INDEX_STRIDE):
+    """(line count, newlines before each multiple of `stride`) of a file, in one read"""
+    checkpoints = array("q", [0])
+    newlines = 0
+    block = b""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(stride)
+            if not chunk:
+                break
+            block = chunk
+            newlines += block.count(b"\n")
+            checkpoints.append(newlines)
+    # A last line without a newline still counts
+    return newlines + (bool(block) and not block.endswith(b"\n")), checkpoints
+
+def line_offset(f, index, line, stride=LINE_INDEX_STRIDE):
+    """Byte offset where 0-based `line` starts, or None past the end; scans at most one stride"""
+    line_count, checkpoints = index
+    if line >= line_count:
+        return None
+    if line == 0:
+        return 0
+    # Last checkpoint with fewer newlines before it than needed: the one we want is in its stride
+    k = bisect_left(checkpoints, line) - 1
+    f.seek(k * stride)
+    block = f.read(stride)
+    pos = -1
+    for _ in range(line - checkpoints[k]):
+        pos = block.index(b"\n", pos + 1)
+    return k * stride + pos + 1
+
+class LineIndexes:
+    """Line indexes of large text files, built once in the background and kept in the database.
+
+    Stored files never change, so an index stays valid for the life of the
+    paste. Uploads schedule one right away; files under LINE_INDEX_MIN are
+    cheap enough to count on every request and are never stored.
+    """
+    
+    def __init__(self, stride=LINE_INDEX_STRIDE, workers=LINE_INDEX_WORKERS, cache_size=LINE_INDEX_CACHE):
+        self.stride = stride
+        self.cache_size = cache_size
+        self._workers = workers
+        self._pool = None
+        self._pending = {}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        
+    @staticmethod
+    def wants(filename):
+        """Whether a file is previewed as text"""
+        return (filename or "").lower().endswith(TEXT_PREVIEW_EXTENSIONS)
+    
+    def lookup(self, paste_id):
+        """The stored index of a paste, or None if it hasn't been built"""
+        with self._lock:
+            if paste_id in self._cache:
+                self._cache.move_to_end(paste_id)
+                return self._cache[paste_id]
+        with get_db() as db:
+            row = db.execute(
+                "SELECT line_count, checkpoints FROM line_indexes WHERE paste_id = ? AND stride = ?",
+                (paste_id, self.stride)
+            ).fetchone()
+        if not row:
+            return None
+        index = (row["line_count"], array("q", row["checkpoints"]))
+        self._remember(paste_id, index)
+        return index
+    
+    def get(self, paste_id, meta, wait=0):
+        """Index for a file paste: counted now if small, else stored, else built within `wait` seconds"""
+        if meta["size"] < LINE_INDEX_MIN:
+            return build_line_index(meta["path"], self.stride)
+        index = self.lookup(paste_id)
+        if index is None:
+            future = self.schedule({"id": paste_id, "stored_filename": meta["stored_filename"],
+                                    "original_filename": meta["original_filename"]})
+            if future and wait:
                 try:
-                    shutil.move(old_file, new_file)
-                    moved_count += 1
-                except Exception as e:
-                    error_count += 1
-                    errors.append(f"Failed to move {filename}: {str(e)}")
-    except Exception as e:
-        return {"success": False, "message": f"Failed to list files in old directory: {str(e)}"}
+                    index = future.result(timeout=wait)
+                except FutureTimeoutError:
+                    pass
+        return index
+    
+    def schedule(self, row):
+        """Start indexing a text file paste in the background; returns a Future or None"""
+        if not self.wants(row["original_filename"]):
+            return None
+        with self._lock:
+            future = self._pending.get(row["id"])
+            if future is None:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="line-index")
+                future = self._pool.submit(self._build, row["id"], row["stored_filename"])
+                future.add_done_callback(lambda _, paste_id=row["id"]: self._forget(paste_id))
+                self._pending[row["id"]] = future
+        return future
+    
+    def _forget(self, paste_id):
+        with self._lock:
+            self._pending.pop(paste_id, None)
+    
+    def _remember(self, paste_id, index):
+        with self._lock:
+            self._cache[paste_id] = index
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+    
+    def _build(self, paste_id, stored_filename):
+        index = self.lookup(paste_id)
+        if index is not None:
+            return index
+        path = resolve_stored_path(stored_filename)
+        try:
+            if os.path.getsize(path) < LINE_INDEX_MIN:
+                return None
+            started = time.monotonic()
+            line_count, checkpoints = build_line_index(path, self.stride)
+        except OSError as e:
+            logger.warning(f"Could not index lines of {stored_filename}: {e}")
+            return None
+        with get_db() as db:
+            # The paste may have been deleted while its file was being read
+            db.execute(
+                "INSERT OR REPLACE INTO line_indexes (paste_id, stride, line_count, checkpoints)"
+                " SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM pastes WHERE id = ?)",
+                (paste_id, self.stride, line_count, checkpoints.tobytes(), paste_id)
+            )
+        logger.info(f"Indexed {line_count} lines of {stored_filename} in {time.monotonic() - started:.1f}s")
+        index = (line_count, checkpoints)
+        self._remember(paste_id, index)
+        return index
+
+line_indexes = LineIndexes()
+
+def read_preview(path, size):
+    """Head and tail of a text file, cut at line boundaries, and whether it looks binary"""
+    with open(path, "rb") as f:
+        head = f.read(PREVIEW_HEAD_BYTES)
+        if b"\0" in head:
+            return None, None, True
+        if size <= PREVIEW_HEAD_BYTES + PREVIEW_TAIL_BYTES:
+            return (head + f.read()).decode("utf-8", "replace"), None, False
+        f.seek(size - PREVIEW_TAIL_BYTES)
+        tail = f.read(PREVIEW_TAIL_BYTES)
+    # Whole lines only, unless a single line fills the whole window
+    cut = head.rfind(b"\n")
+    head = head[:cut + 1] if cut >= 0 else head
+    cut = tail.find(b"\n")
+    tail = tail[cut + 1:] if 0 <= cut < len(tail) - 1 else tail
+    return head.decode("utf-8", "replace"), tail.decode("utf-8", "replace"), False
+
+def read_lines(path, index, line, count):
+    """Up to `count` lines from 0-based `line`, and whether PREVIEW_WINDOW_BYTES cut them short"""
+    with open(path, "rb") as f:
+        offset = line_offset(f, index, line)
+        if offset is None:
+            return [], False
+        f.seek(offset)
+        chunk = f.read(PREVIEW_WINDOW_BYTES + 1)
+    at_eof = len(chunk) <= PREVIEW_WINDOW_BYTES
+    lines = chunk[:PREVIEW_WINDOW_BYTES].split(b"\n")
+    if at_eof:
+        if lines[-1] == b"":
+            lines.pop()  # The file's final newline
+    elif len(lines) > 1:
+        lines.pop()  # Cut mid-line by the byte limit
+    return [piece.decode("utf-8", "replace") for piece in lines[:count]], not at_eof and len(lines) < count
+
+# ---------- File Serving ----------
+class FileMetaCache:
+    """Bounded LRU of paste id -> what is needed to serve its file.
+
+    Saves the row lookup and the NAS stat on the hot /file and /download
+    paths. Entries are dropped on local deletes and watcher events, and, for
+    deletes made by other worker processes, through the change feed.
+    """
+    
+    def __init__(self, max_entries=FILE_META_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._subscribed = False
+        
+    def get(self, paste_id):
+        """Metadata dict for a file paste, or None if the paste or its file is gone"""
+        folder = get_current_upload_folder()
+        with self._lock:
+            entry = self._entries.get(paste_id)
+            # A folder change in another worker makes the cached path stale
+            if entry is not None and entry["folder"] == folder:
+                self._entries.move_to_end(paste_id)
+                return entry
+        if not self._subscribed:
+            self._subscribed = True
+            change_feed.subscribe(self._on_changes)
+        
+        with get_db() as db:
+            row = db.execute(
+                "SELECT stored_filename, original_filename, content_hash"
+                " FROM pastes WHERE id=? AND is_file=1",
+                (paste_id,),
+            ).fetchone()
+        if not row:
+            return None
+        path = resolve_stored_path(row["stored_filename"])
+        try:
+            with timed_storage("stat"):
+                st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        mtype, _ = mimetypes.guess_type(row["original_filename"])
+        sharded = path == shard_path(folder, row["stored_filename"])
+        in_place = sharded or path == os.path.join(folder, row["stored_filename"])
+        entry = {
+            "folder": folder,
+            "in_place": in_place,
+            "stored_filename": row["stored_filename"],
+            "path": path,
+            "original_filename": row["original_filename"],
+            "mimetype": mtype or "application/octet-stream",
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+            # Files never change after upload, so the content hash is a strong validator
+            "etag": row["content_hash"] or f"{st.st_mtime_ns:x}-{st.st_size:x}",
+        }
+        if not sharded:
+            return entry  # Still to be migrated or re-laid out; don't pin that path
+        with self._lock:
+            self._entries[paste_id] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+    
+    def invalidate(self, paste_ids):
+        with self._lock:
+            for paste_id in paste_ids:
+                self._entries.pop(paste_id, None)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def _on_changes(self, changes):
+        self.invalidate([paste_id for _, paste_id, op in changes if op == "delete"])
+
+file_meta_cache = FileMetaCache()
+
+class FileCache:
+    """Read-through copies of served files on local disk, in front of the upload folder.
+
+    The first read of a file is served from the NAS while a background fill
+    copies it into CACHE_DIR; later reads, from any worker on the host, get
+    the local copy. Fills are written under a temp name and renamed into
+    place, so readers never see a partial file. An index database next to
+    the copies holds their size, last access and hit count for LRU or LFU
+    eviction past CACHE_MAX_BYTES; hits are counted in memory and written in
+    batches. Copies are dropped with deletes and watcher events, and are only
+    ever reached through a live paste row.
+    """
+    
+    def __init__(self, folder=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, policy=CACHE_POLICY, workers=CACHE_FILL_WORKERS):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_file = max_bytes // CACHE_MAX_FILE_SHARE
+        self.policy = policy if policy in ("lru", "lfu") else "lru"
+        self._workers = workers
+        self._pool = None
+        self._pending = set()
+        self._hits = {}  # stored filename -> hits not yet written
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        
+    @property
+    def enabled(self):
+        return bool(self.folder)
+    
+    def _db(self):
+        """This thread's connection to the cache index, shared by every worker on the host"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(self.folder, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.folder, "index.db"), timeout=DB_BUSY_TIMEOUT)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    stored_filename TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 1
+                )
+                """
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+    
+    def path_for(self, stored_filename, source, size=None):
+        """Where to read a stored file from: the local copy if there is one, else `source`.
+
+        A miss queues a fill, so the next read is local.
+        """
+        if not self.enabled:
+            return source
+        if size is not None and not 0 < size <= self.max_file:
+            FILE_CACHE_REQUESTS.inc(result="bypass")
+            return source
+        local = shard_path(self.folder, stored_filename)
+        try:
+            cached_size = os.stat(local).st_size
+            hit = size is None or cached_size == size
+        except OSError:
+            hit = False
+        if hit:
+            FILE_CACHE_REQUESTS.inc(result="hit")
+            self._touch(stored_filename)
+            return local
+        FILE_CACHE_REQUESTS.inc(result="miss")
+        self.schedule(stored_filename, source)
+        return source
+    
+    def schedule(self, stored_filename, source):
+        """Copy a file into the cache in the background, unless it is already on its way"""
+        with self._lock:
+            if stored_filename in self._pending or len(self._pending) >= CACHE_FILL_QUEUE:
+                return
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="file-cache")
+            self._pending.add(stored_filename)
+        future = self._pool.submit(self._fill, stored_filename, source)
+        future.add_done_callback(lambda _: self._forget(stored_filename))
+        
+    def _forget(self, stored_filename):
+        with self._lock:
+            self._pending.discard(stored_filename)
+            
+    def _touch(self, stored_filename):
+        now = time.monotonic()
+        with self._lock:
+            self._hits[stored_filename] = self._hits.get(stored_filename, 0) + 1
+            due = now - self._last_flush >= CACHE_FLUSH_INTERVAL
+        if due:
+            self.flush()
+            
+    def flush(self):
+        """Write the hits counted since the last flush"""
+        with self._lock:
+            hits, self._hits = self._hits, {}
+            self._last_flush = time.monotonic()
+        if hits:
+            now = time.time()
+            with self._db() as db:
+                db.executemany(
+                    "UPDATE entries SET hits = hits + ?, last_access = ? WHERE stored_filename = ?",
+                    [(count, now, name) for name, count in hits.items()]
+                )
+        return len(hits)
+    
+    def _fill(self, stored_filename, source):
+        dest = shard_path(self.folder, stored_filename)
+        try:
+            size = os.path.getsize(source)
+            if not 0 < size <= self.max_file:
+                return
+            with contextlib.suppress(FileNotFoundError):
+                if os.path.getsize(dest) == size:
+                    return  # Filled by another worker meanwhile
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(prefix=".fill-", dir=os.path.dirname(dest))
+            try:
+                with os.fdopen(fd, "wb") as out, open(source, "rb") as src, timed_storage("cache_fill"):
+                    shutil.copyfileobj(src, out, MIGRATION_CHUNK)
+                if os.path.getsize(temp_path) != size:
+                    raise OSError("file changed while it was copied")
+                os.replace(temp_path, dest)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        except OSError as e:
+            logger.warning(f"Could not cache {stored_filename}: {e}")
+            return
+        STORAGE_BYTES.inc(size, op="cache_fill")
+        with self._db() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO entries (stored_filename, size, last_access, hits) VALUES (?, ?, ?, 1)",
+                (stored_filename, size, time.time())
+            )
+        self.evict()
+        
+    def evict(self):
+        """Drop copies until the cache is at 90% of its budget; returns how many went"""
+        self.flush()
+        db = self._db()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            used = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if used <= self.max_bytes:
+                return 0
+            # LFU ages the counts on every round so yesterday's favourite can leave
+            order = "hits, last_access" if self.policy == "lfu" else "last_access"
+            victims = []
+            for row in db.execute(f"SELECT stored_filename, size FROM entries ORDER BY {order}"):
+                if used <= self.max_bytes * 0.9:
+                    break
+                victims.append(row["stored_filename"])
+                used -= row["size"]
+            db.executemany("DELETE FROM entries WHERE stored_filename = ?", [(name,) for name in victims])
+            if self.policy == "lfu":
+                db.execute("UPDATE entries SET hits = hits / 2")
+        # Readers that already opened a copy keep reading it; later ones miss
+        self._remove_copies(victims)
+        FILE_CACHE_EVICTIONS.inc(len(victims))
+        return len(victims)
+    
+    def discard(self, stored_filenames):
+        """Drop the copies of files that were deleted or went missing"""
+        stored_filenames = list(stored_filenames)
+        if not self.enabled or not stored_filenames:
+            return
+        with self._db() as db:
+            db.executemany(
+                "DELETE FROM entries WHERE stored_filename = ?", [(name,) for name in stored_filenames]
+            )
+        self._remove_copies(stored_filenames)
+        
+    def _remove_copies(self, stored_filenames):
+        for name in stored_filenames:
+            try:
+                os.remove(shard_path(self.folder, name))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not remove cached copy of {name}: {e}")
+                
+    def usage(self):
+        """(entries, bytes) across every worker on the host"""
+        if not self.enabled:
+            return 0, 0
+        with self._db() as db:
+            row = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return row[0], row[1]
+
+file_cache = FileCache()
+
+def content_disposition(disposition, filename):
+    """Content-Disposition value with an ASCII fallback and an RFC 5987 UTF-8 name"""
+    try:
+        filename.encode("ascii")
+        return f'{disposition}; filename="{filename}"'
+    except UnicodeEncodeError:
+        fallback = filename.encode("ascii", "ignore").decode() or "download"
+        return f'{disposition}; filename="{fallback}"; filename*=UTF-8\'\'{quote(filename, safe="")}'
+
+def serve_paste_file(paste_id, as_attachment, retry=True):
+    """Response for a file paste, offloaded to the proxy when SENDFILE_MODE is set"""
+    meta = file_meta_cache.get(paste_id)
+    if meta is None:
+        abort(404)
+    access_tracker.touch(paste_id)
+    # With X-Accel-Redirect the proxy reads the upload folder itself
+    if SENDFILE_MODE == "x-accel-redirect" and meta["in_place"]:
+        path = meta["path"]
+    else:
+        path = file_cache.path_for(meta["stored_filename"], meta["path"], meta["size"])
     
-    message = f"Migration completed. Moved {moved_count} files."
-    if error_count > 0:
-        message += f" {error_count} files failed to move."
+    # The proxy only knows the current upload folder
+    if not SENDFILE_MODE or not meta["in_place"]:
+        started = time.perf_counter()
+        try:
+            with timed_storage("open"):
+                response = send_file(
+                    path,
+                    mimetype=meta["mimetype"],
+                    as_attachment=as_attachment,
+                    download_name=meta["original_filename"],
+                    etag=meta["etag"],
+                    last_modified=meta["mtime"],
+                    max_age=FILE_MAX_AGE,
+                )
+        except FileNotFoundError:
+            # Removed, re-laid out or evicted since it was cached; look it up once more
+            file_meta_cache.invalidate([paste_id])
+            if retry:
+                return serve_paste_file(paste_id, as_attachment, retry=False)
+            abort(404)
+        # Time the body until the last byte is handed over. A server's own
+        # wsgi.file_wrapper (sendfile) is left unwrapped so it keeps working.
+        if response.direct_passthrough and "wsgi.file_wrapper" not in request.environ:
+            response.response = ClosingIterator(
+                response.response, lambda: STORAGE_SECONDS.observe(time.perf_counter() - started, op="send")
+            )
+        return response
     
-    return {
-        "success": True,
-        "message": message,
-        "moved_count": moved_count,
-        "error_count": error_count,
-        "errors": errors
-    }
+    # The proxy sends the bytes (and handles Range); validators and 304s stay here
+    response = Response(status=200, mimetype=meta["mimetype"])
+    if SENDFILE_MODE == "x-accel-redirect":
+        relative = quote(os.path.relpath(meta["path"], meta["folder"]).replace(os.sep, "/"))
+        response.headers["X-Accel-Redirect"] = ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + relative
+    else:
+        response.headers["X-Sendfile"] = path
+    response.headers["Content-Disposition"] = content_disposition(
+        "attachment" if as_attachment else "inline", meta["original_filename"]
+    )
+    response.headers["Accept-Ranges"] = "bytes"
+    response.set_etag(meta["etag"])
+    response.last_modified = meta["mtime"]
+    response.cache_control.public = True
+    response.cache_control.max_age = FILE_MAX_AGE
+    return response.make_conditional(request)
 
 # ---------- Routes ----------
 @app.route("/", methods=["GET"])
@@ -313,97 +3481,309 @@ def index():
         return render_template("welcome.html")
     
     # Regular index logic
-    page = max(int(request.args.get("page", 1)), 1)
+    page = max(request.args.get("page", 1, type=int), 1)
     q    = request.args.get("q", "").strip()
+    sort = request.args.get("sort", "newest")
     start_date = request.args.get("start_date", "").strip()
     end_date = request.args.get("end_date", "").strip()
+    before = decode_page_cursor(request.args.get("before"))
+    after = decode_page_cursor(request.args.get("after"))
 
     where, params = "", []
     conditions = []
+    source = "pastes"
+    columns = LISTING_COLUMNS
+    order = "created_at DESC, pastes.id DESC"
     
     if q:
-        conditions.append("(content LIKE ? OR original_filename LIKE ?)")
-        like = f"%{q}%"
-        params.extend([like, like])
+        match = build_fts_query(q) if fts_enabled else ""
+        if match:
+            source = "pastes_fts JOIN pastes ON pastes.id = pastes_fts.rowid"
+            columns = (
+                f"{LISTING_COLUMNS}, substr(snippet(pastes_fts, -1, ?, ?, '…', 16), 1, {2 * PREVIEW_CHARS})"
+                " AS match_snippet"
+            )
+            conditions.append("pastes_fts MATCH ?")
+            params.append(match)
+            if sort == "relevance":
+                order = "rank"
+        else:
+            conditions.append(
+                "(content LIKE ? OR original_filename LIKE ?"
+                " OR pastes.id IN (SELECT paste_id FROM paste_bodies WHERE inflate_text(body) LIKE ?))"
+            )
+            like = f"%{q}%"
+            params.extend([like, like, like])
     
-    if start_date:
-        conditions.append("DATE(created_at) >= ?")
-        params.append(start_date)
+    # Half-open ranges on the raw column so idx_pastes_created_at applies
+    start = parse_date_arg(start_date)
+    if start:
+        conditions.append("created_at >= ?")
+        params.append(start.isoformat())
     
-    if end_date:
-        conditions.append("DATE(created_at) <= ?")
-        params.append(end_date)
+    end = parse_date_arg(end_date)
+    if end:
+        conditions.append("created_at < ?")
+        params.append((end + timedelta(days=1)).isoformat())
     
     if conditions:
         where = "WHERE " + " AND ".join(conditions)
 
-    offset = (page - 1) * PAGE_SIZE
+    # Keyset pagination: seek past the (created_at, id) of the previous page's
+    # edge instead of skipping rows. Plain ?page=N links still use OFFSET.
+    keyset = order != "rank" and (before or after)
+    page_conditions, page_params = list(conditions), list(params)
+    offset = 0 if keyset else (page - 1) * PAGE_SIZE
+    if keyset and before:
+        page_conditions.append("(created_at, pastes.id) < (?, ?)")
+        page_params.extend(before)
+    elif keyset:
+        page_conditions.append("(created_at, pastes.id) > (?, ?)")
+        page_params.extend(after)
+        order = "created_at ASC, pastes.id ASC"
+    page_where = "WHERE " + " AND ".join(page_conditions) if page_conditions else ""
+
+    column_params = [SNIPPET_OPEN, SNIPPET_CLOSE] if "match_snippet" in columns else []
     with get_db() as db:
-        total  = db.execute(f"SELECT COUNT(*) FROM pastes {where}", params).fetchone()[0]
+        # Nothing inserted or deleted since the browser's copy: skip the queries and templates
+        # (If-Modified-Since is not honoured: two changes can share a second)
+        change_cursor, etag, last_modified = listing_validators(db)
+        if request.if_none_match.contains_weak(etag):
+            return listing_response(Response(status=304), etag, last_modified)
+        total, total_is_estimate = count_pastes(db, source, where, params)
         pastes = db.execute(
-            f"""SELECT * FROM pastes
-                {where}
-                ORDER BY created_at DESC
+            f"""SELECT {columns} FROM {source}
+                {page_where}
+                ORDER BY {order}
                 LIMIT ? OFFSET ?""",
-            params + [PAGE_SIZE, offset],
+            column_params + page_params + [PAGE_SIZE + 1, offset],
         ).fetchall()
 
-    last_page = max(ceil(total / PAGE_SIZE), 1)
+    # One extra row tells whether there is anything beyond this page
+    has_more = len(pastes) > PAGE_SIZE
+    pastes = pastes[:PAGE_SIZE]
+    if keyset and after:
+        pastes.reverse()
+        has_prev, has_next = has_more, True
+        if not has_more:
+            page = 1
+    else:
+        has_prev, has_next = page > 1, has_more
+
+    last_page = max(ceil(total / PAGE_SIZE), page, 1)
+
+    link_args = {
+        "q": q or None,
+        "start_date": start_date or None,
+        "end_date": end_date or None,
+        "sort": sort if sort != "newest" else None,
+    }
+    prev_url = next_url = None
+    if has_prev:
+        prev_args = dict(link_args, page=page - 1)
+        if order != "rank" and page > 2 and pastes:
+            prev_args["after"] = encode_page_cursor(pastes[0])
+        prev_url = url_for("index", **prev_args)
+    if has_next:
+        next_args = dict(link_args, page=page + 1)
+        if order != "rank" and pastes:
+            next_args["before"] = encode_page_cursor(pastes[-1])
+        next_url = url_for("index", **next_args)
+
+    pagination = dict(
+        page=page,
+        last_page=last_page,
+        total=total,
+        total_is_estimate=total_is_estimate,
+        prev_url=prev_url,
+        next_url=next_url,
+    )
 
     # ---------- AJAX (partial) ----------
     if request.args.get("partial") == "1":
-        return jsonify(
+        return listing_response(jsonify(
             list=render_template("_pastes.html", pastes=pastes),
-            pagination=render_template(
-                "_pagination.html", page=page, last_page=last_page, q=q
-            ),
-        )
+            pagination=render_template("_pagination.html", **pagination),
+            cursor=change_cursor,
+            total=total,
+            total_is_estimate=total_is_estimate,
+            prev_url=prev_url,
+            next_url=next_url,
+        ), etag, last_modified)
 
-    return render_template(
+    return listing_response(Response(render_template(
         "index.html",
         pastes=pastes,
-        page=page,
-        last_page=last_page,
         q=q,
-    )
+        sort=sort,
+        change_cursor=change_cursor,
+        page_size=PAGE_SIZE,
+        **pagination,
+    ), mimetype="text/html"), etag, last_modified)
+
+def listing_response(response, etag, last_modified):
+    """Attach the listing validators; browsers revalidate on every load"""
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 @app.route("/paste", methods=["POST"])
 def paste():
     text = request.form.get("content", "").strip()
     files = request.files.getlist("files")
+    try:
+        ttl = parse_ttl(request.form.get("ttl"))
+    except ValueError:
+        abort(400)
     
     current_upload_folder = get_current_upload_folder()
     os.makedirs(current_upload_folder, exist_ok=True)
 
+    new_files = []
     with get_db() as db:
         # Handle multiple file uploads
         if files and any(f.filename for f in files):
             for upload in files:
                 if upload and upload.filename:
                     original = secure_filename(upload.filename)
-                    ts = datetime.now().strftime("%Y%m%d%H%M%S%f")
-                    stored = f"{ts}_{original}"
-                    file_path = os.path.join(current_upload_folder, stored)
-                    upload.save(file_path)
-                    
-                    # Get file size
-                    file_size = os.path.getsize(file_path)
+                    spool = upload.stream
+                    if isinstance(spool, UploadSpool):
+                        # Already on the destination filesystem: rename, no copy
+                        spool.flush()
+                        file_size, content_hash = spool.size, spool.hash.hexdigest()
+                        stored = store_upload(db, spool.path, original, content_hash)
+                    else:
+                        ts = datetime.now().strftime("%Y%m%d%H%M%S%f")
+                        stored = f"{ts}_{original}"
+                        file_path = shard_path(current_upload_folder, stored)
+                        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                        upload.save(file_path)
+                        file_size, content_hash = os.path.getsize(file_path), None
                     
                     # Store with optional text content and file size
-                    db.execute(
-                        "INSERT INTO pastes (content, stored_filename, original_filename, is_file, file_size)"
-                        " VALUES (?,?,?,1,?)",
-                        (text if text else None, stored, original, file_size),
-                    )
+                    paste_id = insert_file_paste(db, text, stored, original, file_size, content_hash, ttl)
+                    new_files.append({
+                        "id": paste_id, "stored_filename": stored,
+                        "original_filename": original, "content_hash": content_hash,
+                    })
         elif text:
             # Text-only paste
-            db.execute(
-                "INSERT INTO pastes (content, is_file, file_size) VALUES (?,0,?)",
-                (text, len(text.encode('utf-8'))),
-            )
+            insert_text_paste(db, text, ttl)
+    change_feed.notify()
+    # Thumbnails are usually ready by the time the page reloads
+    for row in new_files:
+        thumbnails.schedule(row)
+        line_indexes.schedule(row)
     
     return redirect(url_for("index"))
 
+@app.route("/uploads", methods=["POST"])
+def create_upload():
+    """Start a resumable upload (tus-style).
+
+    Expects Upload-Length and an Upload-Metadata header carrying `filename`
+    and optional `content` and `ttl`. The body is then sent with PATCH requests; a client
+    whose connection drops asks HEAD for the offset and continues from there.
+    """
+    upload_length = request.headers.get("Upload-Length", type=int)
+    if upload_length is None or upload_length < 0:
+        return jsonify(success=False, message="Upload-Length is required"), 400
+    metadata = parse_upload_metadata(request.headers.get("Upload-Metadata"))
+    original = secure_filename(metadata.get("filename", ""))
+    if not original:
+        return jsonify(success=False, message="A filename is required"), 400
+    try:
+        ttl = parse_ttl(metadata.get("ttl"))
+    except ValueError:
+        return jsonify(success=False, message="Invalid ttl"), 400
+    
+    expire_stale_uploads()
+    token = base64.urlsafe_b64encode(os.urandom(18)).decode()
+    part_path = upload_part_path(token)
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    open(part_path, "wb").close()
+    session = {
+        "token": token, "original_filename": original,
+        "content": metadata.get("content", "").strip(), "ttl": ttl,
+    }
+    with get_db() as db:
+        db.execute(
+            "INSERT INTO uploads (token, original_filename, content, upload_length, ttl) VALUES (?,?,?,?,?)",
+            (token, original, session["content"], upload_length, ttl),
+        )
+    
+    headers = {"Location": url_for("upload_offset", token=token), "Upload-Offset": "0"}
+    if upload_length == 0:
+        headers["X-Paste-Id"] = str(finish_resumable_upload(session, part_path, hashlib.sha256(), 0))
+    return ("", 201, headers)
+
+@app.route("/uploads/<token>", methods=["HEAD"])
+def upload_offset(token):
+    """Report how many bytes of a resumable upload the server has"""
+    with get_db() as db:
+        session = db.execute("SELECT upload_length FROM uploads WHERE token = ?", (token,)).fetchone()
+    part_path = upload_part_path(token)
+    if not session or not os.path.exists(part_path):
+        abort(404)
+    return ("", 200, {
+        "Upload-Offset": str(os.path.getsize(part_path)),
+        "Upload-Length": str(session["upload_length"]),
+        "Cache-Control": "no-store",
+    })
+
+@app.route("/uploads/<token>", methods=["PATCH"])
+def upload_chunk(token):
+    """Append the request body to a resumable upload at Upload-Offset"""
+    if request.mimetype != "application/offset+octet-stream":
+        return jsonify(success=False, message="Content-Type must be application/offset+octet-stream"), 415
+    client_offset = request.headers.get("Upload-Offset", type=int)
+    
+    with locked_upload_part(token) as part:
+        if part is None:
+            abort(404)
+        with get_db() as db:
+            session = db.execute("SELECT * FROM uploads WHERE token = ?", (token,)).fetchone()
+            db.execute("UPDATE uploads SET updated_at = CURRENT_TIMESTAMP WHERE token = ?", (token,))
+        if not session:
+            abort(404)
+        part_path = upload_part_path(token)
+        
+        offset = part.tell()
+        if client_offset != offset:
+            return ("", 409, {"Upload-Offset": str(offset)})
+        
+        digest = _upload_hash(token, part_path, offset)
+        remaining = session["upload_length"] - offset
+        try:
+            while remaining > 0:
+                chunk = request.stream.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                with timed_storage("save"):
+                    part.write(chunk)
+                STORAGE_BYTES.inc(len(chunk), op="save")
+                digest.update(chunk)
+                offset += len(chunk)
+                remaining -= len(chunk)
+        finally:
+            # Whatever reached the disk counts, even if the client went away
+            part.flush()
+            _upload_hashes[token] = (offset, digest)
+        
+        headers = {"Upload-Offset": str(offset)}
+        if remaining == 0:
+            headers["X-Paste-Id"] = str(finish_resumable_upload(session, part_path, digest, offset))
+    return ("", 204, headers)
+
+@app.route("/uploads/<token>", methods=["DELETE"])
+def cancel_upload(token):
+    """Abandon a resumable upload and discard what was received"""
+    discard_upload(token)
+    return ("", 204)
+
 @app.route("/admin/cleanup", methods=["POST"])
 def manual_cleanup():
     """Manual cleanup of orphaned database entries"""
@@ -420,13 +3800,20 @@ def manual_cleanup():
             "message": f"Cleanup failed: {str(e)}"
         }), 500
 
-@app.route("/admin/check-files", methods=["POST"])
+@app.route("/admin/check-files", methods=["GET", "POST"])
 def check_files():
-    """Periodic check for missing files"""
+    """Periodic check for missing files.
+
+    The watcher and the background sweep do the actual file checks, so a poll
+    only compares the client's last seen deletion generation with the current one.
+    """
     try:
-        cleanup_count = cleanup_orphaned_entries()
+        generation = get_deletion_generation()
+        since = request.args.get("since", type=int)
+        cleanup_count = generation - since if since is not None and generation > since else 0
         return jsonify({
             "success": True,
+            "generation": generation,
             "cleanup_count": cleanup_count,
             "message": f"Found {cleanup_count} missing files" if cleanup_count > 0 else "All files present"
         })
@@ -436,123 +3823,300 @@ def check_files():
             "message": f"Check failed: {str(e)}"
         }), 500
 
+@app.route("/changes", methods=["GET"])
+def changes():
+    """Long-poll for paste inserts/deletes after the `since` cursor"""
+    since = request.args.get("since", 0, type=int)
+    timeout = min(max(request.args.get("timeout", 25, type=int), 0), 60)
+    change_feed.ensure_started()
+    changes, cursor, reset = change_feed.changes_since(since, timeout)
+    return jsonify(success=True, cursor=cursor, changes=changes, reset=reset)
+
+@app.route("/changes/stream", methods=["GET"])
+def changes_stream():
+    """Server-Sent Events stream of paste inserts/deletes.
+
+    Each event carries its cursor as the SSE id, so a reconnecting browser
+    resumes from Last-Event-ID. Streams end after CHANGE_STREAM_MAX_AGE to
+    free the worker; EventSource reconnects on its own.
+    """
+    since = request.headers.get("Last-Event-ID", type=int)
+    if since is None:
+        since = request.args.get("since", type=int)
+    change_feed.ensure_started()
+    
+    def generate(since):
+        if since is None:
+            since = change_feed.cursor
+        yield f"retry: 2000\nid: {since}\nevent: hello\ndata: {json.dumps({'cursor': since})}\n\n"
+        deadline = time.monotonic() + CHANGE_STREAM_MAX_AGE
+        while time.monotonic() < deadline:
+            changes, cursor, reset = change_feed.changes_since(since, 15)
+            if reset:
+                yield f"id: {cursor}\nevent: reset\ndata: {json.dumps({'cursor': cursor})}\n\n"
+            elif changes:
+                yield f"id: {cursor}\nevent: changes\ndata: {json.dumps(changes)}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+            since = cursor
+    
+    return Response(
+        generate(since),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.route("/cards", methods=["GET"])
+def cards():
+    """Rendered cards for the given paste ids, used to patch the list in place"""
+    try:
+        paste_ids = [int(i) for i in request.args.get("ids", "").split(",") if i][:PAGE_SIZE]
+    except ValueError:
+        abort(400)
+    if not paste_ids:
+        return jsonify(cards={})
+    
+    placeholders = ",".join("?" * len(paste_ids))
+    with get_db() as db:
+        pastes = db.execute(
+            f"SELECT {LISTING_COLUMNS} FROM pastes WHERE id IN ({placeholders})", paste_ids
+        ).fetchall()
+    return jsonify(cards={
+        p["id"]: render_template("_paste_card.html", p=p) for p in pastes
+    })
+
+@app.route("/raw/<int:paste_id>")
+def raw(paste_id):
+    """Full text of a paste (or a file paste's note), fetched when it is opened or copied"""
+    # Bodies never change, so the id is a valid validator; existence is checked
+    # first so a revalidation doesn't read the body at all
+    etag = f"paste-{paste_id}"
+    with get_db() as db:
+        if not db.execute("SELECT 1 FROM pastes WHERE id=?", (paste_id,)).fetchone():
+            abort(404)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            row = db.execute("SELECT content FROM pastes WHERE id=?", (paste_id,)).fetchone()
+            # Large bodies are decompressed as they are sent
+            response = Response(paste_text_chunks(db, paste_id, row["content"]), mimetype="text/plain")
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    response.cache_control.private = True
+    return response
+
 @app.route("/file/<int:paste_id>")
 def file_inline(paste_id):
-    with get_db() as db:
-        row = db.execute(
-            "SELECT stored_filename, original_filename"
-            " FROM pastes WHERE id=? AND is_file=1",
-            (paste_id,),
-        ).fetchone()
-    if not row:
+    return serve_paste_file(paste_id, as_attachment=False)
+
+@app.route("/preview/<int:paste_id>")
+def preview(paste_id):
+    """Bounded look into a text file: its head and tail, or `?line=N&count=M` (1-based)"""
+    meta = file_meta_cache.get(paste_id)
+    if meta is None:
         abort(404)
-    
-    # Use current upload folder instead of config
-    current_upload_folder = get_current_upload_folder()
-    file_path = os.path.join(current_upload_folder, row["stored_filename"])
-    
-    # Check if file exists
-    if not os.path.exists(file_path):
+    line = request.args.get("line", type=int)
+    try:
+        if line is None:
+            head, tail, binary = read_preview(meta["path"], meta["size"])
+            # Don't hold the request for a big file's line count; it is usually indexed at upload
+            index = None if binary else line_indexes.get(paste_id, meta)
+            result = {"head": head, "tail": tail, "binary": binary, "truncated": tail is not None}
+        else:
+            count = min(max(request.args.get("count", 200, type=int), 1), PREVIEW_MAX_LINES)
+            if meta["size"] >= LINE_INDEX_MIN and not line_indexes.wants(meta["original_filename"]):
+                # Large files are only indexed for text types; waiting would never end
+                return jsonify(success=False, message="Line windows are only available for text files"), 415
+            index = line_indexes.get(paste_id, meta, wait=LINE_INDEX_WAIT)
+            if index is None:
+                response = jsonify(success=False, indexing=True, message="The file is still being indexed")
+                response.headers["Retry-After"] = "2"
+                return response, 503
+            lines, cut = read_lines(meta["path"], index, max(line, 1) - 1, count)
+            result = {"line": max(line, 1), "text": "\n".join(lines), "count": len(lines), "truncated": cut}
+    except FileNotFoundError:
+        file_meta_cache.invalidate([paste_id])
         abort(404)
-    
-    mtype, _ = mimetypes.guess_type(row["original_filename"])
-    return send_from_directory(
-        current_upload_folder,
-        row["stored_filename"],
-        mimetype=mtype or "application/octet-stream",
-        as_attachment=False,
-        download_name=row["original_filename"],
-    )
+    response = jsonify(success=True, size=meta["size"], lines=index[0] if index else None, **result)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
-@app.route("/download/<int:paste_id>")
-def download(paste_id):
+@app.route("/thumb/<int:paste_id>")
+def thumbnail(paste_id):
+    """Small preview for the card grid, generated on upload or on first request"""
     with get_db() as db:
         row = db.execute(
-            "SELECT stored_filename, original_filename"
+            "SELECT id, stored_filename, original_filename, content_hash"
             " FROM pastes WHERE id=? AND is_file=1",
             (paste_id,),
         ).fetchone()
     if not row:
         abort(404)
     
-    # Use current upload folder instead of config
-    current_upload_folder = get_current_upload_folder()
-    file_path = os.path.join(current_upload_folder, row["stored_filename"])
-    
-    # Check if file exists
-    if not os.path.exists(file_path):
+    name = thumbnails.lookup(row)
+    if name is None:
+        future = thumbnails.schedule(row)
+        try:
+            name = future.result(timeout=THUMB_WAIT) if future else None
+        except FutureTimeoutError:
+            name = None
+    if name is None:
+        # No thumbnail possible (or not yet): images fall back to the original
+        if is_image_filter(row["original_filename"]):
+            return redirect(url_for("file_inline", paste_id=paste_id))
         abort(404)
     
-    return send_from_directory(
-        current_upload_folder,
-        row["stored_filename"],
-        as_attachment=True,
-        download_name=row["original_filename"],
-    )
+    response = send_from_directory(thumbnails.folder, name, max_age=THUMB_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route("/download/<int:paste_id>")
+def download(paste_id):
+    return serve_paste_file(paste_id, as_attachment=True)
 
 @app.route("/delete/<int:paste_id>", methods=["POST"])
 def delete_paste(paste_id):
-    current_upload_folder = get_current_upload_folder()
-    
-    with get_db() as db:
-        row = db.execute(
-            "SELECT stored_filename, is_file FROM pastes WHERE id=?", (paste_id,)
-        ).fetchone()
-        if not row:
-            abort(404)
-        if row["is_file"]:
-            try:
-                file_path = os.path.join(current_upload_folder, row["stored_filename"])
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-            except FileNotFoundError:
-                pass
-        db.execute("DELETE FROM pastes WHERE id=?", (paste_id,))
+    deleted, _ = delete_pastes([paste_id])
+    if not deleted:
+        abort(404)
 
     # 204 = No Content → JS removes list item.
     if request.headers.get("X-Requested-With") == "XMLHttpRequest":
         return ("", 204)
     return redirect(url_for("index"))
 
+class ZipStream:
+    """Write-only sink for zipfile.ZipFile that hands out what was written so far.
+
+    It has no tell()/seek(), so ZipFile writes data descriptors after each
+    member instead of seeking back, which is what lets the archive be sent
+    while it is being built.
+    """
+    
+    def __init__(self):
+        self._chunks = []
+        
+    def write(self, data):
+        if data:
+            self._chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def unique_archive_name(name, used):
+    """Avoid duplicate member names, which most unzip tools silently overwrite"""
+    candidate, n = name, 1
+    stem, ext = os.path.splitext(name)
+    while candidate in used:
+        n += 1
+        candidate = f"{stem} ({n}){ext}"
+    used.add(candidate)
+    return candidate
+
+def stream_zip(rows):
+    """Yield a ZIP archive of the given paste rows chunk by chunk, in constant memory"""
+    started = time.perf_counter()
+    for data in _stream_zip(rows):
+        STORAGE_BYTES.inc(len(data), op="bulk_download")
+        yield data
+    BULK_DOWNLOAD_SECONDS.observe(time.perf_counter() - started)
+
+def _stream_zip(rows):
+    sink = ZipStream()
+    used = set()
+    with zipfile.ZipFile(sink, "w", allowZip64=True) as archive:
+        for row in rows:
+            if row["is_file"]:
+                file_path = file_cache.path_for(
+                    row["stored_filename"], resolve_stored_path(row["stored_filename"]), row["file_size"] or None
+                )
+                try:
+                    source = open(file_path, "rb")
+                except FileNotFoundError:
+                    # Evicted from the local cache just now, or missing (the reconciler drops the row)
+                    try:
+                        source = open(resolve_stored_path(row["stored_filename"]), "rb")
+                    except OSError:
+                        continue
+                except OSError:
+                    continue
+                with source:
+                    st = os.fstat(source.fileno())
+                    info = zipfile.ZipInfo(
+                        unique_archive_name(row["original_filename"], used),
+                        date_time=time.localtime(st.st_mtime)[:6],
+                    )
+                    info.file_size = st.st_size  # lets ZipFile pick ZIP64 up front for big members
+                    ext = os.path.splitext(row["original_filename"])[1].lower()
+                    info.compress_type = zipfile.ZIP_STORED if ext in ZIP_STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+                    with archive.open(info, "w") as dest:
+                        for chunk in iter(lambda: source.read(ZIP_STREAM_CHUNK), b""):
+                            dest.write(chunk)
+                            data = sink.drain()
+                            if data:
+                                yield data
+            else:
+                info = zipfile.ZipInfo(unique_archive_name(f"paste_{row['id']}.txt", used), date_time=time.localtime()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with archive.open(info, "w") as dest:
+                    for chunk in paste_text_chunks(get_db(), row["id"], row["content"]):
+                        dest.write(chunk)
+                        data = sink.drain()
+                        if data:
+                            yield data
+            data = sink.drain()
+            if data:
+                yield data
+    # The central directory, written when the archive closes
+    data = sink.drain()
+    if data:
+        yield data
+
 @app.route("/bulk-download", methods=["POST"])
 def bulk_download():
-    paste_ids = request.json.get("ids", [])
+    # JSON from scripts; a plain form POST from the page so the browser streams it to disk
+    if request.is_json:
+        raw_ids = request.json.get("ids", [])
+    else:
+        raw_ids = request.form.getlist("ids")
+    paste_ids = []
+    for value in raw_ids:
+        try:
+            paste_ids.append(int(value))
+        except (TypeError, ValueError):
+            continue
     if not paste_ids:
         abort(400)
     
-    current_upload_folder = get_current_upload_folder()
-    zip_buffer = io.BytesIO()
+    with get_db() as db:
+        placeholders = ",".join("?" * len(paste_ids))
+        found = {
+            row["id"]: row for row in db.execute(
+                "SELECT id, content, stored_filename, original_filename, is_file, file_size"
+                f" FROM pastes WHERE id IN ({placeholders})",
+                paste_ids
+            )
+        }
+    # Keep the order the ids were selected in
+    rows = [found[paste_id] for paste_id in dict.fromkeys(paste_ids) if paste_id in found]
     
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        with get_db() as db:
-            for paste_id in paste_ids:
-                row = db.execute(
-                    "SELECT content, stored_filename, original_filename, is_file"
-                    " FROM pastes WHERE id=?",
-                    (paste_id,)
-                ).fetchone()
-                
-                if not row:
-                    continue
-                    
-                if row["is_file"]:
-                    file_path = os.path.join(current_upload_folder, row["stored_filename"])
-                    if os.path.exists(file_path):
-                        zip_file.write(file_path, row["original_filename"])
-                else:
-                    zip_file.writestr(f"paste_{paste_id}.txt", row["content"])
-    
-    zip_buffer.seek(0)
     filename = f"pastebin_bulk_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
-    
-    response = send_file(
-        zip_buffer,
-        as_attachment=True,
-        download_name=filename,
-        mimetype="application/zip"
+    return Response(
+        stream_zip(rows),
+        mimetype="application/zip",
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "X-Accel-Buffering": "no",  # let a fronting nginx pass chunks straight through
+        },
     )
-    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
-    return response
 
 @app.route("/bulk-delete", methods=["POST"])
 def bulk_delete():
@@ -560,54 +4124,58 @@ def bulk_delete():
     if not paste_ids:
         return jsonify(success=False, message="No IDs provided"), 400
     
-    deleted_count = 0
     errors = []
-    
-    current_upload_folder = get_current_upload_folder()
+    valid_ids = []
+    for paste_id_str in paste_ids:
+        try:
+            valid_ids.append(int(paste_id_str)) # Ensure it's an integer
+        except (TypeError, ValueError):
+            errors.append(f"Invalid Paste ID format: {paste_id_str}")
 
     try:
-        with get_db() as db:
-            for paste_id_str in paste_ids:
-                try:
-                    paste_id = int(paste_id_str) # Ensure it's an integer
-                    row = db.execute(
-                        "SELECT stored_filename, is_file FROM pastes WHERE id=?", (paste_id,)
-                    ).fetchone()
-                    
-                    if not row:
-                        errors.append(f"Paste ID {paste_id} not found.")
-                        continue
-
-                    if row["is_file"] and row["stored_filename"]:
-                        try:
-                            file_path = os.path.join(current_upload_folder, row["stored_filename"])
-                            if os.path.exists(file_path):
-                                os.remove(file_path)
-                        except OSError as e:
-                            logger.error(f"Error deleting file {row['stored_filename']} for paste {paste_id}: {e}")
-                            errors.append(f"Error deleting file for paste ID {paste_id}.")
-                    
-                    db.execute("DELETE FROM pastes WHERE id=?", (paste_id,))
-                    deleted_count += 1
-                except ValueError:
-                    errors.append(f"Invalid Paste ID format: {paste_id_str}")
-                except Exception as e:
-                    logger.error(f"Error deleting paste {paste_id_str}: {e}")
-                    errors.append(f"Error processing paste ID {paste_id_str}.")
-            
-            db.commit()
-
-        if deleted_count > 0:
-            message = f"Successfully deleted {deleted_count} items."
-            if errors:
-                message += f" {len(errors)} items had errors."
-            return jsonify(success=True, message=message, deleted_count=deleted_count, errors=errors)
-        else:
-            return jsonify(success=False, message="No items were deleted.", errors=errors), 400
-            
+        deleted, failed_files = delete_pastes(valid_ids)
     except Exception as e:
         logger.error(f"Bulk delete error: {e}")
         return jsonify(success=False, message=f"Database error: {str(e)}"), 500
+    
+    errors.extend(f"Paste ID {paste_id} not found." for paste_id in dict.fromkeys(valid_ids) if paste_id not in deleted)
+    # The rows are gone either way; the files are retried in the background
+    errors.extend(
+        f"Error deleting file for paste ID {paste_id}."
+        for paste_id, stored in deleted.items() if stored in failed_files
+    )
+    deleted_count = len(deleted)
+
+    if deleted_count > 0:
+        message = f"Successfully deleted {deleted_count} items."
+        if errors:
+            message += f" {len(errors)} items had errors."
+        return jsonify(success=True, message=message, deleted_count=deleted_count, errors=errors)
+    else:
+        return jsonify(success=False, message="No items were deleted.", errors=errors), 400
+
+# ---------- Metrics endpoint ----------
+def read_counter(name):
+    with get_db() as db:
+        row = db.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row["value"] if row else 0
+
+def pending_unlink_count():
+    with get_db() as db:
+        return db.execute("SELECT COUNT(*) FROM pending_unlinks").fetchone()[0]
+
+metrics.register(Gauge("pastebin_pastes", "Pastes stored", lambda: read_counter("paste_count")))
+metrics.register(Gauge("pastebin_storage_used_bytes", "Bytes of stored files", lambda: read_counter("storage_used")))
+metrics.register(Gauge("pastebin_pending_unlinks", "Files queued for removal", pending_unlink_count))
+metrics.register(Gauge("pastebin_file_cache_bytes", "Bytes of local file cache copies on this host",
+                       lambda: file_cache.usage()[1]))
+metrics.register(Gauge("pastebin_file_meta_cache_entries", "Entries in the /file metadata cache",
+                       lambda: len(file_meta_cache._entries)))
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """This worker's metrics in the Prometheus text exposition format"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 # ---------- Settings ----------
 @app.route("/settings", methods=["GET"])
@@ -617,7 +4185,183 @@ def settings():
     
     return jsonify({
         "current_path": current_path,
-        "is_first_time": is_first_time_setup()
+        "is_first_time": is_first_time_setup(),
+        "dedupe_uploads": is_dedupe_enabled(),
+        "ingest_files": is_ingest_enabled(),
+        "retention": retention_settings(),
+    })
+
+@app.route("/settings/dedupe", methods=["POST"])
+def update_dedupe_setting():
+    """Turn content-addressed storage for new uploads on or off"""
+    data = request.get_json(silent=True) or {}
+    enabled = bool(data.get("enabled"))
+    set_setting("dedupe_uploads", "true" if enabled else "false")
+    return jsonify({"success": True, "dedupe_uploads": enabled})
+
+@app.route("/settings/ingest", methods=["POST"])
+def update_ingest_setting():
+    """Turn registering files copied into the upload folder on or off"""
+    data = request.get_json(silent=True) or {}
+    enabled = bool(data.get("enabled"))
+    set_setting("ingest_files", "true" if enabled else "false")
+    return jsonify({"success": True, "ingest_files": enabled})
+
+def retention_settings():
+    return {
+        "max_age": get_max_age(),
+        "storage_quota": get_storage_quota(),
+        "eviction_policy": get_eviction_policy(),
+        "storage_used": storage_used(),
+    }
+
+@app.route("/settings/retention", methods=["POST"])
+def update_retention_settings():
+    """Set the global maximum age (seconds or e.g. '30d'), the storage quota
+    in bytes and the eviction policy; 0 turns the age limit or the quota off"""
+    data = request.get_json(silent=True) or {}
+    updates = {}
+    try:
+        if "max_age" in data:
+            updates["max_age"] = str(parse_ttl(str(data["max_age"])) or 0)
+        if "storage_quota" in data:
+            quota = int(data["storage_quota"] or 0)
+            if quota < 0:
+                raise ValueError(quota)
+            updates["storage_quota"] = str(quota)
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "message": "max_age and storage_quota must be non-negative"}), 400
+    if "eviction_policy" in data:
+        if data["eviction_policy"] not in EVICTION_POLICIES:
+            return jsonify({"success": False, "message": "eviction_policy must be 'oldest' or 'lru'"}), 400
+        updates["eviction_policy"] = data["eviction_policy"]
+    
+    for key, value in updates.items():
+        set_setting(key, value)
+    return jsonify({"success": True, "retention": retention_settings()})
+
+class TTLCache:
+    """Small thread-safe cache whose entries expire after `ttl` seconds"""
+    
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > time.monotonic():
+                return entry[0]
+            self._entries.pop(key, None)
+            return None
+    
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+_browse_listings = TTLCache(BROWSE_CACHE_TTL, BROWSE_CACHE_ENTRIES)
+_browse_details = TTLCache(BROWSE_CACHE_TTL, BROWSE_CACHE_ENTRIES * 16)
+_browse_pending = {}
+_browse_lock = threading.RLock()
+_browse_pool = None
+
+def list_subdirectories(path):
+    """Sorted names of the directories in `path` (non-hidden first), from one scandir pass.
+
+    scandir's d_type answers is_dir() without a stat per entry on local and
+    NFS/SMB filesystems that report it.
+    """
+    names = _browse_listings.get(path)
+    if names is None:
+        with os.scandir(path) as entries:
+            names = [entry.name for entry in entries if _is_dir(entry)]
+        names.sort(key=lambda name: (name.startswith("."), name.lower()))
+        _browse_listings.set(path, names)
+    return names
+
+def _is_dir(entry):
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
+def probe_directory(item_path):
+    """Permissions and whether a directory has subdirectories, stopping at the first one"""
+    name = os.path.basename(item_path)
+    try:
+        readable = os.access(item_path, os.R_OK)
+        writable = os.access(item_path, os.W_OK)
+    except OSError:
+        return {"path": item_path, "type": "directory", "writable": False, "readable": False,
+                "hidden": name.startswith("."), "error": True, "has_subdirs": False}
+    has_subdirs = False
+    if readable:
+        try:
+            with os.scandir(item_path) as entries:
+                for seen, entry in enumerate(entries):
+                    if _is_dir(entry) or seen >= BROWSE_PROBE_LIMIT:
+                        has_subdirs = True
+                        break
+        except OSError:
+            # If we can't read the directory, assume it might have subdirs
+            has_subdirs = True
+    return {"path": item_path, "type": "directory", "writable": writable, "readable": readable,
+            "hidden": name.startswith("."), "error": False, "has_subdirs": has_subdirs}
+
+def directory_details(paths, budget=BROWSE_DETAIL_BUDGET):
+    """Details for each path, probing uncached ones in parallel for at most `budget` seconds.
+
+    Probes that don't finish in time keep running and land in the cache; their
+    items are returned as optimistic placeholders marked pending.
+    """
+    global _browse_pool
+    results, futures = {}, {}
+    with _browse_lock:
+        for item_path in paths:
+            cached = _browse_details.get(item_path)
+            if cached is not None:
+                results[item_path] = cached
+                continue
+            future = _browse_pending.get(item_path)
+            if future is None:
+                if _browse_pool is None:
+                    _browse_pool = ThreadPoolExecutor(max_workers=BROWSE_WORKERS, thread_name_prefix="browse")
+                future = _browse_pool.submit(probe_directory, item_path)
+                _browse_pending[item_path] = future
+                # Runs right here if the probe already finished, hence the RLock
+                future.add_done_callback(lambda f, item_path=item_path: _store_probe(item_path, f))
+            futures[item_path] = future
+    
+    deadline = time.monotonic() + budget
+    for item_path, future in futures.items():
+        try:
+            results[item_path] = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            name = os.path.basename(item_path)
+            results[item_path] = {"path": item_path, "type": "directory", "writable": False, "readable": True,
+                                  "hidden": name.startswith("."), "error": False, "has_subdirs": True,
+                                  "pending": True}
+    return results
+
+def _store_probe(item_path, future):
+    with _browse_lock:
+        _browse_pending.pop(item_path, None)
+    if not future.exception():
+        _browse_details.set(item_path, future.result())
+
+@app.route("/settings/browse/details", methods=["POST"])
+def browse_details():
+    """Details of directories a listing returned as pending"""
+    paths = (request.get_json(silent=True) or {}).get("paths", [])[:BROWSE_PAGE_SIZE]
+    details = directory_details(paths, budget=5)
+    return jsonify({
+        "success": True,
+        "items": [dict(details[p], name=os.path.basename(p.rstrip(os.sep)) or p) for p in paths],
     })
 
 @app.route("/settings/browse", methods=["POST"])
@@ -625,6 +4369,10 @@ def browse_directory():
     """Browse directory structure with full filesystem access"""
     data = request.get_json()
     path = data.get("path", "").strip()
+    try:
+        offset = max(int(data.get("offset") or 0), 0)
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "message": "offset must be a number"}), 400
     
     # If no path provided, start from appropriate root based on OS
     if not path:
@@ -692,69 +4440,28 @@ def browse_directory():
         
         # List directories only (for cleaner interface)
         try:
-            all_items = []
-            
-            for item in os.listdir(path):
-                item_path = os.path.join(path, item)
-                try:
-                    if os.path.isdir(item_path):
-                        is_hidden = item.startswith('.')
-                        writable = os.access(item_path, os.W_OK)
-                        readable = os.access(item_path, os.R_OK)
-                        
-                        # Check if this directory has subdirectories
-                        has_subdirs = False
-                        if readable:
-                            try:
-                                for subitem in os.listdir(item_path):
-                                    subitem_path = os.path.join(item_path, subitem)
-                                    if os.path.isdir(subitem_path):
-                                        has_subdirs = True
-                                        break
-                            except (PermissionError, OSError):
-                                # If we can't read the directory, assume it might have subdirs
-                                has_subdirs = True
-                        
-                        all_items.append({
-                            "name": item,
-                            "path": item_path,
-                            "type": "directory",
-                            "writable": writable,
-                            "readable": readable,
-                            "hidden": is_hidden,
-                            "has_subdirs": has_subdirs,
-                            "error": False
-                        })
-                        
-                except (PermissionError, OSError):
-                    # Add directory even if we can't check permissions
-                    all_items.append({
-                        "name": item,
-                        "path": item_path,
-                        "type": "directory",
-                        "writable": False,
-                        "readable": False,
-                        "hidden": item.startswith('.'),
-                        "error": True,
-                        "has_subdirs": False  # Can't determine, assume no subdirs
-                    })
-            
-            # Sort items: non-hidden directories first, then by name
-            all_items.sort(key=lambda x: (x["hidden"], x["name"].lower()))
-            items = all_items
-            
+            names = list_subdirectories(path)
         except PermissionError:
             return jsonify({
                 "success": False, 
                 "message": "Permission denied to access this directory"
             }), 403
         
+        page = names[offset:offset + BROWSE_PAGE_SIZE]
+        details = directory_details([os.path.join(path, name) for name in page])
+        items = [dict(details[os.path.join(path, name)], name=name) for name in page]
+        next_offset = offset + BROWSE_PAGE_SIZE if offset + BROWSE_PAGE_SIZE < len(names) else None
+        
         return jsonify({
             "success": True,
             "items": items,
             "current_path": path,
             "parent_path": parent_path,
-            "current_writable": os.access(path, os.W_OK)
+            "current_writable": os.access(path, os.W_OK),
+            "total": len(names),
+            "next_offset": next_offset,
+            # Still being probed; fetch them from /settings/browse/details
+            "pending": [item["path"] for item in items if item.get("pending")]
         })
         
     except Exception as e:
@@ -782,61 +4489,268 @@ def update_upload_folder_route():
         return jsonify({"success": False, "message": "Directory is not writable"}), 400
     
     current_path = get_current_upload_folder()
+    if active_migration():
+        return jsonify({"success": False, "message": "A file migration is still running"}), 409
+    source = unfinished_migration_source()
+    if source and current_path != new_path:
+        return jsonify({
+            "success": False,
+            "message": f"Some files of the last migration are still in {source}. "
+                       "Retry the migration before changing the folder again.",
+        }), 409
     
-    # If path is different, migrate files (only if not setup)
-    migration_result = {"success": True, "message": "No files to migrate"}
+    # If path is different, migrate files in the background (only if not setup)
+    migration_id = None
+    migration_message = "No files to migrate"
     if not is_setup and current_path != new_path and os.path.exists(current_path):
-        migration_result = migrate_files(current_path, new_path)
-        if not migration_result["success"]:
-            return jsonify(migration_result), 500
+        migration_id = start_migration(current_path, new_path, verify=bool(data.get("verify")))
+        migration_message = "Files are being moved in the background."
     
     # Update the path in database (this will also restart the file watcher)
-    update_upload_folder(new_path)
+    if not migration_id:
+        update_upload_folder(new_path)
     
     # Update the app config
     app.config['UPLOAD_FOLDER'] = new_path
     
-    # Clean up any orphaned entries after path change
-    cleanup_count = cleanup_orphaned_entries()
+    # Orphaned entries are left to the reconciler: checking every file here
+    # would stat the whole share inside the request, and race the mover
     
     # Mark setup as complete if this is initial setup
     if is_setup:
         complete_setup()
     
-    message = f"Upload folder updated successfully. {migration_result['message']}"
-    if cleanup_count > 0:
-        message += f" Cleaned up {cleanup_count} orphaned entries."
-    
     return jsonify({
         "success": True,
-        "message": message,
-        "migration_details": migration_result,
-        "cleanup_count": cleanup_count
-    })
+        "message": f"Upload folder updated successfully. {migration_message}",
+        "migration_id": migration_id,
+    }), 202 if migration_id else 200
+
+@app.route("/settings/migration", methods=["GET"])
+def migration_status():
+    """Progress of the most recent upload-folder migration"""
+    with get_db() as db:
+        job = db.execute("SELECT * FROM migrations ORDER BY id DESC LIMIT 1").fetchone()
+    if not job:
+        return jsonify({"migration": None})
+    with get_db() as db:
+        errors = db.execute(
+            "SELECT filename, error FROM migration_files"
+            " WHERE migration_id = ? AND state = 'failed' LIMIT 20",
+            (job["id"],)
+        ).fetchall()
+    return jsonify({"migration": {
+        "id": job["id"],
+        "source": job["source"],
+        "dest": job["dest"],
+        "status": job["status"],
+        "message": job["message"],
+        "verify": bool(job["verify"]),
+        **migration_progress(job["id"]),
+        "errors": [dict(row) for row in errors],
+    }})
+
+@app.route("/settings/migration/retry", methods=["POST"])
+def retry_migration():
+    """Retry the files a finished migration could not move"""
+    if active_migration():
+        return jsonify({"success": False, "message": "A file migration is still running"}), 409
+    with get_db() as db:
+        job = db.execute("SELECT id FROM migrations WHERE status = 'failed' ORDER BY id DESC LIMIT 1").fetchone()
+        if not job:
+            return jsonify({"success": False, "message": "No failed migration to retry"}), 404
+        db.execute(
+            "UPDATE migration_files SET state = 'pending', error = NULL WHERE migration_id = ? AND state = 'failed'",
+            (job["id"],)
+        )
+        # Rescan too: the scan is idempotent and may be what failed
+        db.execute(
+            "UPDATE migrations SET status = 'scanning', message = NULL, finished_at = NULL WHERE id = ?",
+            (job["id"],)
+        )
+    FolderMigration(job["id"]).start()
+    return jsonify({"success": True, "migration_id": job["id"]}), 202
 
-# Initialize services when app context is created
-def init_app_services():
-    """Initialize services that need to run once"""
-    if not hasattr(app, '_services_initialized'):
+# ---------- Startup ----------
+@contextlib.contextmanager
+def host_lock(path):
+    """Hold an exclusive lock on `path` across the processes of this host"""
+    with open(path, "a") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def check_schema_version(version):
+    """Refuse a database whose schema is newer than this code"""
+    if version > SCHEMA_VERSION:
+        message = (
+            f"{DB_PATH} has schema version {version}, newer than the {SCHEMA_VERSION} this version"
+            " of the app knows; not starting, to leave it intact. Upgrade the app, or restore a backup."
+        )
+        logger.error(message)
+        raise RuntimeError(message)
+
+def ensure_schema():
+    """Create or upgrade the schema once per host.
+
+    The first process to see an old PRAGMA user_version runs init_db() under
+    INIT_LOCK_PATH while the others wait; afterwards it is a single lookup.
+    A database written by a newer version (e.g. after rolling a deploy back)
+    is left alone and the app refuses to start on it.
+    """
+    global fts_enabled
+    with get_db() as db:
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+    check_schema_version(version)
+    if version < SCHEMA_VERSION:
+        with host_lock(INIT_LOCK_PATH):
+            with get_db() as db:
+                version = db.execute("PRAGMA user_version").fetchone()[0]
+            check_schema_version(version)
+            if version < SCHEMA_VERSION:
+                started = time.perf_counter()
+                init_db()
+                with get_db() as db:
+                    db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                logger.info(f"Database schema set up in {time.perf_counter() - started:.2f}s")
+                return
+    with get_db() as db:
+        fts_enabled = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'pastes_fts'").fetchone() is not None
+
+class ServiceLeader:
+    """Runs the per-host background services in exactly one process.
+
+    Every process polls a non-blocking lock on SERVICES_LOCK_PATH; the holder
+    starts the file watcher, the missing-file reconciler and the retention
+    sweeper, resumes an interrupted migration and drains queued unlinks. The
+    OS releases the lock when the leader exits, and another process takes over
+    within LEADER_RETRY seconds.
+    """
+    
+    def __init__(self, lock_path=SERVICES_LOCK_PATH, interval=LEADER_RETRY):
+        self.lock_path = lock_path
+        self.interval = interval
+        self._lock_file = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        
+    @property
+    def is_leader(self):
+        return self._lock_file is not None
+        
+    def start(self):
+        """Start competing for the services in a background thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.run, name="service-leader", daemon=True)
+        self._thread.start()
+        
+    def stop(self):
+        """Stop the services if this process runs them, and release the lock"""
+        self._stop_event.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=10)
+        self._thread = None
+        
+    def run(self):
+        """Take the lead when possible and keep the services in step; blocks until stop()"""
+        try:
+            while True:
+                if not self.is_leader and self._try_acquire():
+                    self._start_services()
+                elif self.is_leader:
+                    self._follow_upload_folder()
+                if self._stop_event.wait(self.interval):
+                    break
+        finally:
+            if self.is_leader:
+                self._stop_services()
+            
+    def _try_acquire(self):
+        lock_file = open(self.lock_path, "a")
+        if fcntl:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+        self._lock_file = lock_file
+        return True
+        
+    def _start_services(self):
+        logger.info(f"Process {os.getpid()} runs the background services")
         init_file_watcher()
-        # Perform initial cleanup
-        cleanup_count = cleanup_orphaned_entries()
-        if cleanup_count > 0:
-            logger.info(f"Startup cleanup: removed {cleanup_count} orphaned entries")
-        app._services_initialized = True
+        init_reconciler()
+        init_ingester()
+        init_retention_sweeper()
+        resume_migration()
+        drain_pending_unlinks()
+        
+    def _follow_upload_folder(self):
+        """Point the watcher at a folder another worker switched to"""
+        folder = get_current_upload_folder()
+        if file_watcher and file_watcher.watch_path != folder:
+            file_watcher.restart(folder)
+            
+    def _stop_services(self):
+        for service in (file_watcher, reconciler, ingester, retention_sweeper):
+            if service:
+                service.stop()
+        self._lock_file.close()
+        self._lock_file = None
+
+service_leader = ServiceLeader()
+_ready = False
+_ready_lock = threading.Lock()
+_startup_timings = {}
 
-# Use app context to initialize services
-with app.app_context():
-    init_app_services()
+@app.before_request
+def ensure_app_ready():
+    """Finish startup on the first request, so importing the app stays cheap"""
+    global _ready
+    if _ready:
+        return
+    with _ready_lock:
+        if _ready:
+            return
+        ensure_schema()
+        if SERVICES_MODE != "off":
+            service_leader.start()
+        _startup_timings["ready"] = time.perf_counter() - IMPORT_STARTED
+        _ready = True
+    if _startup_timings["ready"] > STARTUP_BUDGET:
+        logger.warning(
+            f"Worker {os.getpid()} took {_startup_timings['ready']:.2f}s to start,"
+            f" over the {STARTUP_BUDGET}s budget"
+        )
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create or upgrade the database schema (e.g. as a deploy step)."""
+    ensure_schema()
+
+@app.cli.command("run-services")
+def run_services_command():
+    """Run the watcher and background sweeps in the foreground; pair with PASTEBIN_SERVICES=off for the workers."""
+    ensure_schema()
+    try:
+        service_leader.run()
+    except KeyboardInterrupt:
+        pass
+
+_startup_timings["import"] = time.perf_counter() - IMPORT_STARTED
+metrics.register(Gauge("pastebin_import_seconds", "Time to import the app module",
+                       lambda: _startup_timings["import"]))
+metrics.register(Gauge("pastebin_ready_seconds", "Time from import to the first request being served",
+                       lambda: _startup_timings.get("ready", 0)))
 
 # Cleanup on app shutdown
 import atexit
 
 def shutdown_handler():
-    """Clean shutdown of file watcher"""
-    global file_watcher
-    if file_watcher:
-        file_watcher.stop()
+    """Clean shutdown of the background services"""
+    service_leader.stop()
 
 atexit.register(shutdown_handler)
 
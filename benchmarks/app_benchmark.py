@@ -0,0 +1,411 @@
+"""Load-test the pastebin end to end against a synthetic database and upload folder.
+
+Generates a pastes.db with a mix of text and file pastes (files are sparse, so
+millions of them cost little disk) in a work directory, points the app at it
+through PASTEBIN_DB / PASTEBIN_UPLOAD_FOLDER and drives the real routes, either
+through Flask's test client or over HTTP against a local threaded server.
+Prints p50/p99 latency and throughput per scenario, and the whole run as JSON.
+
+    python benchmarks/app_benchmark.py --rows 100000 --workdir /dev/shm/pb-bench
+    python benchmarks/app_benchmark.py --rows 1000000 --http --concurrency 8 --large-mb 4096 --json run.json
+
+The work directory is reused when it already holds a database, so repeated runs
+compare like with like; --bulk-delete removes rows from it.
+"""
+import argparse
+import base64
+import http.client
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VOCABULARY_SIZE = 20000
+INSERT_BATCH = 10000
+
+
+def app_environment(workdir):
+    return {
+        "PASTEBIN_DB": os.path.join(workdir, "pastes.db"),
+        "PASTEBIN_UPLOAD_FOLDER": os.path.join(workdir, "files"),
+        "PASTEBIN_THUMB_DIR": os.path.join(workdir, "thumbnails"),
+    }
+
+
+def make_vocabulary(rng):
+    """Pseudo-words sampled with Zipf weights, as in search_benchmark.py"""
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 10))))
+    words = sorted(words, key=lambda w: rng.random())
+    weights = [1 / rank for rank in range(1, VOCABULARY_SIZE + 1)]
+    return words, weights
+
+
+def populate(app, rows, file_ratio, days, rng, words, weights):
+    """Insert `rows` pastes spread over the last `days` days, oldest first"""
+    folder = app.get_current_upload_folder()
+    os.makedirs(folder, exist_ok=True)
+    start = datetime.utcnow() - timedelta(days=days)
+    step = timedelta(days=days) / max(rows, 1)
+    text_sql = "INSERT INTO pastes (content, is_file, file_size, created_at) VALUES (?,0,?,?)"
+    file_sql = (
+        "INSERT INTO pastes (content, stored_filename, original_filename, is_file, file_size, created_at)"
+        " VALUES (?,?,?,1,?,?)"
+    )
+    texts, files = [], []
+
+    def flush():
+        with app.get_db() as db:
+            db.executemany(text_sql, texts)
+            db.executemany(file_sql, files)
+        texts.clear()
+        files.clear()
+
+    for i in range(rows):
+        created = (start + step * i).strftime("%Y-%m-%d %H:%M:%S")
+        if rng.random() < file_ratio:
+            name = f"{rng.choices(words, weights)[0]}_{i}.{rng.choice(['log', 'png', 'zip', 'txt', 'mp4'])}"
+            stored = f"{created.replace('-', '').replace(' ', '').replace(':', '')}{i:06d}_{name}"
+            size = int(rng.lognormvariate(10, 2)) + 1  # median ~22 KB, long tail
+            path = app.shard_path(folder, stored)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.truncate(size)  # sparse: realistic sizes without the disk use
+            files.append((None, stored, name, size, created))
+        else:
+            body = " ".join(rng.choices(words, weights, k=rng.randint(20, 200)))
+            texts.append((body, len(body), created))
+        if len(texts) + len(files) >= INSERT_BATCH:
+            flush()
+    flush()
+
+
+class RepeatingStream:
+    """Seekable file-like body of `size` bytes made of one random block, for big uploads"""
+
+    def __init__(self, size, block=os.urandom(1024 * 1024)):
+        self.size = size
+        self.position = 0
+        self.block = block
+
+    def read(self, n=-1):
+        remaining = self.size - self.position
+        n = remaining if n is None or n < 0 else min(n, remaining)
+        n = min(n, len(self.block))
+        self.position += n
+        return self.block[:n]
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        self.position = (0, self.position, self.size)[whence] + offset
+        return self.position
+
+
+class TestClientDriver:
+    """Requests through Flask's test client, one client per thread"""
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        kwargs = {"method": method, "headers": headers or {}, "buffered": False}
+        if hasattr(body, "read"):
+            kwargs["input_stream"] = body
+        elif body is not None:
+            kwargs["data"] = body
+        response = client.open(path, **kwargs)
+        received = sum(len(chunk) for chunk in response.response)
+        response.close()
+        return response.status_code, response.headers, received
+
+
+class HttpDriver:
+    """Requests over HTTP/1.1 keep-alive connections, one per thread"""
+
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=600)
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        received = 0
+        for chunk in iter(lambda: response.read(1024 * 1024), b""):
+            received += len(chunk)
+        return response.status, response.headers, received
+
+
+def start_local_server(app):
+    from werkzeug.serving import make_server
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_scenario(name, requests, concurrency, expect=(200,)):
+    """Run callables returning (status, bytes); returns latency percentiles and throughput"""
+    latencies, moved, errors = [], 0, 0
+    lock = threading.Lock()
+
+    def one(make_request):
+        nonlocal moved, errors
+        started = time.perf_counter()
+        status, nbytes = make_request()
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            moved += nbytes
+            errors += status not in expect
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, requests))
+    wall = time.perf_counter() - started
+    latencies.sort()
+    result = {
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "throughput_rps": len(latencies) / wall,
+        "mb_per_s": moved / wall / 1e6,
+    }
+    print(
+        f"{name:>18}: p50 {result['p50_ms']:9.2f} ms  p99 {result['p99_ms']:9.2f} ms  "
+        f"{result['throughput_rps']:9.1f} req/s  {result['mb_per_s']:8.1f} MB/s"
+        + (f"  ({errors} errors)" if errors else "")
+    )
+    return result
+
+
+def upload(driver, size, name):
+    """Send one file through the resumable upload API, as the page does"""
+    metadata = "filename " + base64.b64encode(name.encode()).decode()
+    status, headers, _ = driver.request("POST", "/uploads", headers={
+        "Upload-Length": str(size), "Upload-Metadata": metadata, "Content-Length": "0",
+    })
+    if status != 201:
+        return status, 0
+    location = headers["Location"]
+    location = location[location.index("/uploads/"):]
+    offset, chunk = 0, 8 * 1024 * 1024
+    while offset < size:
+        length = min(chunk, size - offset)
+        status, headers, _ = driver.request("PATCH", location, body=RepeatingStream(length), headers={
+            "Upload-Offset": str(offset), "Content-Length": str(length),
+            "Content-Type": "application/offset+octet-stream",
+        })
+        if status != 204:
+            return status, offset
+        offset += length
+    return 204, size
+
+
+STARTUP_PROBE = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.app.test_client().get("/admin/check-files")
+print(json.dumps([imported - started, time.perf_counter() - started]))
+"""
+
+
+def measure_startup(env, repeat):
+    """Cold start of a worker process: `import app`, then its first request.
+
+    The benchmark process itself already holds the services, so this measures a
+    follower worker, which is what most of a multi-worker server's processes are.
+    """
+    imports, first_requests = [], []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_PROBE], cwd=REPO_ROOT, env={**os.environ, **env},
+            check=True, capture_output=True, text=True,
+        ).stdout
+        imported, ready = json.loads(output.strip().splitlines()[-1])
+        imports.append(imported)
+        first_requests.append(ready)
+    return {
+        "import_p50_ms": statistics.median(imports) * 1000,
+        "first_request_p50_ms": statistics.median(first_requests) * 1000,
+        "first_request_max_ms": max(first_requests) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000, help="pastes to generate (10k to 10M)")
+    parser.add_argument("--file-ratio", type=float, default=0.2, help="share of file pastes")
+    parser.add_argument("--days", type=int, default=365, help="spread created_at over this many days")
+    parser.add_argument("--workdir", help="database and upload folder (default: a new temp dir)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--requests", type=int, default=200, help="requests per read scenario")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--http", action="store_true", help="go through a local threaded HTTP server")
+    parser.add_argument("--large-mb", type=int, default=256, help="size of the large-upload scenario")
+    parser.add_argument("--bulk-size", type=int, default=50, help="ids per bulk download / delete")
+    parser.add_argument("--bulk-delete", action="store_true", help="also run /bulk-delete (removes rows)")
+    parser.add_argument("--startup-repeat", type=int, default=3)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="pastebin-bench-")
+    env = app_environment(workdir)
+    os.environ.update(env)
+    os.makedirs(workdir, exist_ok=True)
+    fresh = not os.path.exists(env["PASTEBIN_DB"])
+    sys.path.insert(0, REPO_ROOT)
+    import app as pastebin
+
+    pastebin.ensure_schema()
+    rng = random.Random(args.seed)
+    words, weights = make_vocabulary(rng)
+    if fresh:
+        pastebin.set_setting("upload_folder", env["PASTEBIN_UPLOAD_FOLDER"])
+        pastebin.complete_setup()
+        started = time.perf_counter()
+        populate(pastebin, args.rows, args.file_ratio, args.days, rng, words, weights)
+        print(f"generated {args.rows} pastes in {time.perf_counter() - started:.1f}s under {workdir}")
+
+    with pastebin.get_db() as db:
+        total = db.execute("SELECT COUNT(*) FROM pastes").fetchone()[0]
+        file_ids = [row[0] for row in db.execute("SELECT id FROM pastes WHERE is_file = 1")]
+        all_ids = [row[0] for row in db.execute("SELECT id FROM pastes")]
+        newest = db.execute("SELECT MAX(created_at) FROM pastes").fetchone()[0] or "2000-01-01"
+
+    server = None
+    if args.http:
+        server = start_local_server(pastebin.app)
+        driver = HttpDriver(*server.server_address[:2])
+    else:
+        driver = TestClientDriver(pastebin.app)
+
+    def get(path, headers=None):
+        def send():
+            status, _, received = driver.request("GET", path, headers=headers)
+            return status, received
+        return send
+
+    day = datetime.strptime(newest[:10], "%Y-%m-%d")
+    date_range = urlencode({
+        "start_date": (day - timedelta(days=7)).strftime("%Y-%m-%d"), "end_date": day.strftime("%Y-%m-%d"),
+    })
+    deep_page = max(1, total // pastebin.PAGE_SIZE // 2)
+    n = args.requests
+    results = {
+        "rows": total,
+        "file_pastes": len(file_ids),
+        "driver": "http" if args.http else "test_client",
+        "concurrency": args.concurrency,
+        "started_at": datetime.utcnow().isoformat(timespec="seconds"),
+        "scenarios": {},
+    }
+    scenarios = results["scenarios"]
+
+    scenarios["index"] = run_scenario("index", [get("/")] * n, args.concurrency)
+    scenarios["index_gzip"] = run_scenario("index_gzip", [get("/", {"Accept-Encoding": "gzip"})] * n, args.concurrency)
+    # A refresh with nothing changed: answered from the change counter, no queries or templates
+    _, headers, _ = driver.request("GET", "/")
+    scenarios["index_revalidate"] = run_scenario(
+        "index_revalidate", [get("/", {"If-None-Match": headers["ETag"]})] * n, args.concurrency, expect=(304,)
+    )
+    scenarios["index_search"] = run_scenario(
+        "index_search", [get(f"/?q={rng.choice(words[:200])}") for _ in range(n)], args.concurrency
+    )
+    scenarios["index_search_rare"] = run_scenario(
+        "index_search_rare", [get(f"/?q={rng.choice(words[5000:])}") for _ in range(n)], args.concurrency
+    )
+    scenarios["index_date"] = run_scenario("index_date", [get(f"/?{date_range}")] * n, args.concurrency)
+    scenarios["index_deep_page"] = run_scenario(
+        "index_deep_page", [get(f"/?page={deep_page}")] * n, args.concurrency
+    )
+    scenarios["check_files"] = run_scenario("check_files", [get("/admin/check-files?since=0")] * n, args.concurrency)
+    if file_ids:
+        scenarios["file"] = run_scenario(
+            "file", [get(f"/file/{rng.choice(file_ids)}") for _ in range(n)], args.concurrency
+        )
+
+    def paste_text():
+        body = urlencode({"content": " ".join(rng.choices(words, weights, k=100))})
+        status, _, received = driver.request("POST", "/paste", body=body, headers={
+            "Content-Type": "application/x-www-form-urlencoded", "Content-Length": str(len(body)),
+        })
+        return status, len(body)
+
+    scenarios["paste_text"] = run_scenario("paste_text", [paste_text] * n, args.concurrency, expect=(302,))
+    scenarios["upload_small"] = run_scenario(
+        "upload_small", [lambda: upload(driver, 64 * 1024, "small.bin")] * n, args.concurrency, expect=(204,)
+    )
+    scenarios["upload_large"] = run_scenario(
+        "upload_large", [lambda: upload(driver, args.large_mb * 1024 * 1024, "large.bin")], 1, expect=(204,)
+    )
+
+    def bulk(path, ids_from, expect):
+        def send():
+            body = json.dumps({"ids": rng.sample(ids_from, min(args.bulk_size, len(ids_from)))})
+            status, _, received = driver.request("POST", path, body=body, headers={
+                "Content-Type": "application/json", "Content-Length": str(len(body)),
+            })
+            return status, received
+        return send
+
+    bulk_rounds = max(1, n // 10)
+    scenarios["bulk_download"] = run_scenario(
+        "bulk_download", [bulk("/bulk-download", all_ids, (200,))] * bulk_rounds, args.concurrency
+    )
+    if args.bulk_delete:
+        # Disjoint id sets so every round deletes as many rows as the first
+        rng.shuffle(all_ids)
+        batches = [all_ids[i:i + args.bulk_size] for i in range(0, args.bulk_size * bulk_rounds, args.bulk_size)]
+
+        def delete(ids):
+            body = json.dumps({"ids": ids})
+            status, _, received = driver.request("POST", "/bulk-delete", body=body, headers={
+                "Content-Type": "application/json", "Content-Length": str(len(body)),
+            })
+            return status, received
+
+        scenarios["bulk_delete"] = run_scenario(
+            "bulk_delete", [lambda ids=ids: delete(ids) for ids in batches if ids], args.concurrency
+        )
+
+    if server:
+        server.shutdown()
+    scenarios["startup"] = measure_startup(env, args.startup_repeat)
+    startup = scenarios["startup"]
+    print(
+        f"{'startup':>18}: import p50 {startup['import_p50_ms']:.2f} ms  first request p50"
+        f" {startup['first_request_p50_ms']:.2f} ms  max {startup['first_request_max_ms']:.2f} ms"
+    )
+
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""Compare LIKE scans with the FTS5 index used by the search box.
+
+Builds a throwaway database with the same pastes / pastes_fts layout as
+app.init_db(), fills it with synthetic text pastes and times the two queries
+index() runs for a search: the COUNT(*) and the first page.
+
+    python benchmarks/search_benchmark.py --rows 1000000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+PAGE_SIZE = 15
+
+VOCABULARY_SIZE = 50000
+
+
+def make_vocabulary(rng):
+    """Pseudo-words; sampled with Zipf weights so terms range from common to rare"""
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 10))))
+    words = sorted(words, key=lambda w: rng.random())
+    weights = [1 / rank for rank in range(1, VOCABULARY_SIZE + 1)]
+    return words, weights
+
+
+def create_schema(db):
+    db.executescript(
+        """
+        CREATE TABLE pastes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            content TEXT,
+            stored_filename TEXT,
+            original_filename TEXT,
+            is_file INTEGER,
+            file_size INTEGER DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE VIRTUAL TABLE pastes_fts USING fts5(
+            content, original_filename,
+            content='pastes', content_rowid='id',
+            tokenize='unicode61', prefix='2 3'
+        );
+        """
+    )
+
+
+def populate(db, rows, rng, words, weights):
+    sql = "INSERT INTO pastes (content, stored_filename, original_filename, is_file) VALUES (?,?,?,?)"
+    batch = []
+    for i in range(rows):
+        if rng.random() < 0.2:
+            name = f"{rng.choices(words, weights)[0]}_{i}.{rng.choice(['log', 'png', 'zip', 'txt'])}"
+            batch.append((None, f"{i}_{name}", name, 1))
+        else:
+            body = " ".join(rng.choices(words, weights, k=rng.randint(20, 200)))
+            batch.append((body, None, None, 0))
+        if len(batch) == 10000:
+            db.executemany(sql, batch)
+            batch.clear()
+    if batch:
+        db.executemany(sql, batch)
+    db.commit()
+
+
+def timed(db, sql, params, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        db.execute(sql, params).fetchall()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def like_queries(db, term, repeat):
+    like = f"%{term}%"
+    where = "WHERE (content LIKE ? OR original_filename LIKE ?)"
+    return {
+        "count_ms": timed(db, f"SELECT COUNT(*) FROM pastes {where}", [like, like], repeat),
+        "page_ms": timed(
+            db,
+            f"SELECT * FROM pastes {where} ORDER BY created_at DESC LIMIT ? OFFSET 0",
+            [like, like, PAGE_SIZE],
+            repeat,
+        ),
+    }
+
+
+def fts_queries(db, term, repeat):
+    match = f'"{term}"*'
+    source = "pastes_fts JOIN pastes ON pastes.id = pastes_fts.rowid"
+    return {
+        "count_ms": timed(db, f"SELECT COUNT(*) FROM {source} WHERE pastes_fts MATCH ?", [match], repeat),
+        "page_ms": timed(
+            db,
+            f"SELECT pastes.*, snippet(pastes_fts, -1, '[', ']', '…', 16) FROM {source}"
+            " WHERE pastes_fts MATCH ? ORDER BY created_at DESC LIMIT ? OFFSET 0",
+            [match, PAGE_SIZE],
+            repeat,
+        ),
+        "ranked_page_ms": timed(
+            db,
+            f"SELECT pastes.* FROM {source} WHERE pastes_fts MATCH ? ORDER BY rank LIMIT ? OFFSET 0",
+            [match, PAGE_SIZE],
+            repeat,
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--terms", nargs="+",
+                        help="search terms (default: a common word, a rare word, a prefix and a miss)")
+    parser.add_argument("--db", help="keep the generated database at this path")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    words, weights = make_vocabulary(rng)
+    terms = args.terms or [words[5], words[5000], words[300][:3], "zzzzzzzzzzzz"]
+
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix="pastebin-bench-"), "pastes.db")
+    db = sqlite3.connect(path)
+    if not db.execute("SELECT 1 FROM sqlite_master WHERE name='pastes'").fetchone():
+        create_schema(db)
+        started = time.perf_counter()
+        populate(db, args.rows, rng, words, weights)
+        populated = time.perf_counter() - started
+        started = time.perf_counter()
+        db.execute("INSERT INTO pastes_fts (pastes_fts) VALUES ('rebuild')")
+        db.commit()
+        print(f"generated {args.rows} rows in {populated:.1f}s, backfilled FTS in {time.perf_counter() - started:.1f}s")
+
+    results = {"rows": db.execute("SELECT COUNT(*) FROM pastes").fetchone()[0], "terms": {}}
+    for term in terms:
+        results["terms"][term] = {
+            "like": like_queries(db, term, args.repeat),
+            "fts": fts_queries(db, term, args.repeat),
+        }
+        like, fts = results["terms"][term]["like"], results["terms"][term]["fts"]
+        print(
+            f"{term!r:>14}: LIKE count {like['count_ms']:8.1f} ms  page {like['page_ms']:8.1f} ms | "
+            f"FTS count {fts['count_ms']:7.1f} ms  page {fts['page_ms']:7.1f} ms  ranked {fts['ranked_page_ms']:7.1f} ms"
+        )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -10,21 +10,23 @@ const debounce = (fn, ms = 500) => {
 /* ---------- PERIODIC FILE CHECKING ---------- */
 let periodicCheckInterval = null;
 let lastCleanupCount = 0;
+let deletionGeneration = null;
 
 function initPeriodicFileCheck() {
-  // Check for missing files every 2 seconds
+  // Poll the server's deletion generation every 2 seconds. The server-side
+  // watcher and reconciler do the file checks, so each poll is a single lookup.
   periodicCheckInterval = setInterval(async () => {
     try {
-      const response = await fetch('/admin/check-files', {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        }
-      });
+      const since = deletionGeneration === null ? '' : `?since=${deletionGeneration}`;
+      const response = await fetch(`/admin/check-files${since}`);
       
       const result = await response.json();
+      if (!result.success) return;
+      
+      const isFirstCheck = deletionGeneration === null;
+      deletionGeneration = result.generation;
       
-      if (result.success && result.cleanup_count > 0) {
+      if (!isFirstCheck && result.cleanup_count > 0) {
         // Files were found missing and cleaned up
         console.log(`Automatic cleanup: ${result.cleanup_count} missing files detected and removed`);
         
@@ -44,6 +46,103 @@ function initPeriodicFileCheck() {
   }, 2000); // Check every 2 seconds
 }
 
+/* ---------- LIVE CHANGE FEED ---------- */
+let changeSource = null;
+
+function initChangeFeed() {
+  // Browsers without Server-Sent Events fall back to polling
+  if (typeof EventSource === 'undefined') {
+    initPeriodicFileCheck();
+    return;
+  }
+  
+  // Start from the cursor the page was rendered at so nothing is missed in between;
+  // on reconnect the browser resumes from Last-Event-ID instead
+  const cursor = document.getElementById('pasteList').dataset.changeCursor || '';
+  changeSource = new EventSource(`/changes/stream?since=${cursor}`);
+  changeSource.addEventListener('changes', (e) => applyPasteChanges(JSON.parse(e.data)));
+  changeSource.addEventListener('reset', () => refreshPasteList());
+}
+
+function stopChangeFeed() {
+  if (changeSource) {
+    changeSource.close();
+    changeSource = null;
+  }
+}
+
+async function applyPasteChanges(changes) {
+  const inserted = new Set();
+  changes.forEach(change => {
+    const id = String(change.paste_id);
+    if (change.op === 'delete') {
+      inserted.delete(id);
+      removePasteCard(id);
+    } else if (change.op === 'insert') {
+      inserted.add(id);
+    }
+  });
+  
+  // New pastes only belong on the unfiltered first page
+  if (inserted.size > 0 && isViewingNewest()) {
+    await insertPasteCards(Array.from(inserted));
+  }
+}
+
+function removePasteCard(id) {
+  const item = document.getElementById(`item-${id}`);
+  if (!item) return;
+  
+  item.style.transform = "scale(0)";
+  item.style.opacity = "0";
+  setTimeout(() => {
+    item.remove();
+    if (selectedItems.has(id)) {
+      selectedItems.delete(id);
+      updateBulkActionsAfterDelete();
+    }
+  }, 300);
+}
+
+function isViewingNewest() {
+  const searchBox = document.getElementById("searchBox");
+  const dateRange = window.getCurrentDateRange ? window.getCurrentDateRange() : { start: '', end: '' };
+  const page = new URLSearchParams(window.location.search).get('page') || '1';
+  return page === '1' && !(searchBox && searchBox.value.trim()) && !dateRange.start && !dateRange.end;
+}
+
+async function insertPasteCards(ids) {
+  const pasteList = document.getElementById('pasteList');
+  const grid = pasteList.querySelector('.grid');
+  if (!grid) {
+    // Empty-state placeholder is showing; render the list from scratch
+    await refreshPasteList();
+    return;
+  }
+  
+  try {
+    const res = await fetch(`/cards?ids=${ids.join(',')}`);
+    if (!res.ok) return;
+    const data = await res.json();
+    
+    // Insert oldest first so the newest ends up on top
+    ids.map(Number).sort((a, b) => a - b).forEach(id => {
+      const html = data.cards[id];
+      if (!html || document.getElementById(`item-${id}`)) return;
+      grid.insertAdjacentHTML('afterbegin', html);
+      const card = grid.firstElementChild;
+      card.querySelectorAll('.copy-btn').forEach(handleCopy);
+      card.querySelectorAll('.delete-btn').forEach(handleDelete);
+    });
+    
+    // Keep the page at its usual size
+    const pageSize = parseInt(pasteList.dataset.pageSize) || 15;
+    Array.from(grid.querySelectorAll('.paste-card')).slice(pageSize).forEach(card => card.remove());
+  } catch (error) {
+    console.error('Failed to insert new pastes:', error);
+  }
+}
+
 async function refreshPasteList() {
   try {
     // Get current search parameters
@@ -406,42 +505,25 @@ function initBulkSelection() {
     updateBulkActions();
   });
 
-  bulkDownload.addEventListener('click', async () => {
+  bulkDownload.addEventListener('click', () => {
     if (selectedItems.size === 0) return;
     
-    try {
-      const res = await fetch('/bulk-download', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ ids: Array.from(selectedItems) })
-      });
-      
-      if (res.ok) {
-        const blob = await res.blob();
-        const url = window.URL.createObjectURL(blob);
-        const a = document.createElement('a');
-        a.href = url;
-        
-        // Get filename from Content-Disposition header
-        const contentDisposition = res.headers.get('Content-Disposition');
-        let filename = `pastebin_bulk_${new Date().toISOString().slice(0, 19).replace(/[-:]/g, '')}.zip`;
-        
-        if (contentDisposition) {
-          const filenameMatch = contentDisposition.match(/filename[^;=\n]*=((['"]).*?\2|[^;\n]*)/);
-          if (filenameMatch && filenameMatch[1]) {
-            filename = filenameMatch[1].replace(/['"]/g, '');
-          }
-        }
-        
-        a.download = filename;
-        a.click();
-        window.URL.revokeObjectURL(url);
-      } else {
-        alert('Download failed');
-      }
-    } catch (err) {
-      alert('Download failed: ' + err.message);
-    }
+    // A regular form POST lets the browser stream the archive straight to
+    // disk; fetch() + blob() would hold the whole ZIP in memory first
+    const form = document.createElement('form');
+    form.method = 'POST';
+    form.action = '/bulk-download';
+    form.classList.add('hidden');
+    selectedItems.forEach(id => {
+      const input = document.createElement('input');
+      input.type = 'hidden';
+      input.name = 'ids';
+      input.value = id;
+      form.appendChild(input);
+    });
+    document.body.appendChild(form);
+    form.submit();
+    form.remove();
   });
 
   // Updated bulk delete with confirmation modal
@@ -643,52 +725,37 @@ function initUploadProgress() {
       submitSpinner.classList.remove('hidden');
       uploadProgress.classList.remove('hidden');
       
-      // Create FormData and submit via XMLHttpRequest for progress tracking
-      const formData = new FormData(form);
-      const xhr = new XMLHttpRequest();
+      // Send each file as a resumable upload so a dropped connection only
+      // costs the chunk in flight, not everything sent so far
+      const files = Array.from(fileInput.files);
+      const content = form.querySelector('textarea[name="content"]').value.trim();
+      const ttl = form.querySelector('select[name="ttl"]')?.value || '';
+      const totalBytes = files.reduce((sum, file) => sum + file.size, 0) || 1;
+      let doneBytes = 0;
       
-      // Track upload progress
-      xhr.upload.addEventListener('progress', (e) => {
-        if (e.lengthComputable) {
-          const progress = Math.round((e.loaded / e.total) * 100);
-          progressBar.style.width = progress + '%';
-          progressPercent.textContent = progress + '%';
-        }
-      });
+      const showProgress = (loaded) => {
+        const progress = Math.min(100, Math.round((loaded / totalBytes) * 100));
+        progressBar.style.width = progress + '%';
+        progressPercent.textContent = progress + '%';
+      };
       
-      // Handle completion
-      xhr.addEventListener('load', () => {
-        if (xhr.status === 200) {
-          // Ensure we show 100% briefly before clearing form and reloading
-          progressBar.style.width = '100%';
-          progressPercent.textContent = '100%';
-          
-          setTimeout(() => {
-            // Reset form before reloading
-            resetFormAfterSuccess();
-            window.location.reload();
-          }, 500);
-        } else {
-          alert('Upload failed. Please try again.');
-          resetUploadUI();
+      (async () => {
+        for (const file of files) {
+          await uploadFileResumable(file, content, ttl, (sent) => showProgress(doneBytes + sent));
+          doneBytes += file.size;
         }
-      });
-      
-      // Handle errors
-      xhr.addEventListener('error', () => {
-        alert('Upload failed: Network error');
-        resetUploadUI();
-      });
-      
-      // Handle abort
-      xhr.addEventListener('abort', () => {
-        alert('Upload was cancelled');
+      })().then(() => {
+        // Ensure we show 100% briefly before clearing form and reloading
+        showProgress(totalBytes);
+        setTimeout(() => {
+          // Reset form before reloading
+          resetFormAfterSuccess();
+          window.location.reload();
+        }, 500);
+      }).catch((err) => {
+        alert('Upload failed: ' + err.message);
         resetUploadUI();
       });
-      
-      // Start the upload
-      xhr.open('POST', form.action);
-      xhr.send(formData);
     } else {
       // For text-only submissions, we need to handle the form reset differently
       // since the page will reload after submission
@@ -719,6 +786,80 @@ function initUploadProgress() {
   }
 }
 
+/* ---------- RESUMABLE UPLOADS ---------- */
+const UPLOAD_CHUNK_BYTES = 8 * 1024 * 1024;
+const UPLOAD_MAX_RETRIES = 5;
+
+function uploadRequest(method, url, headers = {}, body = null, onProgress = null) {
+  return new Promise((resolve, reject) => {
+    const xhr = new XMLHttpRequest();
+    xhr.open(method, url);
+    Object.entries(headers).forEach(([name, value]) => xhr.setRequestHeader(name, value));
+    if (onProgress) {
+      xhr.upload.addEventListener('progress', (e) => onProgress(e.loaded));
+    }
+    xhr.addEventListener('load', () => resolve(xhr));
+    xhr.addEventListener('error', () => reject(new Error('Network error')));
+    xhr.addEventListener('abort', () => reject(new Error('Upload was cancelled')));
+    xhr.send(body);
+  });
+}
+
+function encodeUploadMetadata(fields) {
+  const b64 = (value) => btoa(unescape(encodeURIComponent(value)));
+  return Object.entries(fields)
+    .filter(([, value]) => value)
+    .map(([key, value]) => `${key} ${b64(value)}`)
+    .join(',');
+}
+
+async function uploadFileResumable(file, content, ttl, onProgress) {
+  const created = await uploadRequest('POST', '/uploads', {
+    'Upload-Length': String(file.size),
+    'Upload-Metadata': encodeUploadMetadata({ filename: file.name, content, ttl })
+  });
+  if (created.status !== 201) {
+    throw new Error(`server refused ${file.name} (${created.status})`);
+  }
+  const location = created.getResponseHeader('Location');
+  let offset = 0;
+  let retries = 0;
+  
+  while (offset < file.size) {
+    const chunk = file.slice(offset, offset + UPLOAD_CHUNK_BYTES);
+    try {
+      const xhr = await uploadRequest('PATCH', location, {
+        'Content-Type': 'application/offset+octet-stream',
+        'Upload-Offset': String(offset)
+      }, chunk, (loaded) => onProgress(offset + loaded));
+      
+      if (xhr.status === 204 || xhr.status === 409) {
+        // 409: the server has a different offset (e.g. a retried chunk landed); follow it
+        offset = parseInt(xhr.getResponseHeader('Upload-Offset'), 10);
+        retries = 0;
+        onProgress(offset);
+        continue;
+      }
+      if (xhr.status < 500) {
+        throw Object.assign(new Error(`${file.name} was rejected (${xhr.status})`), { fatal: true });
+      }
+      throw new Error(`server error ${xhr.status}`);
+    } catch (err) {
+      if (err.fatal || ++retries > UPLOAD_MAX_RETRIES) {
+        throw err;
+      }
+      await new Promise((resolve) => setTimeout(resolve, 1000 * 2 ** (retries - 1)));
+      // Ask the server how much it actually kept before resuming
+      const head = await uploadRequest('HEAD', location).catch(() => null);
+      if (head && head.status === 200) {
+        offset = parseInt(head.getResponseHeader('Upload-Offset'), 10);
+      } else if (head && head.status === 404) {
+        throw new Error(`upload of ${file.name} expired on the server`);
+      }
+    }
+  }
+}
+
 /* ---------- MODAL ---------- */
 function initModal() {
   const modal = document.getElementById('modal');
@@ -819,6 +960,90 @@ function initModal() {
     }
   }
 
+  function escapeText(text) {
+    return text.replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;');
+  }
+
+  // Text files are previewed through /preview: the head and tail of big files, never the whole thing
+  async function textPreviewHtml(pasteId, language) {
+    try {
+      const res = await fetch(`/preview/${pasteId}`);
+      if (!res.ok) {
+        return `<div class="text-center py-8 mb-4"><p class="text-red-400">Failed to load file content (file may have been deleted)</p></div>`;
+      }
+      const preview = await res.json();
+      if (preview.binary) {
+        return `<div class="text-center py-8 mb-4"><p class="text-gray-400">This file does not look like text; download it instead.</p></div>`;
+      }
+      let html = `<pre class="text-sm text-gray-300"><code class="language-${language}">${escapeText(preview.head)}</code></pre>`;
+      if (preview.tail !== null) {
+        html += `
+          <p class="text-xs text-gray-500 text-center my-2">&hellip;</p>
+          <pre class="text-sm text-gray-300"><code class="language-${language}">${escapeText(preview.tail)}</code></pre>
+        `;
+      }
+      let footer = '';
+      if (preview.truncated) {
+        const lines = preview.lines !== null ? `, ${preview.lines.toLocaleString()} lines` : '';
+        footer = `
+          <div class="flex flex-wrap items-center gap-2 mt-3 text-xs text-gray-400">
+            <span class="preview-info">Showing the start and end of ${formatFileSize(preview.size)}${lines}.</span>
+            <input type="number" min="1" placeholder="Line" class="preview-line-input w-24 bg-gray-800 border border-gray-700 rounded px-2 py-1 text-gray-200">
+            <button class="preview-goto-btn bg-gray-700 hover:bg-gray-600 px-2 py-1 rounded transition-colors">Go to line</button>
+          </div>
+        `;
+      }
+      return `
+        <div class="text-preview bg-gray-900 p-4 rounded-lg mb-4" data-id="${pasteId}" data-language="${language}">
+          <div class="preview-body max-h-96 overflow-auto">${html}</div>
+          ${footer}
+        </div>
+      `;
+    } catch {
+      return `<div class="text-center py-8 mb-4"><p class="text-red-400">Failed to load file content</p></div>`;
+    }
+  }
+
+  // Jump to a line of a large text file; the server seeks there through its line index
+  async function showPreviewLines(container, line) {
+    const info = container.querySelector('.preview-info');
+    try {
+      const res = await fetch(`/preview/${container.dataset.id}?line=${line}&count=200`);
+      const result = await res.json();
+      if (res.status === 503 && result.indexing) {
+        info.textContent = 'Still indexing this file, try again in a moment.';
+        return;
+      }
+      if (!res.ok) throw new Error(result.message || 'request failed');
+      if (!result.count) {
+        info.textContent = `The file has ${result.lines.toLocaleString()} lines.`;
+        return;
+      }
+      const last = result.line + result.count - 1;
+      container.querySelector('.preview-body').innerHTML =
+        `<pre class="text-sm text-gray-300"><code class="language-${container.dataset.language}">${escapeText(result.text)}</code></pre>`;
+      info.textContent = `Lines ${result.line.toLocaleString()}–${last.toLocaleString()} of ${result.lines.toLocaleString()}` +
+        (result.truncated ? ' (cut short, the lines are very long).' : '.');
+      applySyntaxHighlighting();
+    } catch (err) {
+      info.textContent = 'Failed to load lines: ' + err.message;
+    }
+  }
+
+  modal.addEventListener('click', (e) => {
+    const button = e.target.closest('.preview-goto-btn');
+    if (!button) return;
+    const container = button.closest('.text-preview');
+    const line = parseInt(container.querySelector('.preview-line-input').value, 10);
+    if (line > 0) showPreviewLines(container, line);
+  });
+
+  modal.addEventListener('keydown', (e) => {
+    if (e.key !== 'Enter' || !e.target.classList.contains('preview-line-input')) return;
+    const line = parseInt(e.target.value, 10);
+    if (line > 0) showPreviewLines(e.target.closest('.text-preview'), line);
+  });
+
   // Card click handlers - use event delegation with specific exclusions
   document.addEventListener('click', async (e) => {
     // Don't trigger modal for these elements
@@ -837,7 +1062,7 @@ function initModal() {
     const pasteId = card.dataset.pasteId;
     const isFile = card.dataset.isFile === '1';
     const filename = card.dataset.filename;
-    const textContent = card.dataset.content;
+    const hasText = card.dataset.hasText === '1';
     const fileSize = card.dataset.fileSize;
 
     // Clear previous actions
@@ -875,39 +1100,9 @@ function initModal() {
           </div>
         `;
       } else if (ext.match(/\.(txt|md|log|conf|ini|cfg|json|xml|yaml|yml|csv)$/)) {
-        try {
-          const res = await fetch(`/file/${pasteId}`);
-          if (res.ok) {
-            const text = await res.text();
-            const escapedText = text.replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;');
-            mediaHtml = `
-              <div class="bg-gray-900 p-4 rounded-lg mb-4 max-h-96 overflow-auto">
-                <pre class="text-sm text-gray-300"><code class="language-${ext.slice(1)}">${escapedText}</code></pre>
-              </div>
-            `;
-          } else {
-            mediaHtml = `<div class="text-center py-8 mb-4"><p class="text-red-400">Failed to load file content (file may have been deleted)</p></div>`;
-          }
-        } catch {
-          mediaHtml = `<div class="text-center py-8 mb-4"><p class="text-red-400">Failed to load file content</p></div>`;
-        }
+        mediaHtml = await textPreviewHtml(pasteId, ext.slice(1));
       } else if (ext.match(/\.(js|py|html|css|java|cpp|c|php|rb|go|rs|swift)$/)) {
-        try {
-          const res = await fetch(`/file/${pasteId}`);
-          if (res.ok) {
-            const text = await res.text();
-            const escapedText = text.replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;');
-            mediaHtml = `
-              <div class="bg-gray-900 p-4 rounded-lg mb-4 max-h-96 overflow-auto">
-                <pre class="text-sm text-gray-300"><code class="language-${getLanguageFromExt(ext)}">${escapedText}</code></pre>
-              </div>
-            `;
-          } else {
-            mediaHtml = `<div class="text-center py-8 mb-4"><p class="text-red-400">Failed to load file content (file may have been deleted)</p></div>`;
-          }
-        } catch {
-          mediaHtml = `<div class="text-center py-8 mb-4"><p class="text-red-400">Failed to load file content</p></div>`;
-        }
+        mediaHtml = await textPreviewHtml(pasteId, getLanguageFromExt(ext));
       } else if (ext.match(/\.(doc|docx|xls|xlsx|ppt|pptx)$/)) {
         const officeIcons = {
           'doc': 'text-blue-500', 'docx': 'text-blue-500',
@@ -929,12 +1124,22 @@ function initModal() {
         mediaHtml = `<div class="text-center py-8 mb-4"><p class="text-gray-400">Preview not available for this file type.</p></div>`;
       }
       
-      // Generate text content if available (appears AFTER media)
-      if (textContent && textContent.trim()) {
+      // Fetch the associated text only when there is some (appears AFTER media)
+      let textContent = '';
+      if (hasText) {
+        try {
+          const res = await fetch(`/raw/${pasteId}`);
+          if (res.ok) textContent = await res.text();
+        } catch {
+          /* the file preview is still useful without its note */
+        }
+      }
+      if (textContent.trim()) {
+        const escapedNote = textContent.replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;');
         textHtml = `
           <div class="bg-gray-900 p-4 rounded-lg">
             <h4 class="text-sm font-medium text-gray-300 mb-2">Associated Text:</h4>
-            <pre class="text-sm text-gray-300 whitespace-pre-wrap">${textContent}</pre>
+            <pre class="text-sm text-gray-300 whitespace-pre-wrap">${escapedNote}</pre>
           </div>
         `;
       }
@@ -948,9 +1153,9 @@ function initModal() {
         </a>
       `;
       
-      if (textContent && textContent.trim()) {
+      if (textContent.trim()) {
         actionsHtml += `
-          <button class="modal-copy-text-btn bg-blue-600 hover:bg-blue-700 px-3 sm:px-4 py-2 rounded-lg text-xs sm:text-sm font-medium transition-colors" data-text="${textContent.replace(/"/g, '&quot;')}">
+          <button class="modal-copy-text-btn bg-blue-600 hover:bg-blue-700 px-3 sm:px-4 py-2 rounded-lg text-xs sm:text-sm font-medium transition-colors" data-text="${textContent.replace(/&/g, '&amp;').replace(/"/g, '&quot;')}">
             Copy Text
           </button>
         `;
@@ -1253,7 +1458,7 @@ function initSettings() {
     }
   }
 
-  async function browseDirectory(path) {
+  async function browseDirectory(path, offset = 0) {
     pathInput.value = path;
     
     try {
@@ -1262,7 +1467,7 @@ function initSettings() {
         headers: {
           'Content-Type': 'application/json',
         },
-        body: JSON.stringify({ path: path })
+        body: JSON.stringify({ path: path, offset: offset })
       });
       
       const data = await response.json();
@@ -1282,10 +1487,14 @@ function initSettings() {
       // Update select current button
       selectCurrentBtn.disabled = !data.current_writable;
       
-      // Clear and populate directory list
-      directoryList.innerHTML = '';
+      // Clear and populate directory list (later pages are appended)
+      const loadMore = directoryList.querySelector('.browse-load-more');
+      if (loadMore) loadMore.remove();
+      if (offset === 0) {
+        directoryList.innerHTML = '';
+      }
       
-      if (data.items.length === 0) {
+      if (data.items.length === 0 && offset === 0) {
         const emptyDiv = document.createElement('div');
         emptyDiv.className = 'p-6 text-center text-gray-400';
         emptyDiv.textContent = 'This directory contains no subdirectories';
@@ -1293,60 +1502,93 @@ function initSettings() {
         return;
       }
       
+      const rows = new Map();
       data.items.forEach(item => {
-        const itemDiv = document.createElement('div');
-        itemDiv.className = `p-3 border-b border-gray-800 flex items-center justify-between hover:bg-gray-800 cursor-pointer transition-colors ${!item.readable ? 'opacity-50' : ''}`;
-        
-        const icon = item.type === 'drive' ? '💾' : (item.hidden ? '📁' : '📂');
-        const statusText = item.error ? ' (access error)' : '';
-        
-        // Status indicator and label
-        let statusIcon = '';
-        let statusLabel = '';
-        
-        if (item.error) {
-          statusIcon = '<span class="text-red-400">⚠</span>';
-          statusLabel = 'Error';
-        } else if (item.has_subdirs) {
-          statusIcon = '<span class="text-blue-400">→</span>';
-          statusLabel = 'Continue';
-        } else if (item.writable) {
-          statusIcon = '<span class="text-green-400">✓</span>';
-          statusLabel = 'Writable';
-        } else {
-          statusIcon = '<span class="text-red-400">✗</span>';
-          statusLabel = 'Read-only';
-        }
-        
-        itemDiv.innerHTML = `
-          <div class="flex items-center gap-3">
-            <span class="text-xl">${icon}</span>
-            <div>
-              <div class="text-sm text-gray-300">${item.name}${statusText}</div>
-              <div class="text-xs text-gray-500">${item.type}</div>
-            </div>
-          </div>
-          <div class="flex items-center gap-2">
-            <span class="text-xs ${item.has_subdirs ? 'text-blue-400' : (item.writable ? 'text-green-400' : 'text-gray-500')}">${statusLabel}</span>
-            ${statusIcon}
-          </div>
-        `;
-        
-        if (item.readable) {
-          itemDiv.addEventListener('click', async () => {
-            await browseDirectory(item.path);
-          });
-        }
-        
+        const itemDiv = renderBrowseItem(item);
+        rows.set(item.path, itemDiv);
         directoryList.appendChild(itemDiv);
       });
       
+      if (data.next_offset !== null && data.next_offset !== undefined) {
+        const moreDiv = document.createElement('div');
+        moreDiv.className = 'browse-load-more p-3 text-center text-sm text-blue-400 hover:bg-gray-800 cursor-pointer';
+        moreDiv.textContent = `Show more (${data.total - data.next_offset} remaining)`;
+        moreDiv.addEventListener('click', () => browseDirectory(path, data.next_offset));
+        directoryList.appendChild(moreDiv);
+      }
+      
+      // Slow directories (e.g. on a busy NAS) are filled in as their probes finish
+      if (data.pending && data.pending.length) {
+        const res = await fetch('/settings/browse/details', {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ paths: data.pending })
+        });
+        const details = await res.json();
+        if (details.success && currentBrowsingPath === data.current_path) {
+          details.items.forEach(item => {
+            const row = rows.get(item.path);
+            if (row && row.isConnected) row.replaceWith(renderBrowseItem(item));
+          });
+        }
+      }
+      
     } catch (error) {
       console.error('Failed to browse directory:', error);
       alert('Failed to browse directory: ' + error.message);
     }
   }
 
+  function renderBrowseItem(item) {
+    const itemDiv = document.createElement('div');
+    itemDiv.className = `p-3 border-b border-gray-800 flex items-center justify-between hover:bg-gray-800 cursor-pointer transition-colors ${!item.readable ? 'opacity-50' : ''}`;
+    
+    const icon = item.type === 'drive' ? '💾' : (item.hidden ? '📁' : '📂');
+    const statusText = item.error ? ' (access error)' : '';
+    
+    // Status indicator and label
+    let statusIcon = '';
+    let statusLabel = '';
+    
+    if (item.error) {
+      statusIcon = '<span class="text-red-400">⚠</span>';
+      statusLabel = 'Error';
+    } else if (item.pending) {
+      statusIcon = '<span class="text-gray-500">…</span>';
+      statusLabel = 'Checking';
+    } else if (item.has_subdirs) {
+      statusIcon = '<span class="text-blue-400">→</span>';
+      statusLabel = 'Continue';
+    } else if (item.writable) {
+      statusIcon = '<span class="text-green-400">✓</span>';
+      statusLabel = 'Writable';
+    } else {
+      statusIcon = '<span class="text-red-400">✗</span>';
+      statusLabel = 'Read-only';
+    }
+    
+    itemDiv.innerHTML = `
+      <div class="flex items-center gap-3">
+        <span class="text-xl">${icon}</span>
+        <div>
+          <div class="text-sm text-gray-300">${item.name}${statusText}</div>
+          <div class="text-xs text-gray-500">${item.type}</div>
+        </div>
+      </div>
+      <div class="flex items-center gap-2">
+        <span class="text-xs ${item.has_subdirs ? 'text-blue-400' : (item.writable ? 'text-green-400' : 'text-gray-500')}">${statusLabel}</span>
+        ${statusIcon}
+      </div>
+    `;
+    
+    if (item.readable) {
+      itemDiv.addEventListener('click', async () => {
+        await browseDirectory(item.path);
+      });
+    }
+    return itemDiv;
+  }
+
   async function saveUploadFolder(newPath) {
     loadingOverlay.classList.remove('hidden');
     loadingMessage.textContent = 'Updating upload folder and migrating files...';
@@ -1363,6 +1605,9 @@ function initSettings() {
       const result = await response.json();
       
       if (result.success) {
+        if (result.migration_id) {
+          await waitForMigration();
+        }
         loadingMessage.textContent = 'Success! Reloading page...';
         
         setTimeout(() => {
@@ -1379,6 +1624,25 @@ function initSettings() {
     }
   }
 
+  // Files keep moving on the server even if this tab is closed; this only reports progress
+  async function waitForMigration() {
+    while (true) {
+      const res = await fetch('/settings/migration');
+      const { migration } = await res.json();
+      if (!migration) return;
+      const percent = migration.bytes_total ? Math.floor((migration.bytes_done / migration.bytes_total) * 100) : 0;
+      loadingMessage.textContent = migration.status === 'scanning'
+        ? 'Listing files to migrate...'
+        : `Migrating files... ${migration.done} / ${migration.total} (${percent}%)`;
+      if (migration.status === 'done') return;
+      if (migration.status === 'failed') {
+        alert(`Migration finished with errors: ${migration.message}. Files that were not moved are still served from ${migration.source}.`);
+        return;
+      }
+      await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+  }
+
   // Close settings on escape key
   document.addEventListener('keydown', (e) => {
     if (e.key === 'Escape' && !settingsModal.classList.contains('hidden')) {
@@ -1455,7 +1719,7 @@ document.addEventListener("DOMContentLoaded", () => {
   initDateRangePicker();
   initUploadProgress();
   initSettings();
-  initPeriodicFileCheck(); // Add periodic file checking
+  initChangeFeed(); // Live paste list updates
   attachItemListeners();
 
   searchBox.addEventListener("input", debounce(doSearch, 1000));
@@ -1463,5 +1727,6 @@ document.addEventListener("DOMContentLoaded", () => {
 
 // Clean up on page unload
 window.addEventListener('beforeunload', () => {
+  stopChangeFeed();
   stopPeriodicFileCheck();
 });